@@ -1,9 +1,9 @@
-from . import blockdevice
-from . import mount
-from . import filesystem
-from . import btrfs
-from . import xen
-from . import lvm
-from . import drbd
-from . import interfaces
-from .atomic_operations import AtomicContext
+'''pybofh: python tools for system administration (block devices, LVM, DRBD, Xen...).
+Submodules are imported on first access (pybofh.lvm, for example), so that
+importing a single submodule doesn't load the whole package'''
+from .lazy import lazy_package
+
+SUBMODULES= ('atomic_operations', 'blockdevice', 'btrfs', 'drbd', 'encryption', 'events', 'filesystem', 'interfaces',
+    'lvm', 'misc', 'mount', 'settingsmodule', 'shell', 'xen')
+
+lazy_package(__name__, SUBMODULES, {'AtomicContext': 'atomic_operations'})
@@ -1,28 +1,67 @@
 # -*- encoding: utf-8 -*-
 
-from pybofh.misc import file_type, lcm
+from pybofh.misc import file_type, lcm, read_file, list_dir
+from pybofh import misc
 from pybofh import shell
+from pybofh import settingsmodule
 import os
 import os.path
 import weakref
 from abc import ABCMeta, abstractmethod, abstractproperty
 from functools import partial
+import importlib
+import json
 import logging
 import re
+import subprocess
 
 DM_DIR = '/dev/mapper/'
 INITIALIZING_SENTINEL = 'initializing'
+SYSFS_ROOT = '/sys'
+MOUNTINFO = '/proc/self/mountinfo'
+SECTOR_SIZE = 512 # unit of sizes in sysfs, regardless of the device sector size
+TOPOLOGY_PROVIDERS = ('commands', 'sysfs')
+LSBLK = '/bin/lsblk'
+LSBLK_FIELDS = ['NAME', 'MAJ:MIN', 'RM', 'SIZE', 'RO', 'TYPE', 'MOUNTPOINT']
 
 log = logging.getLogger(__name__)
 
+settings = settingsmodule.get_settings(__name__)
+settings.define("topology_provider", "How to query block device topology and sizes: 'commands' (lsblk, dmsetup, blockdev) or 'sysfs'")
+settings.define("sysfs_root", "Where sysfs is mounted. Used by the sysfs topology provider")
+
 #this is a lit of 2-tuples that is used for other modules to be able to register Data subclasses.
-#each key (first tuple element) is a function that takes the block device instance and returns True iff the data of that block device can
+#each key (first tuple element) is either a Magic instance or a function that takes the block device instance and returns True iff the data of that block device can
 #be represented using a certain Data subclass.
 #The value (second tuple element) is a function that takes the block device instance and returns a instance
 #of the Data subclass representing the data.
 #example: lambda path: filetype(path)=='Ext2', Ext2Class
 data_classes = []
 
+#modules that register data classes when imported. They're imported on the first
+#detection (see _detect_data_class), so importing pybofh doesn't have to load them
+DATA_CLASS_MODULES = ('pybofh.filesystem', 'pybofh.encryption', 'pybofh.lvm')
+_data_class_modules_loaded = False
+
+class Magic(object):
+    '''A magic signature: the bytes found at a given offset of a block device
+    whose data is of a certain type'''
+    def __init__(self, offset, magic):
+        self.offset = offset
+        self.magic = magic
+
+    @property
+    def size(self):
+        '''How many bytes of the start of the device are needed to test this signature'''
+        return self.offset + len(self.magic)
+
+    def matches(self, header):
+        '''Checks if the signature is present on a header - the data at the start of a block device'''
+        return header[self.offset:self.offset + len(self.magic)] == self.magic
+
+    def __repr__(self):
+        return "{}({!r}, {!r})".format(self.__class__.__name__, self.offset, self.magic)
+
 def is_data_class_filetype(string_match, blockdevice):
     '''Checks if a blockdevice belongs to a data class by testing if a substring
     exists on its file type'''
@@ -31,21 +70,53 @@ def is_data_class_filetype(string_match, blockdevice):
 def register_data_class(match_obj, cls, priority=False):
     '''Registers a class that represents a Data subclass - Ext2, for example.
     If match_obj is a function, it should take a single argument - a block device - and return True iff cls is a appropriate representation of that block device content.
+    If match_obj is a Magic, the start of the block device is checked for that signature.
     If match_obj is a string, it checks the filetype of the block device matches that string instead'''
     if isinstance(match_obj, basestring):
         string_match = match_obj
         f = partial(is_data_class_filetype, string_match)
+    elif isinstance(match_obj, Magic):
+        f = match_obj
     elif callable(match_obj):
         f = match_obj
     else:
-        raise ValueError("match_obj must be a string or a callable")
+        raise ValueError("match_obj must be a string, a Magic or a callable")
     tup = (f, cls)
     pos = 0 if priority else len(data_classes)
     data_classes.insert(pos, tup)
+    data_class_cache.invalidate()
+
+def read_header(path):
+    '''Reads the start of a block device - enough to test all the registered
+    Magic signatures. Returns an empty string if the device can't be read'''
+    size = max([k.size for k, _ in data_classes if isinstance(k, Magic)] or [0])
+    try:
+        return misc.read_file(path, size)
+    except (IOError, OSError) as e:
+        log.warning("Failed to read the header of %s: %s", path, e)
+        return ''
 
 def get_data_class_for(blockdevice):
+    return data_class_cache.get(blockdevice.path, partial(_detect_data_class, blockdevice))
+
+def _load_data_class_modules():
+    global _data_class_modules_loaded
+    if not _data_class_modules_loaded:
+        for name in DATA_CLASS_MODULES:
+            importlib.import_module(name)
+        _data_class_modules_loaded = True
+
+def _detect_data_class(blockdevice):
+    _load_data_class_modules()
+    header = None # read once, only if there's a Magic to test
     for k, v in data_classes:
-        if k(blockdevice):
+        if isinstance(k, Magic):
+            if header is None:
+                header = read_header(blockdevice.path)
+            matched = k.matches(header)
+        else:
+            matched = k(blockdevice)
+        if matched:
             return v
     return None #data type not recognized
 
@@ -97,7 +168,10 @@ class Resizeable(object):
         if byte_size:
             byte_size = self._process_resize_size(byte_size, relative, approximate, round_up)
         log.info("Resizing {} from {} to {} bytes".format(self, self.size, byte_size))
-        self._resize(byte_size, minimum, maximum, interactive, **kwargs)
+        try:
+            self._resize(byte_size, minimum, maximum, interactive, **kwargs)
+        finally:
+            size_cache.invalidate()
         if byte_size:
             if not self.size == byte_size:
                 raise Resizeable.ResizeError("After resizing {} to {} bytes, got a size of {} bytes instead".format(self, byte_size, self.size))
@@ -244,10 +318,12 @@ class Parametrizable(object):
 class BaseBlockDevice(Resizeable):
     __metaclass__=ABCMeta
     def __init__(self, device_path, skip_validation=False):
-        if not skip_validation:
+        if skip_validation:
+            self._path = device_path
+        else:
             if not os.path.exists(device_path):
                 raise Exception("Blockdevice path {} does not exist".format(device_path))
-        self._set_path(device_path)
+            self._set_path(device_path)
         self._last_data = None
         self._last_data_class = None
 
@@ -308,6 +384,12 @@ class Data(Resizeable):
     def __init__(self, blockdevice_or_path):
         self.device = blockdevice(blockdevice_or_path)
 
+    @property
+    def max_unused_size(self):
+        '''How many bytes at the end of the device this data may leave unused.
+        Most data uses the whole device'''
+        return 0
+
     def __repr__(self):
         return "{}({})".format(self.__class__.__name__, self.device)
 
@@ -412,7 +494,8 @@ class BlockDeviceStack(Resizeable, Openable):
 
     def _open(self, **kwargs):
         open_args = kwargs
-        return self._compute_and_open_layers(open_args)
+        with size_cache: # the layer walk queries the topology several times
+            return self._compute_and_open_layers(open_args)
 
     def _close(self):
         for layer in reversed(self.layers[1:]):
@@ -430,10 +513,17 @@ class BlockDeviceStack(Resizeable, Openable):
         return None # this can never be opened externally
 
     def _sanity_check(self):
-        for layer in self.layers[:-1]:
-            layer.data._sanity_check()
-        if self.innermost.data is not None:
-            assert self.innermost.size == self.innermost.data.size
+        with size_cache:
+            self._prefetch_sizes()
+            for layer in self.layers[:-1]:
+                layer.data._sanity_check()
+            if self.innermost.data is not None:
+                unused = self.innermost.size - self.innermost.data.size
+                assert 0 <= unused <= self.innermost.data.max_unused_size
+
+    def _prefetch_sizes(self):
+        '''Queries the sizes of all the layers at once, for use inside a size_cache block'''
+        sizes([l.path for l in self.layers])
 
     @property
     def layers(self):
@@ -481,7 +571,12 @@ class BlockDeviceStack(Resizeable, Openable):
 
     @property
     def total_overhead(self):
-        return sum(l.data.overhead for l in self.layers[:-1])
+        with size_cache:
+            return sum(l.data.overhead for l in self.layers[:-1])
+
+    def resize(self, *args, **kwargs):
+        with size_cache:
+            return Resizeable.resize(self, *args, **kwargs)
 
     def _resize(self, byte_size, minimum, maximum, interactive):
         if maximum or minimum:
@@ -522,11 +617,13 @@ class BlockDeviceStack(Resizeable, Openable):
         self._sanity_check()
 
     def layer_and_data_sizes(self):
-        sizes = []
-        for layer in self.layers:
-            sizes.append(layer.size)
-            sizes.append(layer.data.size)
-        return sizes
+        result = []
+        with size_cache:
+            self._prefetch_sizes()
+            for layer in self.layers:
+                result.append(layer.size)
+                result.append(layer.data.size)
+        return result
 
 
     def __repr__(self):
@@ -539,14 +636,161 @@ class BlockDeviceStack(Resizeable, Openable):
             data_s = "{:<40} size={}".format(l.data, l.data.size if l.data!=None else "?")
             return LAYER_SEP.join((data_s, bd_s))
         try:
-            substrings = map(layer_to_str, reversed(self.layers))
+            with size_cache:
+                self._prefetch_sizes()
+                substrings = map(layer_to_str, reversed(self.layers))
             header = repr(self) + " with layers:"
             return LAYER_SEP.join([header] + substrings)
         except NotReady:
             return self.__repr__()
 
 
+class TopologyCache(object):
+    '''Caches the results of block device topology queries (lsblk, dmsetup info)
+    while an operation is running - that is, inside a "with size_cache:" block.
+    Cached results are discarded when the block ends, when the shell runs a
+    mutating command (see shell.Shell.generation), when device nodes are added
+    to or removed from /dev, or when invalidate() is called.
+    Other tools can resize, mount or unmount devices without any of those
+    changing, so nothing is cached outside of operations: results can only be
+    stale for changes made by other tools while an operation is running.'''
+    CHANGE_SIGNAL_PATHS = ('/dev', DM_DIR)
+
+    def __init__(self):
+        self._key = None
+        self._results = {}
+
+    def _change_signal(self):
+        '''Returns a cheap value that changes when device nodes are created or removed'''
+        signal = []
+        for path in self.CHANGE_SIGNAL_PATHS:
+            try:
+                signal.append(os.stat(path).st_mtime)
+            except OSError:
+                signal.append(None)
+        return tuple(signal)
+
+    def _current_key(self):
+        sh = shell.get()
+        return (sh, sh.generation, size_cache.epoch, self._change_signal())
+
+    @property
+    def active(self):
+        '''Whether results are being cached'''
+        return size_cache.active
+
+    def _refresh(self):
+        '''Discards all cached results if the topology changed'''
+        key = self._current_key()
+        if key != self._key:
+            self._results = {}
+            self._key = key
+
+    def get(self, f, *args):
+        '''Returns f(*args), reusing a previous result if the topology didn't change'''
+        if not self.active:
+            return f(*args)
+        self._refresh()
+        try:
+            return self._results[(f, args)]
+        except KeyError:
+            result = self._results[(f, args)] = f(*args)
+            return result
+
+    def get_many(self, f, keys):
+        '''Given f, a function that takes a list of keys and returns a dict
+        of key -> result, returns the results for keys, calling f (at most
+        once) only for the keys whose result isn't cached'''
+        if not self.active:
+            return f(keys)
+        self._refresh()
+        missing = [k for k in keys if (f, k) not in self._results]
+        if missing:
+            for k, result in f(missing).items():
+                self._results[(f, k)] = result
+        return {k: self._results[(f, k)] for k in keys}
+
+    def invalidate(self):
+        '''Discards all cached results'''
+        self._key = None
+        self._results = {}
+
+class SizeCache(TopologyCache):
+    '''Caches block device sizes while an operation is running - that is,
+    inside a "with size_cache:" block. Blocks can be nested.
+    Sizes can change without the topology changing, so they're not cached
+    outside of operations. Resizeable.resize() invalidates the cache.
+    epoch identifies the current (outermost) block.'''
+    def __init__(self):
+        TopologyCache.__init__(self)
+        self._depth = 0
+        self.epoch = 0
+
+    def __enter__(self):
+        if not self._depth:
+            self.epoch += 1
+        self._depth += 1
+        return self
+
+    def __exit__(self, e_type, e_value, e_trc):
+        self._depth -= 1
+        if not self._depth:
+            self.invalidate()
+
+    @property
+    def active(self):
+        return self._depth > 0
+
+class DataClassCache(object):
+    '''Caches the data class detected for each block device path.
+    A result is reused until the shell runs a mutating command (see
+    shell.Shell.generation - formatting, opening, closing and resizing
+    devices all do), the device node changes (mtime or device number),
+    or invalidate() is called. Paths that can't be stat'ed aren't cached.'''
+    def __init__(self):
+        self._results = {}
+
+    @staticmethod
+    def _device_signature(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_rdev, st.st_mtime)
+
+    def get(self, path, f):
+        '''Returns f(), the data class of the device at path, reusing a previous result if the device didn't change'''
+        signature = self._device_signature(path)
+        if signature is None:
+            return f()
+        sh = shell.get()
+        key = (sh, sh.generation, signature)
+        cached = self._results.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        result = f()
+        self._results[path] = (key, result)
+        return result
+
+    def invalidate(self, path=None):
+        '''Discards the cached result for path, or all cached results'''
+        if path is None:
+            self._results = {}
+        else:
+            self._results.pop(path, None)
+
+topology_cache = TopologyCache() # singleton
+size_cache = SizeCache() # singleton
+data_class_cache = DataClassCache() # singleton
+
 def devicemapper_info(device_or_path):
+    '''Returns a dict with the output of "dmsetup info" for a devicemapper device'''
+    path = get_device_path(device_or_path)
+    if _use_sysfs():
+        return dict(topology_cache.get(_sysfs_devicemapper_info, _sysfs_root(), path))
+    return dict(topology_cache.get(_devicemapper_info, path))
+
+def _devicemapper_info(path):
     REGEX = r'(.*): +(.*)\n'
     ALL_KEYS= ['Major, minor', 'Name', 'Tables present', 'UUID', 'Read Ahead', 'Number of targets', 'State', 'Open count', 'Event number']
     MIN_KEYS= ['Major, minor', 'Name', 'UUID', 'State', 'Open count']
@@ -555,7 +799,6 @@ def devicemapper_info(device_or_path):
             return int(x)
         except ValueError:
             return x
-    path = get_device_path(device_or_path)
     command = ['/sbin/dmsetup', 'info', path]
     output = shell.get().check_output(command)
     kv_pairs = re.findall(REGEX, output)
@@ -564,19 +807,30 @@ def devicemapper_info(device_or_path):
     return d
 
 class LsblkNode(object):
+    DM_TYPES = ('lvm', 'crypt', 'dm')
+
+    class NodeNotFound(Exception):
+        '''Raised when a lookup doesn't find exactly one node'''
+        pass
+
     def __init__(self, name, major, minor, size, ro, type, mountpoint, parent=None):
         assert mountpoint != '' # if it's not mounted, should be None
-        if not type in ('disk', 'part', 'lvm', 'crypt', 'loop', 'raid1', "md", None):
-            raise Exception("Unexpected lsblk node type: {}".format(type))
         self.children = []
         self.name = name
         self.major, self.minor = int(major), int(minor)
-        self.size = size #string. example: 43G
+        self.size = size #in bytes
         self.ro = bool(int(ro))
         self.type = type
         self.mountpoint = mountpoint
         self.parent = parent
 
+    @property
+    def path(self):
+        '''The (unresolved) path to the block device'''
+        if self.type in self.DM_TYPES:
+            return DM_DIR + self.name
+        return '/dev/' + self.name
+
     def add_child(self, node):
         self.children.append(node)
         node.parent = self
@@ -588,29 +842,130 @@ class LsblkNode(object):
             for sub in c.iterate():
                 yield sub
 
+    @staticmethod
+    def _one(nodes, key, return_one):
+        if return_one:
+            if len(nodes)!=1:
+                raise LsblkNode.NodeNotFound("node not found: {} (or multiple matches)".format(key))
+            return nodes[0]
+        return tuple(nodes)
+
     def find_node(self, node_name, return_one=True):
         '''finds nodes in the tree that mach the given name'''
-        l = (self,) if self.name==node_name else ()
-        for c in self.children:
-            l+= c.find_node(node_name, return_one=False)
-        if return_one:
-            if len(l)!=1:
-                raise Exception("node not found: {} (or multiple matches)".format(node_name))
-            return l[0]
-        return l
+        l = [node for node in self.iterate() if node.name==node_name]
+        return self._one(l, node_name, return_one)
 
     def __repr__(self):
         return "{}<{}, {}>".format(self.__class__.__name__, self.name, self.type)
 
     @staticmethod
     def create_root():
-        return LsblkNode("lsblk_root", -1, -1, None, 1, None, None)
+        return LsblkTree()
+
+class LsblkTree(LsblkNode):
+    '''The root node of a lsblk tree.
+    Keeps indexes of all the nodes in the tree, by name, by (major, minor) and
+    by resolved path, so that lookups don't need to walk the tree.
+    The indexes are built on the first lookup - the tree shouldn't be modified
+    after that.'''
+    def __init__(self):
+        LsblkNode.__init__(self, "lsblk_root", -1, -1, None, 1, None, None)
+        self._by_name = None
+        self._by_devno = None
+        self._by_path = None
+
+    def _build_indexes(self):
+        self._by_name, self._by_devno = {}, {}
+        nodes = self.iterate()
+        next(nodes) # skip the root itself
+        for node in nodes:
+            self._by_name.setdefault(node.name, []).append(node)
+            self._by_devno.setdefault((node.major, node.minor), []).append(node)
+
+    def _build_path_index(self):
+        # resolving paths touches the filesystem, so this index is built separately
+        self._by_path = {}
+        for nodes in self._by_name.values():
+            path = os.path.realpath(nodes[0].path)
+            self._by_path.setdefault(path, []).extend(nodes)
+
+    def find_node(self, node_name, return_one=True):
+        '''finds nodes in the tree that mach the given name'''
+        if self._by_name is None:
+            self._build_indexes()
+        return self._one(self._by_name.get(node_name, ()), node_name, return_one)
+
+    def find_devno(self, major, minor, return_one=True):
+        '''finds nodes in the tree with the given major and minor numbers'''
+        if self._by_devno is None:
+            self._build_indexes()
+        key = (int(major), int(minor))
+        return self._one(self._by_devno.get(key, ()), key, return_one)
+
+    def find_path(self, path, return_one=True):
+        '''finds nodes in the tree for the block device on the given path.
+        Symlinks (such as /dev/mapper/NAME -> /dev/dm-X) are resolved'''
+        if self._by_name is None:
+            self._build_indexes()
+        if self._by_path is None:
+            self._build_path_index()
+        path = os.path.realpath(path)
+        return self._one(self._by_path.get(path, ()), path, return_one)
 
 def lsblk():
-    '''Parses the lsblk command output to get block device dependencies/state
+    '''Returns (the root node of) a tree of block device dependencies/state.
+    During an operation, the tree is shared between calls while the topology
+    doesn't change (see TopologyCache), so it should not be modified.'''
+    if _use_sysfs():
+        return topology_cache.get(_sysfs_lsblk, _sysfs_root())
+    return topology_cache.get(_lsblk)
+
+#shells whose lsblk doesn't support --json (util-linux < 2.27)
+_lsblk_json_unsupported = weakref.WeakSet()
+
+def _lsblk():
+    '''Runs lsblk to get block device dependencies/state.
     Outputs (the root node of) a tree.'''
+    sh = shell.get()
+    fields = ",".join(LSBLK_FIELDS)
+    if sh not in _lsblk_json_unsupported:
+        try:
+            output = sh.check_output((LSBLK, '--json', '--bytes', '-o', fields))
+            return _parse_lsblk_json(output)
+        except subprocess.CalledProcessError:
+            if _lsblk_supports_json(sh):
+                raise # it failed for some other reason
+            log.info("lsblk doesn't support --json, parsing its text output instead")
+            _lsblk_json_unsupported.add(sh)
+    output = sh.check_output((LSBLK, '--bytes', '-o', fields))
+    return _parse_lsblk_text(output)
+
+def _lsblk_supports_json(sh):
+    '''Checks the lsblk help for the --json option. The exit status of a failed
+    lsblk --json doesn't tell a unknown option from other errors'''
+    try:
+        return '--json' in sh.check_output((LSBLK, '--help'))
+    except subprocess.CalledProcessError:
+        return False
+
+def _parse_lsblk_json(output):
+    '''Parses the output of lsblk --json --bytes into a tree'''
+    def add_nodes(parent, devices):
+        for d in devices:
+            major, minor = d['maj:min'].split(":")
+            size = d['size']
+            if size is not None:
+                size = int(size) # older versions output all values as strings
+            node = LsblkNode(d['name'], major, minor, size, d['ro'], d['type'], d['mountpoint'] or None)
+            parent.add_child(node)
+            add_nodes(node, d.get('children', ()))
+    root = LsblkNode.create_root()
+    add_nodes(root, json.loads(output)['blockdevices'])
+    return root
+
+def _parse_lsblk_text(output):
+    '''Parses the (tree formatted) output of lsblk --bytes into a tree'''
     TREE_SYMBOL= u'─'
-    FIELDS=['NAME', 'MAJ:MIN', 'RM', 'SIZE', 'RO', 'TYPE', 'MOUNTPOINT']
     def indent_level(line):
         try:
             i = line.index(TREE_SYMBOL)
@@ -631,13 +986,11 @@ def lsblk():
         assert ":" in data[1] #major:minor
         name, majmin, rm, size, ro, type, mountpoint = data
         maj, min = majmin.split(":")
-        return name, maj, min, size, ro, type, mountpoint
-    command = ['/bin/lsblk']
-    output = shell.get().check_output(command)
+        return name, maj, min, int(size), ro, type, mountpoint
     output = output.decode('utf-8') #TODO: get system encoding
     #split lines and verify format
     lines = output.splitlines()
-    assert lines[0].split()==FIELDS
+    assert lines[0].split()==LSBLK_FIELDS
     lines =lines[1:] #remove header
     #parse tree
     root = LsblkNode.create_root()
@@ -651,6 +1004,135 @@ def lsblk():
         current_dev_at_indent[indent]= node
     return root
 
+class SysfsTopology(object):
+    '''Reads block device topology, sizes and devicemapper info directly from
+    sysfs, producing the same results as lsblk(), devicemapper_info() and
+    size(), without running any commands.
+    sysfs_root and mountinfo can point to a fake tree, for testing.'''
+    def __init__(self, sysfs_root=SYSFS_ROOT, mountinfo=MOUNTINFO):
+        self.root = sysfs_root
+        self.mountinfo = mountinfo
+
+    @staticmethod
+    def _read(dev_dir, name):
+        return read_file(os.path.join(dev_dir, name)).strip()
+
+    def _mountpoints(self):
+        '''Returns a dict of (major, minor) -> mountpoint'''
+        def unescape(path):
+            return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), path)
+        mountpoints = {}
+        try:
+            lines = read_file(self.mountinfo).splitlines()
+        except IOError:
+            return mountpoints
+        for line in lines:
+            fields = line.split()
+            major, minor = fields[2].split(':')
+            mountpoints.setdefault((int(major), int(minor)), unescape(fields[4]))
+        return mountpoints
+
+    def _device_dir(self, path):
+        '''Returns the sysfs directory of the block device with the given path'''
+        name = os.path.basename(os.path.realpath(path))
+        dev_dir = os.path.join(self.root, 'class', 'block', name)
+        if os.path.isdir(dev_dir):
+            return dev_dir
+        # /dev/mapper entries may be device nodes instead of symlinks to /dev/dm-X
+        block_dir = os.path.join(self.root, 'block')
+        for kname in list_dir(block_dir):
+            dev_dir = os.path.join(block_dir, kname)
+            if os.path.isdir(os.path.join(dev_dir, 'dm')) and self._read(dev_dir, 'dm/name') == name:
+                return dev_dir
+        raise Exception("Block device not found in sysfs: {}".format(path))
+
+    def _device_type(self, dev_dir):
+        '''Returns the device type, as named by lsblk'''
+        kname = os.path.basename(dev_dir)
+        if os.path.isfile(os.path.join(dev_dir, 'partition')):
+            parent_kname = os.path.basename(os.path.dirname(dev_dir))
+            return 'md' if parent_kname.startswith('md') else 'part'
+        if os.path.isdir(os.path.join(dev_dir, 'dm')):
+            uuid = self._read(dev_dir, 'dm/uuid')
+            return {'LVM': 'lvm', 'CRYPT': 'crypt'}.get(uuid.split('-')[0], 'dm')
+        if os.path.isdir(os.path.join(dev_dir, 'md')):
+            return self._read(dev_dir, 'md/level')
+        if kname.startswith('loop'):
+            return 'loop'
+        if kname.startswith('sr'):
+            return 'rom'
+        return 'disk'
+
+    def _node(self, dev_dir, mountpoints):
+        kname = os.path.basename(dev_dir)
+        major, minor = self._read(dev_dir, 'dev').split(':')
+        is_dm = os.path.isdir(os.path.join(dev_dir, 'dm'))
+        name = self._read(dev_dir, 'dm/name') if is_dm else kname
+        size = int(self._read(dev_dir, 'size')) * SECTOR_SIZE
+        ro = self._read(dev_dir, 'ro')
+        type = self._device_type(dev_dir)
+        mountpoint = mountpoints.get((int(major), int(minor)))
+        return LsblkNode(name, major, minor, size, ro, type, mountpoint)
+
+    def _add_subtree(self, parent, dev_dir, mountpoints):
+        '''Adds the device on dev_dir to the parent node, and (recursively) its partitions and holders'''
+        node = self._node(dev_dir, mountpoints)
+        parent.add_child(node)
+        entries = sorted(list_dir(dev_dir))
+        children = [os.path.join(dev_dir, e) for e in entries if os.path.isfile(os.path.join(dev_dir, e, 'partition'))]
+        holders = sorted(list_dir(os.path.join(dev_dir, 'holders')))
+        children += [os.path.join(self.root, 'class', 'block', h) for h in holders]
+        for child_dir in children:
+            self._add_subtree(node, child_dir, mountpoints)
+
+    def lsblk(self):
+        '''Returns (the root node of) a tree, like lsblk().
+        Like lsblk, devices with several slaves appear under each of them.'''
+        root = LsblkNode.create_root()
+        mountpoints = self._mountpoints()
+        block_dir = os.path.join(self.root, 'block')
+        for kname in sorted(list_dir(block_dir)):
+            dev_dir = os.path.join(block_dir, kname)
+            if list_dir(os.path.join(dev_dir, 'slaves')):
+                continue # added as a holder of its slaves
+            self._add_subtree(root, dev_dir, mountpoints)
+        return root
+
+    def devicemapper_info(self, path):
+        '''Returns a dict like devicemapper_info().
+        sysfs doesn't provide all of the dmsetup info keys (such as "Open count")'''
+        dev_dir = self._device_dir(path)
+        if not os.path.isdir(os.path.join(dev_dir, 'dm')):
+            raise Exception("Not a devicemapper device: {}".format(path))
+        major, minor = self._read(dev_dir, 'dev').split(':')
+        suspended = self._read(dev_dir, 'dm/suspended') == '1'
+        return {
+            'Major, minor': '{}, {}'.format(major, minor),
+            'Name': self._read(dev_dir, 'dm/name'),
+            'UUID': self._read(dev_dir, 'dm/uuid'),
+            'State': 'SUSPENDED' if suspended else 'ACTIVE',
+            }
+
+    def size(self, path):
+        '''Returns the size of the block device in bytes'''
+        return int(self._read(self._device_dir(path), 'size')) * SECTOR_SIZE
+
+def _use_sysfs():
+    '''Whether topology queries should use SysfsTopology instead of running commands'''
+    provider = settings.get("topology_provider", "commands")
+    if provider not in TOPOLOGY_PROVIDERS:
+        raise ValueError("Unknown topology provider: {}".format(provider))
+    return provider == 'sysfs'
+
+def _sysfs_root():
+    return settings.get("sysfs_root", SYSFS_ROOT)
+
+def _sysfs_lsblk(sysfs_root):
+    return SysfsTopology(sysfs_root).lsblk()
+
+def _sysfs_devicemapper_info(sysfs_root, path):
+    return SysfsTopology(sysfs_root).devicemapper_info(path)
+
 def dm_get_child(blockdevice_path):
     '''Given a devicemapper block device, returns its child, if any (according to lsblk)'''
     root = lsblk()
@@ -669,17 +1151,40 @@ def dm_get_child(blockdevice_path):
 
 def size(blockdevice_path):
     '''return the of the block device in bytes'''
-    return int(shell.get().check_output(('/sbin/blockdev', '--getsize64', blockdevice_path)))
+    return sizes([blockdevice_path])[blockdevice_path]
+
+def sizes(blockdevice_paths):
+    '''Returns a dict of path -> size of the block device in bytes.
+    The sizes of all the block devices are queried with a single command (or
+    read from sysfs, see SysfsTopology). Inside a size_cache block, sizes
+    queried before are reused.'''
+    paths = []
+    for path in blockdevice_paths:
+        if path not in paths:
+            paths.append(path)
+    return size_cache.get_many(_sizes, paths)
+
+def _sizes(paths):
+    if _use_sysfs():
+        topology = SysfsTopology(_sysfs_root())
+        return {path: topology.size(path) for path in paths}
+    output = shell.get().check_output(('/sbin/blockdev', '--getsize64') + tuple(paths))
+    values = output.split()
+    assert len(values) == len(paths)
+    return dict(zip(paths, map(int, values)))
 
 def get_blockdevice_child(path):
         root = lsblk()
-        path = os.path.realpath(path)
         try:
-            dm_name = devicemapper_info(path)['Name']
-        except Exception as e:
-            #might not be a devicemapper device
-            dm_name = path.split("/")[-1]
-        outer_node = root.find_node(dm_name)
+            outer_node = root.find_path(path)
+        except LsblkNode.NodeNotFound:
+            path = os.path.realpath(path)
+            try:
+                dm_name = devicemapper_info(path)['Name']
+            except Exception as e:
+                #might not be a devicemapper device
+                dm_name = path.split("/")[-1]
+            outer_node = root.find_node(dm_name)
         if not len(outer_node.children):
             return None
         c1= outer_node.children[0]
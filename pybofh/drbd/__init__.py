@@ -1,5 +1,10 @@
-import drbdadm
-from classes import Resource
-from misc import devices_list, resources_list
+from pybofh.lazy import lazy_package
 
-__all__=[drbdadm, Resource, devices_list, resources_list]
+__all__=['drbdadm', 'Resource', 'get_resources', 'devices_list', 'resources_list']
+
+lazy_package(__name__, ('classes', 'drbdadm', 'misc', 'proc_parser'), {
+    'Resource': 'classes',
+    'get_resources': 'classes',
+    'devices_list': 'misc',
+    'resources_list': 'misc',
+    })
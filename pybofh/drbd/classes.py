@@ -31,3 +31,15 @@ class Resource(object):
 
     def __repr__(self):
         return """drbd.Resource("{}")""".format(self._name)
+
+def get_resources(resource_names):
+    '''Returns a Resource for each of the given names.
+    Their existence is checked concurrently, if the shell supports it (see shell.AsyncShell)'''
+    resources= [Resource(name, check_existence=False) for name in resource_names]
+    roles= [r.role_async() for r in resources]
+    for resource, role in zip(resources, roles):
+        try:
+            role.result()
+        except Exception as e:
+            raise Exception("Failed to create resource {}: {}".format(resource.name, e))
+    return resources
@@ -39,17 +39,32 @@ def adjust(resource, options=()):
     shell.get().check_call((DRBDADM, "adjust") + options + (resource,))
 
 def role(resource, options=()):
-    out= shell.get().check_output((DRBDADM, "role") + options + (resource,))
+    return role_async(resource, options).result()
+
+def role_async(resource, options=()):
+    out= shell.get().check_output_async((DRBDADM, "role") + options + (resource,))
+    return out.then(_parse_role)
+
+def _parse_role(out):
     roles = out.strip().split("/")
     assert len(roles)==2
     return roles
 
 def cstate(resource, options=()):
-    out= shell.get().check_output((DRBDADM, "cstate") + options + (resource,))
-    return out.strip()
+    return cstate_async(resource, options).result()
+
+def cstate_async(resource, options=()):
+    out= shell.get().check_output_async((DRBDADM, "cstate") + options + (resource,))
+    return out.then(lambda s: s.strip())
 
 def dstate(resource, options=()):
-    out= shell.get().check_output((DRBDADM, "dstate") + options + (resource,))
+    return dstate_async(resource, options).result()
+
+def dstate_async(resource, options=()):
+    out= shell.get().check_output_async((DRBDADM, "dstate") + options + (resource,))
+    return out.then(_parse_dstate)
+
+def _parse_dstate(out):
     states= out.strip().split("/")
     assert len(states)==2
     return states
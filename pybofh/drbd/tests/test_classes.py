@@ -4,6 +4,7 @@ import unittest
 import mock
 
 from pybofh.drbd import classes
+from pybofh.shell import FakeShell
 from pybofh.tests import common
 
 class FakeEnvironment(common.FakeEnvironment):
@@ -113,6 +114,11 @@ class Resource(unittest.TestCase):
         self.assertEqual(self.env.shell.run_commands[-1], ('/sbin/drbdadm', 'role', 'some_name'))
         self.assertEqual(role, ["Primary", "Secondary"])
 
+    def test_role_async(self):
+        r = classes.Resource("some_name", check_existence=False)
+        role = r.role_async()
+        self.assertEqual(role.result(), ["Primary", "Secondary"])
+
     def test_cstate(self):
         r = classes.Resource("some_name", check_existence=False)
         cstate = r.cstate()
@@ -143,3 +149,18 @@ class Resource(unittest.TestCase):
     def test_repr(self):
         r = classes.Resource("some_name", check_existence=False)
         self.assertEqual(repr(r), """drbd.Resource("some_name")""")
+
+class ModuleTest(unittest.TestCase):
+    def setUp(self):
+        generic_setup(self)
+
+    def tearDown(self):
+        mock.patch.stopall()
+
+    def test_get_resources(self):
+        resources = classes.get_resources(["r1", "r2"])
+        self.assertEqual([r.name for r in resources], ["r1", "r2"])
+        self.assertItemsEqual(self.env.shell.run_commands, [('/sbin/drbdadm', 'role', 'r1'), ('/sbin/drbdadm', 'role', 'r2')])
+        with mock.patch('pybofh.shell.get', new=FakeShell): # no drbdadm
+            with self.assertRaises(Exception):
+                classes.get_resources(["r1"])
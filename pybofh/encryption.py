@@ -9,6 +9,7 @@ from pybofh import misc
 
 LUKS_SECTOR_SIZE = 512 #this seems hardcoded into luks, so hopefully it's safe to keep it there
 CRYPTSETUP = '/sbin/cryptsetup'
+LUKS_MAGIC = blockdevice.Magic(0, 'LUKS\xba\xbe')
 
 log = logging.getLogger(__name__)
 
@@ -134,7 +135,7 @@ def luks_data_offset(bd_path):
     encrypted data (in bytes) - that is, where the LUKS header "ends".
     Info extracted from the LUKS On-Disk Format Specification Version 1.2.2'''
     data = misc.read_file(bd_path, 108)
-    if data[0:6] != 'LUKS\xba\xbe':
+    if not LUKS_MAGIC.matches(data):
         raise Exception("Not a LUKS device (no LUKS magic detected)")
     luks_version = struct.unpack('>H', data[6:8])[0]
     assert luks_version == 1
@@ -143,4 +144,4 @@ def luks_data_offset(bd_path):
     assert 592 <= offset <= 4*2**20
     return offset
 
-blockdevice.register_data_class("LUKS", Encrypted)
+blockdevice.register_data_class(LUKS_MAGIC, Encrypted)
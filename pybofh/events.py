@@ -0,0 +1,124 @@
+"""Structured events for the operations pybofh runs (creating a LV, mounting a filesystem...).
+
+Each operation emits an Event (operation, target, duration, result) through
+logging - the Event is available to handlers as record.event - and to the
+active EventSinks (see sink()).
+Inside a batch (see batch()), each operation is only logged at DEBUG level,
+and a single summary Event is logged when the batch ends."""
+from collections import namedtuple
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+OK = "ok"
+
+class Event(namedtuple('Event', ['operation', 'target', 'duration', 'result', 'details'])):
+    """A finished operation. duration is in seconds, result is OK or the name
+    of the exception the operation raised, and details is a dict"""
+    __slots__ = ()
+
+    def __str__(self):
+        details = "".join(" {}={}".format(k, v) for k, v in sorted(self.details.items()))
+        return "{} {}: {} in {:.3f}s{}".format(self.operation, self.target, self.result, self.duration, details)
+
+class EventSink(object):
+    """Collects the Events emitted while it's active"""
+    def __init__(self):
+        self.events = []
+
+    def add(self, event):
+        self.events.append(event)
+
+    def failures(self):
+        return [e for e in self.events if e.result != OK]
+
+    def counts(self):
+        """Returns a dict of operation -> number of events"""
+        counts = {}
+        for event in self.events:
+            counts[event.operation] = counts.get(event.operation, 0) + 1
+        return counts
+
+class Batch(EventSink):
+    """The operations run inside a batch() block"""
+    def __init__(self, name):
+        EventSink.__init__(self)
+        self.name = name
+        self.start = time.time()
+
+    def summary(self, result=None):
+        """Returns the Event that summarizes the batch"""
+        failures = len(self.failures())
+        if result is None:
+            result = OK if not failures else "{} failed".format(failures)
+        details = dict(self.counts(), failed=failures)
+        return Event("batch", self.name, time.time() - self.start, result, details)
+
+_sinks = () # active EventSinks
+_local = threading.local()
+
+def _batches():
+    """The stack of batches active on the current thread"""
+    if not hasattr(_local, "batches"):
+        _local.batches = []
+    return _local.batches
+
+def emit(event):
+    """Sends a Event to the active sinks, and logs it (or adds it to the current batch)"""
+    for s in _sinks:
+        s.add(event)
+    batches = _batches()
+    if batches:
+        batches[-1].add(event)
+        log.debug("%s", event, extra={"event": event})
+    else:
+        log.info("%s", event, extra={"event": event})
+
+@contextmanager
+def operation(name, target, **details):
+    """Context manager that emits a Event for the operation run inside it.
+    Example:
+        with events.operation("remove_lv", "vg/lv"):
+            shell.get().check_call(("/sbin/lvremove", "vg/lv"))"""
+    start = time.time()
+    try:
+        yield
+    except Exception as e:
+        emit(Event(name, target, time.time() - start, type(e).__name__, details))
+        raise
+    emit(Event(name, target, time.time() - start, OK, details))
+
+@contextmanager
+def sink():
+    """Context manager that collects all the Events emitted inside it, on any thread.
+    Example:
+        with events.sink() as s:
+            lvm.create_lvs(...)
+        print s.events"""
+    global _sinks
+    s = EventSink()
+    _sinks += (s,)
+    try:
+        yield s
+    finally:
+        _sinks = tuple(x for x in _sinks if x is not s)
+
+@contextmanager
+def batch(name):
+    """Context manager that groups the operations run inside it (on the current thread).
+    They're logged at DEBUG level, and a single summary Event is emitted when the batch ends"""
+    b = Batch(name)
+    batches = _batches()
+    batches.append(b)
+    result = None
+    try:
+        yield b
+    except Exception as e:
+        result = type(e).__name__
+        raise
+    finally:
+        batches.pop()
+        emit(b.summary(result))
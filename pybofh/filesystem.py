@@ -1,7 +1,11 @@
 from abc import ABCMeta, abstractmethod
+import struct
 from pybofh import shell
 from pybofh import blockdevice
 
+EXT_SUPERBLOCK = 1024 # offset of the ext superblock
+EXT_COMPAT_HAS_JOURNAL = 0x4
+
 
 class BaseFilesystem(blockdevice.Data):
     __metaclass__= ABCMeta
@@ -87,7 +91,34 @@ class Ext3(ExtX):
 class Ext4(ExtX):
     NAME="ext4"
 
-blockdevice.register_data_class("ext2", Ext2)
-blockdevice.register_data_class("ext3", Ext3)
-blockdevice.register_data_class("ext4", Ext4)
+def ext_version(header):
+    '''Given the start of a block device with a ext superblock, returns the
+    ext version (2, 3 or 4), following the same rules as "file": without a
+    journal it's ext2 (even with ext4 features), and ext4 features tell ext3
+    from ext4'''
+    compat, incompat, ro_compat = struct.unpack_from('<III', header, EXT_SUPERBLOCK + 92)
+    if not compat & EXT_COMPAT_HAS_JOURNAL:
+        return 2
+    if incompat >= 0x40 or ro_compat >= 0x8:
+        return 4
+    return 3
+
+class ExtMagic(blockdevice.Magic):
+    '''The signature of a ext filesystem of a given version'''
+    def __init__(self, version):
+        blockdevice.Magic.__init__(self, EXT_SUPERBLOCK + 56, '\x53\xef')
+        self.version = version
+
+    @property
+    def size(self):
+        return EXT_SUPERBLOCK + 104 # up to the feature flags
+
+    def matches(self, header):
+        if len(header) < self.size or not blockdevice.Magic.matches(self, header):
+            return False
+        return ext_version(header) == self.version
+
+blockdevice.register_data_class(ExtMagic(2), Ext2)
+blockdevice.register_data_class(ExtMagic(3), Ext3)
+blockdevice.register_data_class(ExtMagic(4), Ext4)
 
@@ -0,0 +1,36 @@
+'''Lazy loading of package submodules.
+A package's __init__ calls lazy_package() instead of importing its submodules,
+and they're imported the first time they're accessed as attributes of the package.
+This must stay cheap to import - it's imported by every pybofh import'''
+import importlib
+import sys
+import types
+
+class LazyPackage(types.ModuleType):
+    '''A package whose submodules (and some of their attributes) are imported on first access'''
+    def __getattr__(self, name):
+        lazy= self.__dict__.get('_lazy_submodules', ())
+        attributes= self.__dict__.get('_lazy_attributes', {})
+        if name in lazy:
+            return importlib.import_module('.' + name, self.__name__) # the import sets the package attribute
+        if name in attributes:
+            value= getattr(importlib.import_module('.' + attributes[name], self.__name__), name)
+            setattr(self, name, value)
+            return value
+        raise AttributeError("'module' object has no attribute '{}'".format(name))
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(self._lazy_submodules) | set(self._lazy_attributes))
+
+def lazy_package(name, submodules, attributes=None):
+    '''Replaces package name (on sys.modules) with a LazyPackage.
+    submodules is a list of submodule names. attributes is a dict of attribute name -> name of the submodule that defines it.
+    Call it from the package __init__, as lazy_package(__name__, ...)'''
+    original= sys.modules[name]
+    package= LazyPackage(name, original.__doc__)
+    package.__dict__.update(original.__dict__)
+    package._lazy_submodules= tuple(submodules)
+    package._lazy_attributes= dict(attributes or {})
+    package._original_module= original # on python 2, the globals of a module are cleared when it's garbage collected
+    sys.modules[name]= package
+    return package
@@ -1,10 +1,46 @@
+import json
 import os
+import subprocess
+import threading
+from collections import namedtuple
 from pybofh import shell
-from misc import sfilter, rsplit
 from pybofh import blockdevice
+from pybofh import events
+from pybofh import settingsmodule
+from pybofh.atomic_operations import AtomicContext, has_reverse
 
 
 REMOVED= '[REMOVED]'
+LVM2_LABEL= blockdevice.Magic(512+24, 'LVM2 001') # label type, on the label in sector 1
+
+LVM= '/sbin/lvm'
+LVM_SUCCESS= 1 # ECMD_PROCESSED, the return code of successful LVM commands
+LVS= '/sbin/lvs'
+VGS= '/sbin/vgs'
+PVS= '/sbin/pvs'
+LV_FIELDS= ['lv_name', 'vg_name', 'lv_path', 'lv_uuid', 'lv_size', 'lv_attr', 'seg_count', 'segtype', 'pool_lv', 'origin', 'data_percent', 'metadata_percent']
+VG_FIELDS= ['vg_name', 'vg_uuid', 'vg_size', 'vg_free', 'vg_extent_size', 'vg_extent_count', 'vg_free_count', 'lv_count', 'pv_count', 'vg_seqno']
+PV_FIELDS= ['pv_name', 'vg_name', 'pv_uuid', 'dev_size', 'pv_size', 'pv_free', 'pe_start', 'pv_pe_count', 'pv_pe_alloc_count', 'vg_extent_size']
+PVSEG_FIELDS= ['pv_name', 'vg_name', 'vg_extent_size', 'pvseg_start', 'pvseg_size', 'lv_name'] # pvseg_* are in extents
+INT_FIELDS= set(['lv_size', 'seg_count', 'vg_size', 'vg_free', 'vg_extent_size', 'vg_extent_count', 'vg_free_count', 'lv_count', 'pv_count', 'vg_seqno',
+    'dev_size', 'pv_size', 'pv_free', 'pe_start', 'pv_pe_count', 'pv_pe_alloc_count', 'pvseg_start', 'pvseg_size']) # sizes are in bytes
+SECTOR_SIZE= 512
+SIZE_UNITS= {'b': 1, 's': SECTOR_SIZE, 'k': 2**10, 'm': 2**20, 'g': 2**30, 't': 2**40, 'p': 2**50, 'e': 2**60} # LVM size arguments are binary, on either case
+ALLOCATION_POLICIES= ('contiguous', 'cling', 'normal', 'anywhere', 'inherit')
+FLOAT_FIELDS= set(['data_percent', 'metadata_percent'])
+THIN_POOL_SEGTYPE= 'thin-pool'
+THIN_SEGTYPE= 'thin'
+SNAPSHOT_VOLUME_TYPES= ('s', 'S') # first lv_attr character of (valid, invalid) snapshots
+
+# records of the LVM inventory. Fields have the names of the LVM report fields
+LVRecord= namedtuple('LVRecord', LV_FIELDS)
+VGRecord= namedtuple('VGRecord', VG_FIELDS)
+PVRecord= namedtuple('PVRecord', PV_FIELDS)
+PVSegmentRecord= namedtuple('PVSegmentRecord', PVSEG_FIELDS) # lv_name is empty on free segments
+VGSeqnoRecord= namedtuple('VGSeqnoRecord', ['vg_name', 'vg_seqno'])
+
+settings= settingsmodule.get_settings(__name__)
+settings.define("backend", "How to run LVM commands: 'commands' (a process per command) or 'session' (a single long-lived 'lvm shell', see LvmShell)")
 
 class PV(blockdevice.Data):
     def create(self, **kwargs):
@@ -17,21 +53,49 @@ class PV(blockdevice.Data):
     def remove(self):
         remove_pv(self.device.path)
         self.device= REMOVED
-    
+
+    @property
+    def record(self):
+        '''The PVRecord of this PV. Always queries LVM'''
+        return pv_record(self.device.path)
+
     def _size(self):
-        raise NotImplementedError
+        '''The space of the device used by the PV: the metadata area (up to pe_start) and the extents'''
+        return pv_used_size(self.record)
 
     @property
     def resize_granularity(self):
-        raise NotImplementedError
+        return SECTOR_SIZE
 
-    def _resize(self, byte_size, minimum, maximum, interactive):   
-        raise NotImplementedError
+    @property
+    def max_unused_size(self):
+        '''A PV only uses whole extents, so the end of the device (less than a extent) may be unused'''
+        return self.record.vg_extent_size
+
+    def _process_resize_size(self, byte_size=None, relative=False, approximate=True, round_up=True):
+        '''A PV only uses whole extents, after pe_start. Sizes are rounded to that'''
+        byte_size= blockdevice.Resizeable._process_resize_size(self, byte_size, relative, approximate, round_up)
+        record= self.record
+        if not byte_size or not record.vg_extent_size:
+            return byte_size
+        extents, remainder= divmod(byte_size - record.pe_start, record.vg_extent_size)
+        if remainder and not approximate:
+            raise self.WrongSize("Can't resize to {}, as it's not pe_start plus a whole number of extents ({})".format(byte_size, record.vg_extent_size))
+        if remainder and round_up:
+            extents+= 1
+        return record.pe_start + extents * record.vg_extent_size
+
+    def _resize(self, byte_size, minimum, maximum, interactive):
+        record= self.record
+        if minimum:
+            # pvresize refuses this if there are allocated extents after the first pv_pe_alloc_count ones
+            byte_size= pv_used_size(record._replace(pv_pe_count=record.pv_pe_alloc_count))
+        resize_pv(self.device.path, None if maximum else byte_size, vg=record.vg_name)
 
 class VG(object):
-    def __init__(self, vg_name):
+    def __init__(self, vg_name, skip_validation=False):
         self.name= vg_name
-        if not self.name in get_vgs():
+        if not skip_validation and not self.name in get_vgs():
             raise Exception("VG {} does not exist".format(vg_name))
 
     @property
@@ -39,15 +103,42 @@ class VG(object):
         return "/dev/{}/".format(self.name)
 
     def get_lvs(self):
-        names= get_lvs(self.name)
-        lvs= [ LV(self, name) for name in names ]
+        records= lv_inventory(self.name)
+        lvs= [ LV.from_inventory(record, self) for record in records if record.segtype != THIN_POOL_SEGTYPE ]
         return lvs
 
+    def get_thin_pools(self):
+        records= lv_inventory(self.name)
+        return [ ThinPool(self, r.lv_name, skip_validation=True) for r in records if r.segtype == THIN_POOL_SEGTYPE ]
+
+    def create_thin_pool(self, name, size, **kwargs):
+        create_thin_pool(self.name, name, size, **kwargs)
+        return ThinPool(self, name)
+
+    def thin_pool(self, name):
+        return ThinPool(self, name)
+
 
     def create_lv( self, name, *args, **kwargs ):
         create_lv( self.name, name, *args, **kwargs)
         return LV( self, name )
 
+    def create_lvs(self, lvs, **kwargs):
+        '''Creates several LVs atomically. lvs is a list of (name, size) tuples. See create_lvs()'''
+        create_lvs(self.name, lvs, **kwargs)
+        return [LV(self, name, skip_validation=True) for name, _ in lvs]
+
+    def planner(self):
+        '''Returns a ExtentPlanner with the current free extents of this VG'''
+        return ExtentPlanner(self.name)
+
+    def plan_lvs(self, lvs, **kwargs):
+        '''Plans the placement of new LVs, without creating them. See ExtentPlanner.plan'''
+        return self.planner().plan(lvs, **kwargs)
+
+    def remove_lvs(self, names, **kwargs):
+        remove_lvs(self.name, names, **kwargs)
+
     def lv(self, lv_name):
         return LV(self, lv_name)
 
@@ -59,14 +150,27 @@ class VG(object):
         self.name= REMOVED
 
 class LV(blockdevice.BaseBlockDevice):
-    def __init__( self, vg, lv_name ):
+    def __init__( self, vg, lv_name, skip_validation=False ):
         if not isinstance(vg, VG):
-            vg= VG(vg)
-        if not lv_name in get_lvs(vg.name):
+            vg= VG(vg, skip_validation=skip_validation)
+        if not skip_validation and not lv_name in get_lvs(vg.name):
             raise Exception("LV {} does not exist on VG {}".format(lv_name, vg.name))
         self.vg= vg
         self.name= lv_name
-        super(LV, self).__init__(self.path)
+        super(LV, self).__init__(self.path, skip_validation=skip_validation)
+
+    @classmethod
+    def from_inventory(cls, record, vg=None):
+        '''Creates a LV from a LVRecord (see lv_inventory), trusting it instead of
+        checking that the LV exists. vg is the VG instance the LV belongs to, if available'''
+        if vg is None:
+            vg= VG(record.vg_name, skip_validation=True)
+        assert vg.name == record.vg_name
+        if cls is LV and record.segtype == THIN_SEGTYPE:
+            cls= ThinLV
+        elif cls is LV and record.lv_attr[0] in SNAPSHOT_VOLUME_TYPES:
+            cls= Snapshot
+        return cls(vg, record.lv_name, skip_validation=True)
 
     @property
     def path(self):
@@ -80,12 +184,17 @@ class LV(blockdevice.BaseBlockDevice):
         self.vg= REMOVED
         self.name= REMOVED
 
+    @property
+    def metadata(self):
+        '''The LVRecord of this LV, from the VG metadata cache'''
+        return vg_metadata_cache.get(self.vg.name).lvs[self.name]
+
+    def _size(self):
+        return self.metadata.lv_size
+
     @property
     def resize_granularity(self):
-        vg_name= self.vg.name
-        all_vg_info= _parse_vgdisplay()
-        vg_info= all_vg_info[vg_name]
-        pe_size= vg_info['PE Size'] #physical extent size
+        pe_size= vg_metadata_cache.get(self.vg.name).extent_size #physical extent size
         assert 1 * 2**20 <= pe_size <= 32 * 2**20 #sanity check
         return pe_size
 
@@ -96,135 +205,626 @@ class LV(blockdevice.BaseBlockDevice):
         options=[]
         if not interactive:
             options.append("-f")
-        shell.get().check_call( ["lvresize"] + options + ["--size", ssize, self.path])
+        try:
+            _shell().check_call( ["lvresize"] + options + ["--size", ssize, self.path])
+        finally:
+            vg_metadata_cache.invalidate(self.vg.name)
 
     def rename(self, new_name):
         rename_lv(self.vg.name, self.name, new_name)
         self.name = new_name
 
+    def snapshot(self, name, size):
+        '''Creates a (copy-on-write) snapshot of this LV, with size bytes for changes. Returns the Snapshot'''
+        create_snapshot(self.vg.name, self.name, name, size)
+        return Snapshot(self.vg, name)
+
+class Snapshot(LV):
+    '''A copy-on-write snapshot of a LV'''
+    @property
+    def origin(self):
+        return LV(self.vg, self.metadata.origin, skip_validation=True)
+
+    @property
+    def cow_usage(self):
+        '''The percentage of the snapshot space used by changes. When it reaches 100 the snapshot is invalidated.
+        It changes without the VG metadata changing, so this always queries LVM'''
+        return lv_record(self.vg.name, self.name).data_percent
+
+    @property
+    def is_invalid(self):
+        '''True if the snapshot overflowed and was invalidated'''
+        return lv_record(self.vg.name, self.name).lv_attr[4] == 'I'
+
+    def merge(self):
+        '''Merges the snapshot into its origin, reverting the origin to the snapshot contents.
+        If the origin is open, the merge happens on its next activation. The snapshot is removed after merging'''
+        merge_snapshot(self.vg.name, self.name)
+        self.vg= REMOVED
+        self.name= REMOVED
+
+
+class ThinPool(object):
+    '''A thin pool: a LV that provides space to thin LVs'''
+    def __init__(self, vg, name, skip_validation=False):
+        if not isinstance(vg, VG):
+            vg= VG(vg, skip_validation=skip_validation)
+        self.vg= vg
+        self.name= name
+        if not skip_validation and self.metadata.segtype != THIN_POOL_SEGTYPE:
+            raise Exception("LV {} is not a thin pool".format(name))
+
+    @property
+    def metadata(self):
+        '''The LVRecord of this pool, from the VG metadata cache'''
+        try:
+            return vg_metadata_cache.get(self.vg.name).lvs[self.name]
+        except KeyError:
+            raise Exception("LV {} does not exist on VG {}".format(self.name, self.vg.name))
+
+    @property
+    def size(self):
+        return self.metadata.lv_size
+
+    def usage(self):
+        '''Returns (data_percent, metadata_percent): how much of the pool data and metadata space is used.
+        Usage changes without the VG metadata changing, so this always queries LVM'''
+        record= lv_record(self.vg.name, self.name)
+        return record.data_percent, record.metadata_percent
+
+    @property
+    def data_percent(self):
+        return self.usage()[0]
+
+    @property
+    def metadata_percent(self):
+        return self.usage()[1]
+
+    def create_thin_lv(self, name, virtual_size):
+        create_thin_lv(self.vg.name, self.name, name, virtual_size)
+        return ThinLV(self.vg, name)
+
+    def remove(self, *args, **kwargs):
+        remove_lv(self.vg.name, self.name, *args, **kwargs)
+        self.vg= REMOVED
+        self.name= REMOVED
+
+    def __repr__(self):
+        return "{}<{}>".format(self.__class__.__name__, self.name)
+
+class ThinLV(LV):
+    '''A thin provisioned LV, which allocates space from a ThinPool as it's written'''
+    @property
+    def pool(self):
+        return ThinPool(self.vg, self.metadata.pool_lv, skip_validation=True)
+
+    def snapshot(self, name, size=None, activate=True):
+        '''Creates a thin snapshot of this LV, and returns it as a ThinLV.
+        If size is given, creates a copy-on-write Snapshot instead (see LV.snapshot)'''
+        if size is not None:
+            return LV.snapshot(self, name, size)
+        create_thin_snapshot(self.vg.name, self.name, name, activate=activate)
+        return ThinLV(self.vg, name, skip_validation=not activate)
+
+class Placement(namedtuple('Placement', ['lv_name', 'extents', 'areas'])):
+    '''Where a ExtentPlanner places a LV. areas is a list of (pv_name, start_extent, extent_count)'''
+    __slots__= ()
+
+    @property
+    def pvs(self):
+        '''The PVs the LV is placed on, in allocation order'''
+        pvs= []
+        for pv, _, _ in self.areas:
+            if pv not in pvs:
+                pvs.append(pv)
+        return pvs
+
+class ExtentPlanner(object):
+    '''Plans where new LVs would go on the free extents of a VG, without running any LVM command.
+    The PV segment map is read once, when the planner is created'''
+    class NoSpace(Exception):
+        pass
+
+    def __init__(self, vg_name, segments=None):
+        if segments is None:
+            segments= pv_segments(vg_name)
+        segments= [s for s in segments if s.vg_name == vg_name]
+        if not segments:
+            raise Exception("VG {} does not exist or has no PVs".format(vg_name))
+        self.vg= vg_name
+        self.extent_size= segments[0].vg_extent_size
+        self.pvs= [] # in VG order
+        self.free_areas= {} # pv_name: sorted list of (start_extent, extent_count)
+        for s in segments:
+            if s.pv_name not in self.free_areas:
+                self.pvs.append(s.pv_name)
+                self.free_areas[s.pv_name]= []
+            if not s.lv_name:
+                self.free_areas[s.pv_name].append((s.pvseg_start, s.pvseg_size))
+        for areas in self.free_areas.values():
+            areas.sort()
+
+    def extents(self, size):
+        '''The number of extents LVM allocates for a LV of the given size (bytes, or a LVM size string)'''
+        return -(-_size_bytes(size) // self.extent_size)
+
+    def free_extents(self, pv=None):
+        '''The free extents of a PV, or of the whole VG'''
+        pvs= [pv] if pv else self.pvs
+        return sum(count for p in pvs for _, count in self.free_areas[p])
+
+    def fits(self, lvs, **kwargs):
+        '''True if all the lvs, a list of (name, size) tuples, fit on the free extents'''
+        try:
+            self.plan(lvs, **kwargs)
+            return True
+        except ExtentPlanner.NoSpace:
+            return False
+
+    def plan(self, lvs, alloc='normal', pvs=None, spread=False):
+        '''Returns a list of Placement for lvs, a list of (name, size) tuples, or raises NoSpace.
+        alloc is the LVM allocation policy: with 'contiguous', each LV must fit on a single free area.
+        Otherwise, a LV is kept on a single PV when possible, and spans PVs (in VG order) when not.
+        pvs restricts the allocation to some PVs. If spread, each LV goes to the PV with the most
+        free extents at that point, so that LVs are spread across PVs.
+        The planner itself is not changed - plans can be tried repeatedly'''
+        if alloc not in ALLOCATION_POLICIES:
+            raise ValueError("Unknown allocation policy: {}".format(alloc))
+        candidates= list(pvs) if pvs else list(self.pvs)
+        unknown= [pv for pv in candidates if pv not in self.free_areas]
+        if unknown:
+            raise Exception("PVs {} are not on VG {}".format(", ".join(unknown), self.vg))
+        free= {pv: list(self.free_areas[pv]) for pv in candidates}
+        placements= []
+        for name, size in lvs:
+            extents= self.extents(size)
+            order= candidates
+            if spread:
+                order= sorted(candidates, key=lambda pv: -sum(count for _, count in free[pv]))
+            if alloc == 'contiguous':
+                areas= self._contiguous(free, order, extents)
+            else:
+                areas= self._on_one_pv(free, order, extents) or self._spanning(free, order, extents)
+            if areas is None:
+                raise ExtentPlanner.NoSpace("LV {} needs {} extents, which don't fit on the free extents of VG {}".format(name, extents, self.vg))
+            placements.append(Placement(name, extents, areas))
+        return placements
+
+    @staticmethod
+    def _take(free, pv, extents):
+        '''Takes extents from the free areas of pv, in order. Returns the areas taken'''
+        taken= []
+        remaining= []
+        for start, count in free[pv]:
+            used= min(count, extents)
+            if used:
+                taken.append((pv, start, used))
+                extents-= used
+            if used < count:
+                remaining.append((start + used, count - used))
+        free[pv]= remaining
+        return taken
+
+    @staticmethod
+    def _contiguous(free, order, extents):
+        for pv in order:
+            for i, (start, count) in enumerate(free[pv]):
+                if count >= extents:
+                    free[pv][i]= (start + extents, count - extents)
+                    free[pv]= [area for area in free[pv] if area[1]]
+                    return [(pv, start, extents)]
+        return None
+
+    @staticmethod
+    def _on_one_pv(free, order, extents):
+        for pv in order:
+            if sum(count for _, count in free[pv]) >= extents:
+                return ExtentPlanner._take(free, pv, extents)
+        return None
+
+    @staticmethod
+    def _spanning(free, order, extents):
+        if sum(count for pv in order for _, count in free[pv]) < extents:
+            return None
+        areas= []
+        for pv in order:
+            taken= ExtentPlanner._take(free, pv, extents - sum(a[2] for a in areas))
+            areas.extend(taken)
+        return areas
+
+class VGMetadata(object):
+    '''A snapshot of the metadata of a VG: its VGRecord and the LVRecords of its LVs'''
+    def __init__(self, vg, lvs):
+        self.vg= vg
+        self.lvs= {r.lv_name: r for r in lvs}
+
+    @property
+    def seqno(self):
+        return self.vg.vg_seqno
+
+    @property
+    def extent_size(self):
+        return self.vg.vg_extent_size
+
+    @property
+    def free(self):
+        '''Free space, in bytes'''
+        return self.vg.vg_free
+
+class VGMetadataCache(object):
+    '''Caches a VGMetadata snapshot per VG.
+    A snapshot is reused while the VG metadata sequence number (vg_seqno) doesn't
+    change, which costs a single light vgs query. While an operation is running
+    (see blockdevice.size_cache) the sequence number is only checked the first
+    time each VG is used - pybofh invalidates the snapshots of the VGs it changes.'''
+    def __init__(self):
+        self._snapshots= {} # vg name -> (shell, snapshot, size_cache epoch it was checked on)
+
+    def get(self, vg_name):
+        '''Returns the VGMetadata of VG vg_name'''
+        sh= _shell() # the shell that runs the LVM commands
+        epoch= blockdevice.size_cache.epoch if blockdevice.size_cache.active else None
+        cached= self._snapshots.get(vg_name)
+        snapshot, checked_epoch= (cached[1], cached[2]) if cached is not None and cached[0] is sh else (None, None)
+        if snapshot is not None and (epoch is None or checked_epoch != epoch):
+            if _vg_seqno(vg_name) != snapshot.seqno:
+                snapshot= None
+        if snapshot is None:
+            snapshot= self._fetch(vg_name)
+        self._snapshots[vg_name]= (sh, snapshot, epoch)
+        return snapshot
+
+    @staticmethod
+    def _fetch(vg_name):
+        vgs, lvs= shell.gather([vg_inventory_async(), lv_inventory_async(vg_name)])
+        vgs= [r for r in vgs if r.vg_name == vg_name]
+        if not vgs:
+            raise Exception("VG {} does not exist".format(vg_name))
+        return VGMetadata(vgs[0], lvs)
+
+    def invalidate(self, vg_name=None):
+        '''Discards the snapshot of VG vg_name, or all snapshots'''
+        if vg_name is None:
+            self._snapshots= {}
+        else:
+            self._snapshots.pop(vg_name, None)
+
+vg_metadata_cache= VGMetadataCache() # singleton
+
+def _vg_seqno(vg_name):
+    '''Returns the metadata sequence number of VG vg_name, or None if it doesn't exist'''
+    try:
+        records= _report_async(VGS, 'vg', VGSeqnoRecord, (vg_name,)).result()
+    except subprocess.CalledProcessError:
+        return None # vgs fails for VGs that don't exist
+    return records[0].vg_seqno if records else None
 
 def get_vgs():
     '''Returns a list of VG names'''
-    out= shell.get().check_output("/sbin/vgdisplay")
-    vg_lines= sfilter('VG Name', out)
-    vgs= [rsplit(x)[2] for x in vg_lines]
-    return vgs
+    return get_vgs_async().result()
+
+def get_vgs_async():
+    '''Like get_vgs, but returns a shell.Future'''
+    return vg_inventory_async().then(lambda vgs: [r.vg_name for r in vgs])
 
 def get_lvs(vg=None):
     '''Returns a list of LV names.
     If vg!=None, filter to LVs on that particular VG'''
-    lvs = _parse_lvdisplay()
-    filtered_lvs = [(k,v) for k,v in lvs.items() if v['VG Name']==vg or vg is None] 
-    names = [k for k,_ in filtered_lvs]
-    return names
-
-def create_lv(vg, name, size):
+    return get_lvs_async(vg).result()
+
+def get_lvs_async(vg=None):
+    '''Like get_lvs, but returns a shell.Future'''
+    return lv_inventory_async(vg).then(lambda lvs: [r.lv_name for r in lvs])
+
+def lv_inventory(vg=None):
+    '''Returns a list of LVRecord, with all LVs (or the ones on VG vg)'''
+    return lv_inventory_async(vg).result()
+
+def lv_inventory_async(vg=None):
+    '''Like lv_inventory, but returns a shell.Future'''
+    return _report_async(LVS, 'lv', LVRecord, (vg,) if vg is not None else ())
+
+def pv_segments(vg=None):
+    '''Returns a list of PVSegmentRecord, the segment map of all PVs (on VG vg, if given)'''
+    return pv_segments_async(vg).result()
+
+def pv_segments_async(vg=None):
+    '''Like pv_segments, but returns a shell.Future'''
+    select= ("--select", "vg_name={}".format(vg)) if vg is not None else () # pvs takes PVs as arguments, not VGs
+    return _report_async(PVS, 'pvseg', PVSegmentRecord, ("--segments",) + select)
+
+def lv_record(vg, name):
+    '''Returns the LVRecord of a single LV. Unlike the VG metadata cache, always queries LVM'''
+    records= _report_async(LVS, 'lv', LVRecord, ("{}/{}".format(vg, name),)).result()
+    records= [r for r in records if r.vg_name == vg and r.lv_name == name]
+    if not records:
+        raise Exception("LV {} does not exist on VG {}".format(name, vg))
+    return records[0]
+
+def pv_record(device):
+    '''Returns the PVRecord of the PV on a device. Always queries LVM'''
+    records= _report_async(PVS, 'pv', PVRecord, (device,)).result()
+    path= os.path.realpath(device)
+    records= [r for r in records if r.pv_name == device or os.path.realpath(r.pv_name) == path]
+    if not records:
+        raise Exception("There's no PV on {}".format(device))
+    return records[0]
+
+def pv_used_size(record):
+    '''The bytes of the device used by a PV. PVs not on a VG (orphans) have no extents, and use pv_size'''
+    if not record.pv_pe_count:
+        return record.pv_size
+    return record.pe_start + record.pv_pe_count * record.vg_extent_size
+
+def vg_inventory():
+    '''Returns a list of VGRecord, with all VGs'''
+    return vg_inventory_async().result()
+
+def vg_inventory_async():
+    '''Like vg_inventory, but returns a shell.Future'''
+    return _report_async(VGS, 'vg', VGRecord)
+
+def pv_inventory():
+    '''Returns a list of PVRecord, with all PVs'''
+    return pv_inventory_async().result()
+
+def pv_inventory_async():
+    '''Like pv_inventory, but returns a shell.Future'''
+    return _report_async(PVS, 'pv', PVRecord)
+
+def _report_async(binary, report_key, record_class, args=()):
+    '''Runs a LVM reporting command (lvs, vgs, pvs), asking for all the fields of record_class.
+    args restricts the report to some objects (e.g.: a VG name)'''
+    out= _shell().check_output_async(_report_command(binary, record_class, args))
+    return out.then(lambda s: _parse_report(s, report_key, record_class))
+
+def _report_command(binary, record_class, args=()):
+    fields= ",".join(record_class._fields)
+    return (binary, "--reportformat", "json", "--units", "b", "--nosuffix", "-o", fields) + tuple(args)
+
+def _parse_report(output, report_key, record_class):
+    '''Parses the JSON output of a LVM reporting command into a list of record_class'''
+    def convert(field, value):
+        if field in INT_FIELDS:
+            return int(value) if value != '' else None
+        if field in FLOAT_FIELDS:
+            return float(value) if value != '' else None
+        return value
+    records= []
+    for report in json.loads(output)['report']:
+        for item in report[report_key]:
+            values= [convert(f, item[f]) for f in record_class._fields]
+            records.append(record_class(*values))
+    return records
+
+def _size_arg(size):
+    '''Converts a size to a LVM command argument. Numbers are in bytes'''
     if not isinstance(size, basestring):
         size= str(size)+"B"
-    print "creating LV {name} with size={size}".format(**locals())
-    command = ("/sbin/lvcreate", vg, "--name", name, "--size", size)
-    shell.get().check_call(command)
+    return size
+
+def _size_bytes(size):
+    '''Converts a size - a number of bytes, or a LVM size argument like "10G" - to bytes. LVM sizes without units are in MiB'''
+    if not isinstance(size, basestring):
+        return int(size)
+    number, unit= (size[:-1], size[-1].lower()) if size[-1].isalpha() else (size, 'm')
+    if unit not in SIZE_UNITS:
+        raise ValueError("Unknown size unit: {}".format(size))
+    return int(float(number) * SIZE_UNITS[unit])
+
+def create_lv(vg, name, size, alloc=None, pvs=()):
+    '''Creates a LV. alloc is a LVM allocation policy, and pvs restricts the allocation to those PVs'''
+    size= _size_arg(size)
+    alloc_flag= ("--alloc", alloc) if alloc else ()
+    command = ("/sbin/lvcreate", vg, "--name", name, "--size", size) + alloc_flag + tuple(pvs)
+    with events.operation("create_lv", "{}/{}".format(vg, name), size=size):
+        _check_call_invalidating(command, vg)
+
+def create_thin_pool(vg, name, size, metadata_size=None):
+    size= _size_arg(size)
+    metadata_flag= ("--poolmetadatasize", _size_arg(metadata_size)) if metadata_size is not None else ()
+    command = ("/sbin/lvcreate", vg, "--type", THIN_POOL_SEGTYPE, "--name", name, "--size", size) + metadata_flag
+    with events.operation("create_thin_pool", "{}/{}".format(vg, name), size=size):
+        _check_call_invalidating(command, vg)
+
+def create_thin_lv(vg, pool, name, virtual_size):
+    virtual_size= _size_arg(virtual_size)
+    command = ("/sbin/lvcreate", vg, "--type", THIN_SEGTYPE, "--thinpool", pool, "--name", name, "--virtualsize", virtual_size)
+    with events.operation("create_thin_lv", "{}/{}".format(vg, name), pool=pool, virtual_size=virtual_size):
+        _check_call_invalidating(command, vg)
+
+def create_snapshot(vg, origin, name, size):
+    size= _size_arg(size)
+    command = ("/sbin/lvcreate", "--snapshot", "--name", name, "--size", size, "{vg}/{origin}".format(**locals()))
+    with events.operation("create_snapshot", "{}/{}".format(vg, name), origin=origin, size=size):
+        _check_call_invalidating(command, vg)
+
+def merge_snapshot(vg, name):
+    command = ("/sbin/lvconvert", "--merge", "{vg}/{name}".format(**locals()))
+    with events.operation("merge_snapshot", "{}/{}".format(vg, name)):
+        _check_call_invalidating(command, vg)
+
+def create_thin_snapshot(vg, origin, name, activate=True):
+    '''Creates a thin snapshot of a thin LV. It takes no space until either LV is written.
+    Thin snapshots are not activated by default by LVM - unless activate is True'''
+    activation_flag= ("--setactivationskip", "n", "--activate", "y") if activate else ()
+    command = ("/sbin/lvcreate", "--snapshot", "--name", name) + activation_flag + ("{vg}/{origin}".format(**locals()),)
+    with events.operation("create_thin_snapshot", "{}/{}".format(vg, name), origin=origin):
+        _check_call_invalidating(command, vg)
 
 def remove_lv(vg, name, force=True):
-    print "deleting LV {name}".format(**locals())
     force_flag= ("-f",) if force else ()
     command = ("/sbin/lvremove",) + force_flag + ("{vg}/{name}".format(**locals()),)
-    shell.get().check_call(command)
+    with events.operation("remove_lv", "{}/{}".format(vg, name)):
+        _check_call_invalidating(command, vg)
+
+_revertible_create_lv= has_reverse(remove_lv, revert_args=lambda args, kwargs: (args[:2], {}))(create_lv)
+
+def create_lvs(vg, lvs, alloc=None, spread=False, validate=False):
+    '''Creates several LVs on VG vg. lvs is a list of (name, size) tuples.
+    This is atomic: if creating any of the LVs fails, the ones already created are removed.
+    The creations are logged as a single events.batch.
+    If validate or spread, the LVs are first planned with a ExtentPlanner, which raises
+    ExtentPlanner.NoSpace before anything is created if they don't fit. Each LV is then
+    created on the PVs of its Placement - with spread, LVs are spread across PVs'''
+    pvs= [()] * len(lvs)
+    if validate or spread:
+        placements= ExtentPlanner(vg).plan(lvs, alloc=alloc or 'normal', spread=spread)
+        pvs= [p.pvs for p in placements]
+    with events.batch("create_lvs"), AtomicContext() as atomic:
+        for (name, size), lv_pvs in zip(lvs, pvs):
+            atomic(_revertible_create_lv)(vg, name, size, alloc=alloc, pvs=lv_pvs)
+
+def remove_lvs(vg, names, force=True):
+    '''Removes several LVs of VG vg with a single lvremove.
+    Removals can't be reverted, so all the LVs are checked to exist before removing any'''
+    if not names:
+        return
+    existing= set(get_lvs(vg))
+    missing= [name for name in names if name not in existing]
+    if missing:
+        raise Exception("LVs {} do not exist on VG {}".format(", ".join(missing), vg))
+    force_flag= ("-f",) if force else ()
+    command = ("/sbin/lvremove",) + force_flag + tuple("{}/{}".format(vg, name) for name in names)
+    with events.operation("remove_lvs", vg, lvs=",".join(names)):
+        _check_call_invalidating(command, vg)
 
 def rename_lv(vg, name, new_name):
-    print "renaming LV {name}".format(**locals())
     command= ("/sbin/lvrename", vg, name, new_name)
-    shell.get().check_call(command)
+    with events.operation("rename_lv", "{}/{}".format(vg, name), new_name=new_name):
+        _check_call_invalidating(command, vg)
  
 def create_pv(device, force=True):
-    print "creating PV {device}".format(**locals())
     force_flag= ("-f",) if force else ()
     command= ("/sbin/pvcreate",) + force_flag + (device,)
-    shell.get().check_call(command)
+    with events.operation("create_pv", device):
+        _shell().check_call(command)
 
 def create_vg(name, pvdevice):
-    print "creating VG {name} with PV {pvdevice}".format(**locals())
     command = ("/sbin/vgcreate", name, pvdevice)
-    shell.get().check_call(command)
+    with events.operation("create_vg", name, pv=pvdevice):
+        _check_call_invalidating(command, name)
 
 def remove_vg(name):
-    print "deleting VG {name}".format(**locals())
     command = ("/sbin/vgremove", name)
-    shell.get().check_call(command)
+    with events.operation("remove_vg", name):
+        _check_call_invalidating(command, name)
+
+def resize_pv(device, byte_size=None, vg=None):
+    '''Resizes the PV on device to byte_size, or to the size of the device if byte_size is None'''
+    size_args= ("--setphysicalvolumesize", _size_arg(byte_size)) if byte_size is not None else ()
+    command = ("/sbin/pvresize",) + size_args + (device,)
+    with events.operation("resize_pv", device, size=byte_size):
+        if vg:
+            _check_call_invalidating(command, vg)
+        else:
+            _shell().check_call(command)
 
 def remove_pv(device):
-    print "deleting PV {device}".format(**locals())
     command = ("/sbin/pvremove", device)
-    shell.get().check_call(command)
-
-def _parse_xxdisplay(output, expected_keys, is_separator_line, name_key, column2_start=24):
-    '''Generic parser for output of pvdisplay, vgdisplay and lvdisplay'''
-    def parse_line(line):
-        if "System ID" in line:
-            #no value data for this one? brakes assertions
-            return ("System ID", None) 
-        assert line.startswith("  ") 
-        assert line[2]!=" " # first column
-        assert line[column2_start-1]==" "
-        assert line[column2_start]!=" " # second column
-        tup= (line[2:column2_start].strip(), line[column2_start:].strip())
-        assert len(tup[0]) > 0 and len(tup[1]) > 0
-        return tup
-    def convert_line_tup(tup):
-        SIZE_SUFFIXES= {'KiB': 2**10, 'MiB': 2**20, 'GiB': 2**30, 'TiB': 2**40}
-        if tup[0].endswith('Size'):
-            tokens= tup[1].split()
-            assert tokens[-1] in SIZE_SUFFIXES
-            if len(tokens)==2: #only a number and a prefix
-                size= int(float(tokens[0]) * SIZE_SUFFIXES[tokens[1]])
-                tup= (tup[0], size)
-        return tup
-    lines= output.splitlines()
-    lines= [line for line in lines if line.strip()!='']
-    sep_lines_idx= [i for i,line in enumerate(lines) if is_separator_line(line)]
-    sep_lines_idx.append(len(lines))
-    assert len(sep_lines_idx)>=1 # TODO: what if there are no VGs?
-    xx_dicts={}
-    for xx_i in range(len(sep_lines_idx) - 1):
-        start_line= sep_lines_idx[xx_i] + 1
-        end_line= sep_lines_idx[xx_i+1]
-        xx_lines= lines[start_line:end_line]
-        assert 8 <= len(xx_lines) <= 30
-        xx_tuples= map(parse_line, xx_lines)
-        xx_tuples2= map(convert_line_tup, xx_tuples)
-        xx_dict= dict(xx_tuples2)
-        assert set(xx_dict) >= set(expected_keys)
-        xx_name= xx_dict[name_key]
-        xx_dicts[xx_name]= xx_dict
-    return xx_dicts
-
-def _parse_pvdisplay():
-    EXPECTED_KEYS = [ 'PV Name', 'VG Name', 'PV Size', 'Allocatable',
-        'PE Size', 'Total PE', 'Free PE', 'Allocated PE', 'PV UUID']
-    is_separator_line= lambda line: '--- Physical volume ---' in line
-    out= shell.get().check_output("/sbin/pvdisplay")
-    name_key='PV Name'
-    return _parse_xxdisplay(out, EXPECTED_KEYS, is_separator_line, name_key)
-
-def _parse_vgdisplay():
-    EXPECTED_KEYS = ['Act PV', 'Alloc PE / Size', 'Cur LV', 'Cur PV',
-        'Format', 'Free  PE / Size', 'MAX LV', 'Max PV', 'Metadata Areas',
-        'Metadata Sequence No', 'Open LV', 'PE Size', 'System ID', 'Total PE',
-        'VG Access', 'VG Name', 'VG Size', 'VG Status', 'VG UUID']
-    is_separator_line= lambda line: '--- Volume group ---' in line
-    out= shell.get().check_output("/sbin/vgdisplay")
-    name_key='VG Name'
-    return _parse_xxdisplay(out, EXPECTED_KEYS, is_separator_line, name_key)
-
-
-def _parse_lvdisplay():
-    EXPECTED_KEYS = [ 'LV Path', 'LV Name', 'VG Name', 'LV UUID',
-            'LV Write Access', 'LV Creation host, time', 'LV Status',
-            '# open', 'LV Size', 'Current LE', 'Segments', 'Allocation',
-            'Read ahead sectors', '- currently set to', 'Block device']
-    is_separator_line= lambda line: '--- Logical volume ---' in line
-    out= shell.get().check_output("/sbin/lvdisplay")
-    name_key='LV Name'
-    return _parse_xxdisplay(out, EXPECTED_KEYS, is_separator_line, name_key, column2_start=25)
-
-blockdevice.register_data_class("LVM2 PV", PV)
+    with events.operation("remove_pv", device):
+        _shell().check_call(command)
+
+class LvmShell(shell.Shell):
+    '''Runs LVM commands inside a single long-lived "lvm shell" process, so
+    devices are scanned and metadata is read once, instead of once per command.
+
+    Commands are given as to any other shell (e.g.: ("/sbin/lvcreate", ...)) - the
+    binary name is used as the lvm shell command. Commands run with
+    "--reportformat json"; lvm shell then includes the command log in the JSON
+    output, and the exit status is read from it.'''
+    class SessionDied(Exception):
+        pass
+
+    class NoStatus(subprocess.CalledProcessError):
+        '''The command log has no exit status, so the command may have failed'''
+        def __str__(self):
+            return "lvm shell didn't report the exit status of: {}".format(self.cmd)
+
+    def __init__(self, lvm_binary=LVM):
+        self.lvm_binary= lvm_binary
+        self._process= None
+        self._buffer= ''
+        self._lock= threading.Lock()
+
+    def check_call(self, command):
+        try:
+            shell.Shell.check_call(self, command)
+        finally:
+            # caches of system state follow the generation of the main shell
+            shell.get().generation += 1
+
+    def close(self):
+        '''Terminates the lvm shell. It will be restarted by the next command'''
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        process, self._process= self._process, None
+        self._buffer= ''
+        if process is not None and process.poll() is None:
+            process.stdin.close()
+            process.wait()
+
+    def _run_process(self, command):
+        args= (os.path.basename(command[0]),) + tuple(command[1:])
+        if any(not arg or arg.split() != [arg] for arg in args):
+            raise ValueError("lvm shell can't run arguments with whitespace: {}".format(command))
+        if '--reportformat' not in args:
+            args+= ('--reportformat', 'json')
+        with self._lock:
+            if self._process is None or self._process.poll() is not None:
+                self._process= subprocess.Popen((self.lvm_binary, 'shell'), stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+            try:
+                self._process.stdin.write(" ".join(args) + "\n")
+                self._process.stdin.flush()
+                output, report= self._read_report()
+            except (IOError, OSError, LvmShell.SessionDied):
+                self._close()
+                raise LvmShell.SessionDied("lvm shell died while running: {}".format(command))
+        statuses= [entry for entry in report.get('log', []) if entry.get('log_type') == 'status']
+        if not statuses:
+            raise LvmShell.NoStatus(None, command, output)
+        if int(statuses[-1]['log_ret_code']) != LVM_SUCCESS:
+            raise subprocess.CalledProcessError(int(statuses[-1]['log_ret_code']), command, output)
+        return output
+
+    def _read_report(self):
+        '''Reads the JSON output of a command. Returns (the output, the parsed output)'''
+        decoder= json.JSONDecoder()
+        while True:
+            start= self._buffer.find('{')
+            if start >= 0 and '}' in self._buffer:
+                try:
+                    report, end= decoder.raw_decode(self._buffer, start)
+                    output, self._buffer= self._buffer[start:end], self._buffer[end:]
+                    return output, report
+                except ValueError:
+                    pass # incomplete
+            chunk= os.read(self._process.stdout.fileno(), 65536)
+            if not chunk:
+                raise LvmShell.SessionDied()
+            self._buffer+= chunk
+
+_session= None # LvmShell singleton, used by the "session" backend
+
+def _shell():
+    '''Returns the shell that runs LVM commands, according to the "backend" setting'''
+    global _session
+    backend= settings.get("backend", "commands")
+    if backend == "commands":
+        return shell.get()
+    if backend == "session":
+        if _session is None:
+            _session= LvmShell()
+        return _session
+    raise ValueError("Unknown LVM backend: {}".format(backend))
+
+def _check_call_invalidating(command, vg):
+    '''Runs a command that changes the metadata of VG vg'''
+    try:
+        _shell().check_call(command)
+    finally:
+        vg_metadata_cache.invalidate(vg)
+
+blockdevice.register_data_class(LVM2_LABEL, PV)
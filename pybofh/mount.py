@@ -1,6 +1,7 @@
 #!/usr/bin/python
 import os
 import pybofh.shell as shell
+from pybofh import events
 
 class Mounted(object):
     '''A class that represents a mounted file.
@@ -82,24 +83,24 @@ class MountPool(object):
         return m
 
 def mount(device, mountpoint, options=()):
-    print "mounting {device} on {mountpoint}".format(**locals())
     options = ("-o",) + options if options else ()
     command= ("/bin/mount",) + options + (device, mountpoint)
-    p = shell.get().check_call(command)
+    with events.operation("mount", device, mountpoint=mountpoint):
+        shell.get().check_call(command)
 
 def unmount(device):
-    print "unmounting {device}".format(**locals())
     command= ('/bin/umount', device)
-    p = shell.get().check_call(command)
+    with events.operation("unmount", device):
+        shell.get().check_call(command)
 
 def is_mountpoint( path ):
     assert os.path.isdir(path)
     return os.path.ismount(path)
 
 def create_filesystem(path, fs="btrfs", options=()):
-    print "creating {fs} filesystem on {path}".format(**locals())
     if fs=="btrfs":
         options.append("-f")
     options= " ".join(options) 
     command=("/sbin/mkfs.{}".format(fs)) + options +(path,)
-    shell.get().check_call(command)
+    with events.operation("create_filesystem", path, fs=fs):
+        shell.get().check_call(command)
@@ -1,22 +1,191 @@
 from abc import ABCMeta, abstractmethod
-import functools
+from collections import deque, namedtuple
+from contextlib import contextmanager
+import gzip
+import itertools
+import json
 import logging
+import math
 import os.path
+import pipes
+import Queue
 import subprocess
+import sys
+import threading
+import time
+import uuid
 
 log = logging.getLogger(__name__)
 
+DEFAULT_MAX_CONCURRENCY = 8
+
+class Future(object):
+    """The result of a command (or computation) that may still be running"""
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    @classmethod
+    def from_call(cls, f, *args):
+        """Returns a finished Future with the result (or exception) of f(*args)"""
+        future = cls()
+        future.set_from_call(f, *args)
+        return future
+
+    def set_from_call(self, f, *args):
+        try:
+            self._result = f(*args)
+        except Exception:
+            self._exc_info = sys.exc_info()
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self):
+        """Waits for the result and returns it. If the computation raised an exception, raises it"""
+        self._done.wait()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def then(self, f):
+        """Returns a Future with the result of f(result)"""
+        return _ChainedFuture(self, f)
+
+class _ChainedFuture(Future):
+    def __init__(self, parent, f):
+        Future.__init__(self)
+        self._parent = parent
+        self._f = f
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._parent.done()
+
+    def result(self):
+        with self._lock:
+            if not self._done.is_set():
+                self.set_from_call(lambda: self._f(self._parent.result()))
+        return Future.result(self)
+
+class CommandRecord(namedtuple('CommandRecord', ['command', 'duration', 'status', 'output_size', 'caller'])):
+    """A command run while profiling. duration is in seconds, status is the
+    exit status (None if the command couldn't run) and caller is the pybofh
+    function that ran it ("module.function")"""
+    __slots__ = ()
+
+class Profile(object):
+    """Collects a CommandRecord for each command run by a shell (see Shell.profile)"""
+    def __init__(self):
+        self.records = []
+
+    def add(self, record):
+        self.records.append(record)
+
+    def stats(self):
+        """Returns a dict of binary -> stats of its commands.
+        stats is a dict with the keys count, total, p50, p95 and max (durations in seconds)"""
+        durations = {}
+        for record in self.records:
+            binary = os.path.basename(record.command[0])
+            durations.setdefault(binary, []).append(record.duration)
+        return {binary: _duration_stats(d) for binary, d in durations.items()}
+
+    def callers(self):
+        """Returns a dict of caller -> (count, total duration)"""
+        callers = {}
+        for record in self.records:
+            count, total = callers.get(record.caller, (0, 0.0))
+            callers[record.caller] = (count + 1, total + record.duration)
+        return callers
+
+    def summary(self):
+        """Returns a human readable table of stats(), slowest binaries first"""
+        stats = sorted(self.stats().items(), key=lambda item: item[1]['total'], reverse=True)
+        lines = ["{:<20} {:>6} {:>9} {:>9} {:>9} {:>9}".format("binary", "count", "total", "p50", "p95", "max")]
+        for binary, st in stats:
+            lines.append("{:<20} {count:>6} {total:>9.3f} {p50:>9.3f} {p95:>9.3f} {max:>9.3f}".format(binary, **st))
+        return "\n".join(lines)
+
+def _percentile(sorted_values, percent):
+    """Nearest-rank percentile"""
+    i = int(math.ceil(percent / 100.0 * len(sorted_values))) - 1
+    return sorted_values[max(i, 0)]
+
+def _duration_stats(durations):
+    durations = sorted(durations)
+    return {
+        'count': len(durations),
+        'total': sum(durations),
+        'p50': _percentile(durations, 50),
+        'p95': _percentile(durations, 95),
+        'max': durations[-1],
+        }
+
+_local = threading.local()
+
+def _caller():
+    """Returns the name of the first function on the stack outside this module.
+    On AsyncShell workers, the function that queued the command"""
+    caller = getattr(_local, 'caller', None)
+    if caller is not None:
+        return caller
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_globals.get('__name__') == __name__:
+        frame = frame.f_back
+    if frame is None:
+        return None
+    return "{}.{}".format(frame.f_globals.get('__name__'), frame.f_code.co_name)
+
+def gather(futures):
+    """Waits for all the futures. Returns a list with their results"""
+    return [f.result() for f in futures]
+
 class Shell(object):
-    """Shell executes processes on a system. It has a interface similar to subprocess."""
+    """Shell executes processes on a system. It has a interface similar to subprocess.
+
+    Commands run through check_call() are assumed to have side effects. Each
+    one increments the generation counter, which caches of system state (such
+    as blockdevice.topology_cache) use to know when they are outdated.
+    """
     __metaclass__ = ABCMeta
+    generation = 0
+    _profiles = () # active Profiles
+
+    @contextmanager
+    def profile(self):
+        """Context manager that records all the commands run inside it.
+        Example:
+            with shell.get().profile() as p:
+                ...
+            print p.summary()
+        """
+        p = Profile()
+        self._profiles += (p,)
+        try:
+            yield p
+        finally:
+            self._profiles = tuple(x for x in self._profiles if x is not p)
+
     def check_call(self, command):
         """Executes the command, and ensures it doesn't return a error. Doesn't return the output"""
-        self.run_process(command)
+        try:
+            self.run_process(command)
+        finally:
+            # even a failed command may have changed the system state
+            self.generation += 1
 
     def check_output(self, command):
         """Executes the command, and ensures it doesn't return a error. Returns the output"""
         return self.run_process(command)
 
+    def check_output_async(self, command):
+        """Like check_output, but returns a Future with the output.
+        Shells that don't run commands concurrently (see AsyncShell) run it right away"""
+        return Future.from_call(self.check_output, command)
+
     def run_process(self, command):
         """Executes the command, and ensures it doesn't return a error. Returns the output"""
         if isinstance(command, (str, unicode)):
@@ -24,11 +193,21 @@ class Shell(object):
         else:
             command = tuple(command)
         logging.debug("Running command: %s" % " ".join(command))
+        profiles = self._profiles
+        start = time.time()
+        response, status = None, 0
         try:
             response = self._run_process(command)
         except Exception as e:
             logging.debug("Failed: %s" % e)
+            status = getattr(e, 'returncode', None)
             raise
+        finally:
+            if profiles:
+                output_size = len(response) if isinstance(response, basestring) else 0
+                record = CommandRecord(command, time.time() - start, status, output_size, _caller())
+                for p in profiles:
+                    p.add(record)
         logging.debug("Result: %s" % response)
         return response
 
@@ -40,14 +219,230 @@ class SystemShell(Shell):
         result = subprocess.check_output(command)
         return result
 
+class PersistentShell(Shell):
+    """Runs commands through a long-lived /bin/sh worker process, instead of
+    creating a new subprocess from python for each command.
+
+    Commands are written to the worker's stdin, one per line, and their
+    output is framed by a random marker followed by the exit status.
+    Commands run with stdin redirected from /dev/null, and with the
+    environment and working directory the worker was started with.
+    Failed commands raise subprocess.CalledProcessError (a missing binary
+    fails with status 127, as in the shell).
+    """
+    SH = '/bin/sh'
+
+    class WorkerDied(Exception):
+        pass
+
+    def __init__(self):
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def _start_worker(self):
+        self._worker = subprocess.Popen((self.SH,), stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+
+    def close(self):
+        """Terminates the worker. It will be restarted by the next command"""
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        worker, self._worker = self._worker, None
+        if worker is not None and worker.poll() is None:
+            worker.stdin.close()
+            worker.wait()
+
+    def _run_process(self, command):
+        with self._lock:
+            if self._worker is None or self._worker.poll() is not None:
+                self._start_worker()
+            marker = uuid.uuid4().hex
+            line = "{} </dev/null; printf '\\n{} %d\\n' $?\n".format(" ".join(pipes.quote(c) for c in command), marker)
+            try:
+                self._worker.stdin.write(line)
+                self._worker.stdin.flush()
+                output, status = self._read_frame(marker)
+            except (IOError, PersistentShell.WorkerDied):
+                self._close()
+                raise PersistentShell.WorkerDied("Shell worker died while running: {}".format(command))
+        if status:
+            raise subprocess.CalledProcessError(status, command, output)
+        return output
+
+    def _read_frame(self, marker):
+        """Reads a command output from the worker, until the marker line. Returns (output, exit status)"""
+        prefix = marker + ' '
+        lines = []
+        while True:
+            line = self._worker.stdout.readline()
+            if not line:
+                raise PersistentShell.WorkerDied()
+            if line.startswith(prefix):
+                # the newline before the marker was added by printf
+                return "".join(lines)[:-1], int(line[len(prefix):])
+            lines.append(line)
+
+class AsyncShell(Shell):
+    """Wraps another shell, running the commands of check_output_async()
+    concurrently, on a pool of max_concurrency worker threads (started on
+    the first call). The other commands wait on a queue for their turn.
+
+    Only check_output (read-only queries) is concurrent - commands with side
+    effects (check_call) run synchronously, like in any other shell.
+    Commands run through the wrapped shell's run_process, so both shells
+    log and profile them.
+    """
+    def __init__(self, shell=None, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        self.shell = shell if shell is not None else SystemShell()
+        self.max_concurrency = max_concurrency
+        self._queue = Queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def _run_process(self, command):
+        return self.shell.run_process(command)
+
+    def _start_workers(self):
+        with self._lock:
+            while len(self._workers) < self.max_concurrency:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._workers.append(thread)
+
+    def _work(self):
+        while True:
+            future, command, caller = self._queue.get()
+            _local.caller = caller
+            try:
+                future.set_from_call(self.check_output, command)
+            finally:
+                _local.caller = None
+
+    def check_output_async(self, command):
+        if len(self._workers) < self.max_concurrency:
+            self._start_workers()
+        future = Future()
+        # the worker thread's stack doesn't have the function that queued the command
+        self._queue.put((future, command, _caller()))
+        return future
+
+class RecordedCommand(namedtuple('RecordedCommand', ['command', 'output', 'status', 'duration'])):
+    """A command run by a RecordingShell. status is the exit status, and duration is in seconds"""
+    __slots__ = ()
+
+def save_recording(path, records):
+    """Saves RecordedCommands to a file: gzip compressed, one JSON object per line"""
+    f = gzip.open(path, 'wb')
+    try:
+        for r in records:
+            # outputs are arbitrary bytes, which JSON can only represent as (latin-1) text
+            line = {"c": r.command, "o": r.output.decode('latin-1'), "s": r.status, "d": round(r.duration, 6)}
+            f.write(json.dumps(line, separators=(',', ':')) + "\n")
+    finally:
+        f.close()
+
+def load_recording(path):
+    """Returns the list of RecordedCommands saved to a file by save_recording()"""
+    f = gzip.open(path, 'rb')
+    try:
+        lines = [json.loads(line) for line in f if line.strip()]
+    finally:
+        f.close()
+    return [RecordedCommand(tuple(c.encode('utf-8') for c in l["c"]), l["o"].encode('latin-1'), l["s"], l["d"]) for l in lines]
+
+class RecordingShell(Shell):
+    """Wraps another shell (a SystemShell, by default), recording each command
+    it runs with its output, exit status and duration.
+    Save the recording with save(), and run it back with a ReplayShell.
+    Commands run through the wrapped shell's run_process, so both shells log and profile them.
+    Commands that can't run at all (missing binaries, for example) are not recorded."""
+    def __init__(self, shell=None):
+        self.shell = shell if shell is not None else SystemShell()
+        self.records = []
+        self._lock = threading.Lock()
+
+    def _run_process(self, command):
+        start = time.time()
+        try:
+            output = self.shell.run_process(command)
+        except subprocess.CalledProcessError as e:
+            self._record(command, e.output, e.returncode, start)
+            raise
+        self._record(command, output, 0, start)
+        return output
+
+    def _record(self, command, output, status, start):
+        record = RecordedCommand(command, output or '', status, time.time() - start)
+        with self._lock:
+            self.records.append(record)
+
+    def save(self, path):
+        with self._lock:
+            save_recording(path, self.records)
+
+class ReplayShell(Shell):
+    """Serves the commands of a recording (see RecordingShell), without running anything.
+
+    A command recorded several times gets its recorded responses in order,
+    so that changes of state are replayed too, and the last one after that.
+    Failed commands raise CalledProcessError, as they did when recorded.
+    If latency is given, each command takes its recorded duration multiplied
+    by latency (1.0 replays the recorded timing)."""
+    class NotRecorded(Exception):
+        def __init__(self, command):
+            Exception.__init__(self, "Command not in the recording: {}".format(command))
+
+    def __init__(self, recording, latency=None):
+        records = load_recording(recording) if isinstance(recording, basestring) else recording
+        self.latency = latency
+        self._responses = {}
+        for r in records:
+            self._responses.setdefault(tuple(r.command), []).append(r)
+        self._replayed = {} # command -> number of times it was run
+        self._lock = threading.Lock()
+
+    def _next_response(self, command):
+        with self._lock:
+            responses = self._responses.get(command)
+            if not responses:
+                raise ReplayShell.NotRecorded(command)
+            i = self._replayed.get(command, 0)
+            self._replayed[command] = i + 1
+        return responses[min(i, len(responses) - 1)]
+
+    def _run_process(self, command):
+        r = self._next_response(command)
+        if self.latency:
+            time.sleep(r.duration * self.latency)
+        if r.status:
+            raise subprocess.CalledProcessError(r.status, command, r.output)
+        return r.output
+
 class FakeShell(Shell):
     class NoFakeForCommand(Exception):
         def __init__(self, command):
             Exception.__init__(self, "No fake exists for command: {}".format(command))
 
-    def __init__(self):
-        self._fakes = []
-        self.run_commands = []
+    def __init__(self, max_run_commands=None):
+        """run_commands logs the commands run. If max_run_commands is given, it only keeps
+        the last max_run_commands (none, if 0) - for long simulations, where the log would grow too much.
+        A bounded log is a deque, which doesn't support slices - use clear_run_commands() to empty it"""
+        # fakes are indexed by kind: exact command, binary basename or matcher callable.
+        # The first fake added that matches a command wins, so each one keeps its order of addition
+        self._exact_fakes = {} # command -> [(order, response)]
+        self._binary_fakes = {} # basename -> [(order, binary_path, response)]
+        self._callable_fakes = [] # [(order, matcher, response)]
+        self._order = itertools.count()
+        self.run_commands = [] if max_run_commands is None else deque(maxlen=max_run_commands)
+
+    def clear_run_commands(self):
+        """Empties the log of commands run"""
+        if isinstance(self.run_commands, deque):
+            self.run_commands.clear()
+        else:
+            del self.run_commands[:]
 
     def add_fake(self, command, response):
         """Adds a fake command to the FakeShell.
@@ -64,20 +459,25 @@ class FakeShell(Shell):
         if isinstance(command, str):
             command = (command,)
         elif callable(command):
-            pass
+            self._callable_fakes.append((next(self._order), command, response))
+            return
         else:
             command = tuple(command)
-        self._fakes.append((command, response))
+        self._exact_fakes.setdefault(command, []).append((next(self._order), response))
 
     def remove_fake(self, command):
         """Removes a fake command from the FakeShell.
         The command argument must be the same object as passed to add_fake.
         """
-        removed_fakes = [fake for fake in self._fakes if fake[0] == command]
-        if not removed_fakes:
+        if callable(command):
+            fakes = [fake for fake in self._callable_fakes if fake[1] != command]
+            found = len(fakes) != len(self._callable_fakes)
+            self._callable_fakes = fakes
+        else:
+            command = (command,) if isinstance(command, str) else tuple(command)
+            found = self._exact_fakes.pop(command, None) is not None
+        if not found:
             raise KeyError("Fake not found: {}".format(command))
-        for fake in removed_fakes:
-            self._fakes.remove(fake)
 
     def add_fake_binary(self, binary_path, response):
         """Adds a fake "binary" to the FakeShell.
@@ -87,15 +487,37 @@ class FakeShell(Shell):
         binary_path can be an absolute or relative path.
         The response argument is passed unmodified to add_fake() (see documentation there).
         """
-        f = functools.partial(_command_matches_binary, binary_path)
-        self.add_fake(f, response)
+        basename = os.path.basename(binary_path)
+        self._binary_fakes.setdefault(basename, []).append((next(self._order), binary_path, response))
+
+    def _find_fake(self, command):
+        """Returns the response of the first fake added that matches command, or raises NoFakeForCommand.
+        Matcher callables are only called if they were added before the exact or binary fakes that match"""
+        best = None # (order, response)
+        exact = self._exact_fakes.get(command)
+        if exact:
+            best = exact[0]
+        if command:
+            for order, binary_path, response in self._binary_fakes.get(os.path.basename(command[0]), ()):
+                if best is not None and order > best[0]:
+                    break
+                if _command_matches_binary(binary_path, command):
+                    best = (order, response)
+                    break
+        for order, matcher, response in self._callable_fakes:
+            if best is not None and order > best[0]:
+                break
+            if matcher(command):
+                best = (order, response)
+                break
+        if best is None:
+            raise FakeShell.NoFakeForCommand(command)
+        return best[1]
 
     def _get_fake_response(self, command):
-        for fake_command, fake_response in self._fakes:
-            if (callable(fake_command) and fake_command(command)) or command == fake_command:
-                self.run_commands.append(command)
-                return fake_response(command) if callable(fake_response) else fake_response
-        raise FakeShell.NoFakeForCommand(command)
+        fake_response = self._find_fake(command)
+        self.run_commands.append(command)
+        return fake_response(command) if callable(fake_response) else fake_response
 
     def _run_process(self, command):
         assert not isinstance(command, str)
@@ -132,3 +554,7 @@ shell = SystemShell() # singleton
 def get():
     return shell
 
+def profile():
+    """Profiles the commands run by the current shell. See Shell.profile"""
+    return get().profile()
+
@@ -0,0 +1,193 @@
+'''Benchmarks. Run with: python -m pybofh.tests.benchmarks [--parsers | --system | --record RECORDING | RECORDING]
+Without arguments, benchmarks the import times.
+With --parsers, benchmarks the parsers with synthetic outputs of several sizes (see fixtures.py).
+With --system, benchmarks the block device stack operations on loop devices (needs root, see system_tests.py).
+With --record, the host queries are run on this host, and recorded (see shell.RecordingShell).
+With a recording, they're benchmarked offline against it (see shell.ReplayShell)'''
+from StringIO import StringIO
+import gc
+import marshal
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from pybofh import shell
+from pybofh.tests import fixtures
+
+PARSER_SIZES = (10, 1000, 10000)
+
+IMPORT_STATEMENTS = (
+    "import pybofh",
+    "import pybofh.drbd.proc_parser",
+    "import pybofh.lvm",
+    # everything the package used to import eagerly
+    "import pybofh.blockdevice, pybofh.mount, pybofh.filesystem, pybofh.btrfs, pybofh.xen, pybofh.lvm, pybofh.drbd.classes, pybofh.interfaces",
+    )
+
+def host_queries():
+    '''The read-only queries benchmarked against a recording, as (name, function)'''
+    from pybofh import blockdevice, lvm, xen
+    return [
+        ("lvm.lv_inventory", lvm.lv_inventory),
+        ("lvm.vg_inventory", lvm.vg_inventory),
+        ("lvm.pv_inventory", lvm.pv_inventory),
+        ("blockdevice.lsblk", blockdevice.lsblk),
+        ("xen.running_domus_names", xen.running_domus_names),
+        ]
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def import_time(statement, repeat=9):
+    '''Median time, in seconds, of running statement on a new python process (minus the python startup time)'''
+    def run(code):
+        start = time.time()
+        subprocess.check_call((sys.executable, "-c", code))
+        return time.time() - start
+    baseline = median([run("pass") for _ in range(repeat)])
+    return median([run(statement) for _ in range(repeat)]) - baseline
+
+def benchmark_imports():
+    for statement in IMPORT_STATEMENTS:
+        print "{:>8.1f}ms  {}".format(import_time(statement) * 1000, statement)
+
+def with_shell(sh, f):
+    '''Runs f() with sh as the shell singleton.
+    LVM commands use the "commands" backend meanwhile, so they run through sh too (the "session"
+    backend runs them on its own lvm shell process, which can't be recorded or replayed)'''
+    from pybofh import lvm
+    original, shell.shell = shell.shell, sh
+    try:
+        with lvm.settings.change(backend="commands"):
+            return f()
+    finally:
+        shell.shell = original
+
+def record(path):
+    '''Records the host queries on this host'''
+    recording = shell.RecordingShell()
+    for name, f in host_queries():
+        try:
+            with_shell(recording, f)
+        except Exception as e:
+            print "{}: failed ({}), not recorded".format(name, e)
+    recording.save(path)
+    print "{} commands recorded on {}".format(len(recording.records), path)
+
+def benchmark_replay(path, repeat=20, latency=None):
+    '''Median time of each host query against a recording'''
+    records = shell.load_recording(path)
+    for name, f in host_queries():
+        replay = shell.ReplayShell(records, latency=latency)
+        def run():
+            start = time.time()
+            with_shell(replay, f)
+            return time.time() - start
+        try:
+            print "{:>8.2f}ms  {}".format(median([run() for _ in range(repeat)]) * 1000, name)
+        except shell.ReplayShell.NotRecorded as e:
+            print "{:>10}  {} ({})".format("-", name, e)
+
+def parsers():
+    '''The parsers to benchmark, as (name, generate, prepare). generate(n) returns the input for n objects
+    (a string, or a list of strings), and prepare(input) returns a function that parses it'''
+    from pybofh import blockdevice, interfaces, lvm, xen
+    from pybofh.drbd import proc_parser
+    def parse(parser):
+        return lambda output: lambda: parser(output)
+    def dm_path(i):
+        return blockdevice.DM_DIR + "{}-{}".format(fixtures.vg_name(0), fixtures.lv_name(i))
+    def prepare_dmsetup_info(outputs):
+        sh = shell.FakeShell(max_run_commands=0)
+        for i, output in enumerate(outputs):
+            sh.add_fake(('/sbin/dmsetup', 'info', dm_path(i)), output)
+        return lambda: with_shell(sh, lambda: [blockdevice._devicemapper_info(dm_path(i)) for i in range(len(outputs))])
+    def prepare_ifconfig(output):
+        sh = shell.FakeShell(max_run_commands=0)
+        sh.add_fake((interfaces.IFCONFIG, '-a'), output)
+        return lambda: with_shell(sh, interfaces.ifconfig)
+    return [
+        ("lvs report", fixtures.lvs_report, parse(lambda out: lvm._parse_report(out, 'lv', lvm.LVRecord))),
+        ("lsblk --json", fixtures.lsblk_json, parse(blockdevice._parse_lsblk_json)),
+        ("lsblk (text)", fixtures.lsblk_text, parse(blockdevice._parse_lsblk_text)),
+        ("dmsetup info", lambda n: [fixtures.dmsetup_info(i) for i in range(n)], prepare_dmsetup_info),
+        ("ifconfig", fixtures.ifconfig, prepare_ifconfig),
+        ("xl list", fixtures.xl_list, parse(xen._parse_xl_list)),
+        ("/proc/drbd", fixtures.proc_drbd, parse(lambda out: proc_parser.parse_proc_drbd(StringIO(out)))),
+        ]
+
+def measure(name, generate, n):
+    '''Runs parser name on a new python process, over the input generated for n objects (loaded
+    from a file, so generating it doesn't count). Returns (duration in seconds, peak RSS in KiB,
+    peak RSS in KiB of a baseline process that loads the same input, without parsing it)'''
+    fd, path = tempfile.mkstemp(prefix='pybofh_benchmark_')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            marshal.dump(generate(n), f)
+        duration, peak = _run_measure(name, path)
+        _, baseline = _run_measure(name, path, baseline=True)
+    finally:
+        os.remove(path)
+    return duration, peak, baseline
+
+def _run_measure(name, path, baseline=False):
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, (root, os.environ.get('PYTHONPATH')))))
+    command = (sys.executable, '-m', 'pybofh.tests.benchmarks', '--measure', name, path) + (('--baseline',) if baseline else ())
+    duration, peak = subprocess.check_output(command, env=env).split()[-2:]
+    return float(duration), int(peak)
+
+def measure_child(name, path, baseline=False):
+    '''The process run by measure(). Prints the duration and the peak RSS'''
+    prepare = {n: p for n, _, p in parsers()}[name]
+    with open(path, 'rb') as f:
+        run = prepare(marshal.load(f))
+    gc.collect()
+    duration = 0.0
+    if not baseline:
+        start = time.time()
+        run()
+        duration = time.time() - start
+    print duration, peak_rss()
+
+def peak_rss():
+    '''Peak RSS of this process, in KiB. ru_maxrss isn't used if possible: after a fork and exec,
+    it starts at the RSS the parent process had when it forked'''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def benchmark_parsers(sizes=PARSER_SIZES):
+    '''Times every parser for each number of objects, reporting throughput and peak memory: the peak RSS
+    of the parsing process, and how much it's over a process that only loads the input.
+    Quadratic parsers show as a throughput that drops with the size'''
+    print "{:<14} {:>6} {:>11} {:>13} {:>11} {:>11}".format("parser", "n", "time(ms)", "objects/s", "peak(KiB)", "parse(KiB)")
+    for name, generate, _ in parsers():
+        for n in sizes:
+            duration, peak, baseline = measure(name, generate, n)
+            print "{:<14} {:>6} {:>11.2f} {:>13.0f} {:>11} {:>11}".format(name, n, duration * 1000, n / max(duration, 1e-9), peak, peak - baseline)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args[:1] == ["--parsers"]:
+        benchmark_parsers()
+    elif args[:1] == ["--measure"]: # run by measure()
+        measure_child(args[1], args[2], baseline="--baseline" in args[3:])
+    elif args[:1] == ["--system"]:
+        from pybofh.tests import system_tests
+        print system_tests.benchmark()
+    elif args[:1] == ["--record"]:
+        record(args[1])
+    elif args:
+        benchmark_replay(args[0])
+    else:
+        benchmark_imports()
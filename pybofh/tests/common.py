@@ -5,6 +5,7 @@ class FakeEnvironment(object):
         self.shell = FakeShell()
         self.devices = []
         self.inactive_devices = []
+        self.shell.add_fake_binary('/sbin/blockdev', self.blockdev)
 
     def add_device(self, fakedevice, active=True):
         self.inactive_devices.append(fakedevice)
@@ -32,6 +33,13 @@ class FakeEnvironment(object):
             raise Exception("Can't find FakeDevice for path: {}".format(path))
         # returns None if there's no match and enforce == False
 
+    def blockdev(self, command):
+        """Emulates blockdev --getsize64, for one or more devices"""
+        if command[1] != '--getsize64' or len(command) < 3:
+            raise NotImplementedError(str(command))
+        devices = [self.get_device(path, enforce=True) for path in command[2:]]
+        return "".join("{}\n".format(d.size) for d in devices)
+
     def path_exists(self, path):
         """Emulates os.path.exists"""
         return self.get_device(path) is not None
@@ -40,9 +48,9 @@ class FakeEnvironment(object):
         """Emulates pybofh.misc.read_file"""
         dev = self.get_device(path)
         if dev is None:
-            raise Exception("Can't find device for path: {}".format(path))
+            raise IOError("Can't find device for path: {}".format(path))
         if dev.content is None:
-            raise Exception("FakeDevice has no content: {}".format(path))
+            raise IOError("FakeDevice has no content: {}".format(path))
         return dev.content[:size]
 
 
@@ -75,8 +83,6 @@ class FakeDevice(object):
 
     def fake_shell_execute(self, command):
         """Implementation of command execution for FakeShell"""
-        if command == ('/sbin/blockdev', '--getsize64', self.path):
-            return str(self.size)
         if command == ('file', '--special', '--dereference', self.path):
             return self.file_type
         raise Exception("Unhandled fake command: {}".format(command))
@@ -0,0 +1,174 @@
+# -*- encoding: utf-8 -*-
+'''Generators of synthetic command outputs, for any number of objects (LVs, block devices,
+interfaces, domains, DRBD resources). The outputs have the format of the real commands, so
+they can be used with FakeShell to test and benchmark the parsers at scale'''
+from collections import OrderedDict
+import json
+
+from pybofh import lvm
+
+EXTENT_SIZE = 4 * 2**20
+LV_EXTENTS = 256 # 1GiB
+LVS_PER_DISK = 8 # children of each disk partition, on lsblk trees
+
+def _uuid(i):
+    '''A LVM-style uuid, unique for each i'''
+    digits = "{:032d}".format(i)
+    return "-".join((digits[:6], digits[6:10], digits[10:14], digits[14:18], digits[18:22], digits[22:26], digits[26:32]))
+
+def _report(report_key, rows):
+    '''A LVM JSON report, one row per line (as LVM formats them). Rows are OrderedDicts, as LVM outputs fields in the requested order'''
+    lines = ",\n".join("                  " + json.dumps(row) for row in rows)
+    return '  {\n      "report": [\n          {\n              "%s": [\n%s\n              ]\n          }\n      ]\n  }\n' % (report_key, lines)
+
+def lv_name(i):
+    return "lv{:05d}".format(i)
+
+def vg_name(i):
+    return "vg{:03d}".format(i)
+
+def lvs_report(n, vgs=1):
+    '''Output of lvs --reportformat json, for n linear LVs spread over vgs VGs'''
+    def row(i):
+        vg, name = vg_name(i % vgs), lv_name(i)
+        values = {
+            "lv_name": name, "vg_name": vg, "lv_path": "/dev/{}/{}".format(vg, name), "lv_uuid": _uuid(i),
+            "lv_size": str(LV_EXTENTS * EXTENT_SIZE), "lv_attr": "-wi-ao----", "seg_count": "1", "segtype": "linear",
+            }
+        return [(field, values.get(field, "")) for field in lvm.LV_FIELDS]
+    return _report("lv", [OrderedDict(row(i)) for i in range(n)])
+
+def vgs_report(n, lvs_per_vg=0):
+    '''Output of vgs --reportformat json, for n VGs'''
+    def row(i):
+        extents = 100000
+        values = {
+            "vg_name": vg_name(i), "vg_uuid": _uuid(i), "vg_size": extents * EXTENT_SIZE,
+            "vg_free": (extents - lvs_per_vg * LV_EXTENTS) * EXTENT_SIZE, "vg_extent_size": EXTENT_SIZE,
+            "vg_extent_count": extents, "vg_free_count": extents - lvs_per_vg * LV_EXTENTS, "lv_count": lvs_per_vg,
+            "pv_count": 1, "vg_seqno": i + 1,
+            }
+        return [(field, str(values[field])) for field in lvm.VG_FIELDS]
+    return _report("vg", [OrderedDict(row(i)) for i in range(n)])
+
+def pvs_report(n):
+    '''Output of pvs --reportformat json, for n PVs, each on its own VG'''
+    def row(i):
+        extents = 100000
+        values = {
+            "pv_name": "/dev/{}1".format(disk_name(i)), "vg_name": vg_name(i), "pv_uuid": _uuid(i),
+            "dev_size": 2**20 + extents * EXTENT_SIZE, "pv_size": extents * EXTENT_SIZE, "pv_free": 0, "pe_start": 2**20,
+            "pv_pe_count": extents, "pv_pe_alloc_count": extents, "vg_extent_size": EXTENT_SIZE,
+            }
+        return [(field, str(values[field])) for field in lvm.PV_FIELDS]
+    return _report("pv", [OrderedDict(row(i)) for i in range(n)])
+
+def disk_name(i):
+    '''sda, sdb, ..., sdz, sdaa, ...'''
+    letters = ""
+    i += 1
+    while i:
+        i, r = divmod(i - 1, 26)
+        letters = chr(ord('a') + r) + letters
+    return "sd" + letters
+
+def _lsblk_devices(n):
+    '''n block devices, as a tree of (name, major, minor, size, type, mountpoint, children).
+    Each disk has a partition, and the partition has LVS_PER_DISK LVs'''
+    disks = []
+    i = 0
+    lv_minor = 0
+    while i < n:
+        d = len(disks)
+        name = disk_name(d)
+        lvs = []
+        for _ in range(min(LVS_PER_DISK, n - i - 2)):
+            lvs.append(("{}-{}".format(vg_name(d), lv_name(lv_minor)), 253, lv_minor, LV_EXTENTS * EXTENT_SIZE, "lvm", None, []))
+            lv_minor += 1
+        size = (len(lvs) + 1) * LV_EXTENTS * EXTENT_SIZE
+        partition = (name + "1", 8 + d // 16 * 57, (d % 16) * 16 + 1, size, "part", None, lvs)
+        disk = (name, 8 + d // 16 * 57, (d % 16) * 16, size + 2**20, "disk", None, [partition] if n - i > 1 else [])
+        disks.append(disk)
+        i += 2 + len(lvs)
+    return disks
+
+def lsblk_json(n):
+    '''Output of lsblk --json --bytes, for n block devices'''
+    def device(dev):
+        name, major, minor, size, type_, mountpoint, children = dev
+        d = OrderedDict([("name", name), ("maj:min", "{}:{}".format(major, minor)), ("rm", False), ("size", size),
+            ("ro", False), ("type", type_), ("mountpoint", mountpoint)])
+        if children:
+            d = OrderedDict(d.items() + [("children", [device(c) for c in children])])
+        return d
+    return json.dumps({"blockdevices": [device(d) for d in _lsblk_devices(n)]}, indent=3) + "\n"
+
+def lsblk_text(n):
+    '''Output of lsblk --bytes (the tree format), for n block devices'''
+    lines = [u"NAME                                MAJ:MIN RM          SIZE RO TYPE  MOUNTPOINT"]
+    def add(dev, prefix, last, top):
+        name, major, minor, size, type_, mountpoint, children = dev
+        branch = u"" if top else (u"└─" if last else u"├─")
+        lines.append(u"{:<36}{:>3}:{:<3} 0 {:>13}  0 {:<5} {}".format(prefix + branch + name, major, minor, size, type_, mountpoint or u""))
+        child_prefix = prefix if top else prefix + (u"  " if last else u"│ ")
+        for i, c in enumerate(children):
+            add(c, child_prefix, i == len(children) - 1, False)
+    for d in _lsblk_devices(n):
+        add(d, u"", True, True)
+    return (u"\n".join(lines) + u"\n").encode('utf-8')
+
+def dmsetup_info(i):
+    '''Output of dmsetup info, for the i-th LV of lsblk_json()'''
+    return """Name:              {name}
+State:             ACTIVE
+Read Ahead:        256
+Tables present:    LIVE
+Open count:        1
+Event number:      0
+Major, minor:      253, {i}
+Number of targets: 1
+UUID: LVM-{uuid}
+
+""".format(name="{}-{}".format(vg_name(0), lv_name(i)), i=i, uuid=_uuid(i).replace("-", ""))
+
+def ifconfig(n):
+    '''Output of ifconfig -a, for n interfaces: lo, and n-1 vifs'''
+    lo = """lo: flags=73<UP,LOOPBACK,RUNNING>  mtu 65536
+        inet 127.0.0.1  netmask 255.0.0.0
+        inet6 ::1  prefixlen 128  scopeid 0x10<host>
+        loop  txqueuelen 1  (Local Loopback)
+        RX packets 311412  bytes 5167687959 (4.8 GiB)
+        RX errors 0  dropped 0  overruns 0  frame 0
+        TX packets 311412  bytes 5167687959 (4.8 GiB)
+        TX errors 0  dropped 0 overruns 0  carrier 0  collisions 0
+
+"""
+    vif = """vif{i}: flags=4163<UP,BROADCAST,RUNNING,MULTICAST>  mtu 1500
+        inet 10.{a}.{b}.1  netmask 255.255.255.0  broadcast 10.{a}.{b}.255
+        ether fe:ff:ff:{a:02x}:{b:02x}:{c:02x}  txqueuelen 32  (Ethernet)
+        RX packets {i}  bytes {i}000 (0.0 B)
+        RX errors 0  dropped 0  overruns 0  frame 0
+        TX packets {i}  bytes {i}000 (0.0 B)
+        TX errors 0  dropped 0 overruns 0  carrier 0  collisions 0
+
+"""
+    return lo + "".join(vif.format(i=i, a=i // 256 % 256, b=i % 256, c=i // 65536 % 256) for i in range(1, n))
+
+def domu_name(i):
+    return "domu{:05d}".format(i)
+
+def xl_list(n):
+    '''Output of xl list, for Domain-0 and n domUs'''
+    lines = ["Name                                        ID   Mem VCPUs      State   Time(s)",
+        "Domain-0                                     0  5301     2     r-----   72726.8"]
+    for i in range(n):
+        lines.append("{:<40} {:>5} {:>5} {:>5}     -b---- {:>9.1f}".format(domu_name(i), i + 1, 256, 1, i * 10.5))
+    return "\n".join(lines) + "\n"
+
+def proc_drbd(n, version="8.4.3"):
+    '''Contents of /proc/drbd (DRBD 8.3 or 8.4), for n resources'''
+    lines = ["version: {} (api:1/proto:86-101)".format(version), "srcversion: 1A9F77B1CA5FF92235C2213 "]
+    for i in range(n):
+        lines.append(" {}: cs:Connected ro:Primary/Secondary ds:UpToDate/UpToDate C r-----".format(i))
+        lines.append("    ns:{0} nr:0 dw:{0} dr:{0} al:{1} bm:{1} lo:0 pe:0 ua:0 ap:0 ep:1 wo:f oos:0".format(i * 4096, i))
+    return "\n".join(lines) + "\n"
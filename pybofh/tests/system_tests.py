@@ -1,23 +1,133 @@
+'''System tests. They run the real commands (LVM, cryptsetup, mkfs, mount...), so they need root.
+Each test runs on a new loop device, backed by a sparse file, and cleans it up afterwards.
+They're not run automatically. Run with: python -m pybofh.tests.system_tests
+The duration of each operation (see events.py) and command (see Shell.profile) is recorded,
+and summarized when the tests end'''
+import hashlib
 import os
 import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
-import pybofh
-from pybofh import lvm, encryption, blockdevice, filesystem, mount
+from pybofh import lvm, encryption, blockdevice, filesystem, mount, events, shell
 
-if not __name__=="__main__":
-    #these tests should not be run automatically
-    unittest = lambda : None
-    unittest.TestCase = object
-
-TEST_BLOCKDEVICE= '/dev/vglocal/test_lv'
-TEST_MOUNTPOINT= '/media/tmp'
+LOSETUP= '/sbin/losetup'
+TEST_DEVICE_SIZE= 1024*1024*1024 #1GiB, sparse
 TEST_VG= 'test_vg_pybofh'
 TEST_LV= 'test_lv_pybofh'
 TEST_LV_SIZE= 500*1024*1024 #500MiB
 LUKS_KEY= '3r9b4g3v9no3'
-LUKS_KEYFILE= 'luks_test_keyfile'
 FILESYSTEM_FILL_RATE=0.8 #how much to fill up a filesystem of data for integrity tests
 
+def system_tests_available():
+    return hasattr(os, 'geteuid') and os.geteuid()==0 and os.path.exists(LOSETUP)
+
+class LoopDevice(object):
+    '''A loop device, backed by a sparse file. As a context manager:
+        with LoopDevice(size) as path:
+            ...'''
+    def __init__(self, size, directory=None):
+        self.size= size
+        self.directory= directory
+        self.file= None
+        self.path= None
+
+    def attach(self):
+        fd, self.file= tempfile.mkstemp(prefix='pybofh_loop_', dir=self.directory)
+        os.ftruncate(fd, self.size) #sparse - takes no space until written
+        os.close(fd)
+        with events.operation("attach_loop", self.file, size=self.size):
+            self.path= shell.get().check_output((LOSETUP, '--find', '--show', self.file)).strip()
+        return self.path
+
+    def detach(self):
+        if self.path:
+            with events.operation("detach_loop", self.path):
+                shell.get().check_call((LOSETUP, '--detach', self.path))
+            self.path= None
+        if self.file:
+            os.remove(self.file)
+            self.file= None
+
+    def __enter__(self):
+        return self.attach()
+
+    def __exit__(self, e_type, e_value, e_trc):
+        self.detach()
+
+class Timings(object):
+    '''The Events and CommandRecords of the tests run through record()'''
+    def __init__(self):
+        self.events= []
+        self.profile= shell.Profile()
+
+    def record(self, f):
+        with events.sink() as sink, shell.get().profile() as profile:
+            try:
+                return f()
+            finally:
+                self.events.extend(sink.events)
+                self.profile.records.extend(profile.records)
+
+    def stats(self):
+        '''Returns a dict of operation -> stats of its events (as Profile.stats)'''
+        durations= {}
+        for event in self.events:
+            durations.setdefault(event.operation, []).append(event.duration)
+        return {op: shell._duration_stats(d) for op, d in durations.items()}
+
+    def summary(self):
+        '''Returns a human readable table of stats(), slowest operations first, followed by the commands'''
+        stats= sorted(self.stats().items(), key=lambda item: item[1]['total'], reverse=True)
+        lines= ["{:<20} {:>6} {:>9} {:>9} {:>9} {:>9}".format("operation", "count", "total", "p50", "p95", "max")]
+        for op, st in stats:
+            lines.append("{:<20} {count:>6} {total:>9.3f} {p50:>9.3f} {p95:>9.3f} {max:>9.3f}".format(op, **st))
+        return "\n".join(lines) + "\n\n" + self.profile.summary()
+
+timings= Timings() #of all the tests run
+
+def _quiet_call(command):
+    '''Runs a cleanup command. Returns its exit status, or None if it isn't installed'''
+    with open(os.devnull, 'w') as null:
+        try:
+            return subprocess.call(command, stdout=null, stderr=subprocess.STDOUT)
+        except OSError:
+            return None
+
+@unittest.skipUnless(system_tests_available(), "system tests need root and losetup")
+class SystemTestCase(unittest.TestCase):
+    '''Gives each test a new loop device (device_path), a mountpoint and a LUKS key file (luks_keyfile)'''
+    def setUp(self):
+        self.dir= tempfile.mkdtemp(prefix='pybofh_system_tests_')
+        self.mountpoint= os.path.join(self.dir, 'mnt')
+        os.mkdir(self.mountpoint)
+        self.luks_keyfile= os.path.join(self.dir, 'luks_keyfile')
+        with open(self.luks_keyfile, 'w') as f:
+            f.write(LUKS_KEY)
+        self.loop= LoopDevice(TEST_DEVICE_SIZE, self.dir)
+        self.device_path= self.loop.attach()
+
+    def tearDown(self):
+        #undo whatever a failed test left behind, or the loop device can't be detached
+        if os.path.ismount(self.mountpoint):
+            _quiet_call(('umount', self.mountpoint))
+        for bd_path in (self.device_path, os.path.join('/dev', TEST_VG, TEST_LV)):
+            path= encryption.luks_path(encryption.luks_name(bd_path))
+            if os.path.exists(path):
+                _quiet_call((encryption.CRYPTSETUP, 'luksClose', path))
+        if _quiet_call(('vgs', TEST_VG))==0:
+            _quiet_call(('vgremove', '--force', TEST_VG))
+        _quiet_call(('pvremove', '--force', self.device_path))
+        self.loop.detach()
+        shutil.rmtree(self.dir)
+        lvm.vg_metadata_cache.invalidate()
+        blockdevice.data_class_cache.invalidate()
+
+    def run(self, result=None):
+        return timings.record(lambda: unittest.TestCase.run(self, result))
+
 def hash_file(file_path, hash_cls=None):
     if hash_cls is None:
         hash_cls= hashlib.sha1
@@ -58,12 +168,13 @@ def hash_dir(dir_path, base_path=None, flat=True):
         return hash_dict
 
 class FilesystemState(object):
-    def __init__(self, blockdevice_path, flat_hash=False):
+    def __init__(self, blockdevice_path, mountpoint, flat_hash=False):
         self.bd_path= blockdevice_path
+        self.mountpoint= mountpoint
         self.flat_hash= flat_hash
 
     def get_hash(self):
-        with mount.Mounted(self.bd_path, TEST_MOUNTPOINT) as mnt:
+        with mount.Mounted(self.bd_path, self.mountpoint) as mnt:
             h= hash_dir(mnt, flat=self.flat_hash)
         return h
 
@@ -98,7 +209,7 @@ class FilesystemState(object):
         import random
         import string
         total_count_size= 0
-        with mount.Mounted(self.bd_path, TEST_MOUNTPOINT) as mnt:
+        with mount.Mounted(self.bd_path, self.mountpoint) as mnt:
             while total_count_size is None or total_count_size<total_size:
                 file_size= random.randint(min_file_size, max_file_size)
                 if total_size is not None:
@@ -115,12 +226,12 @@ class FilesystemState(object):
                     raise #Uh-oh, we cannot write for some reason other than out-of-space
 
 
-class LVMTest(unittest.TestCase):
+class LVMTest(SystemTestCase):
     @staticmethod
     def _create_stack(testcase, size=TEST_LV_SIZE):
-        pv= lvm.PV(TEST_BLOCKDEVICE)
+        pv= lvm.PV(testcase.device_path)
         pv.create()
-        pv= blockdevice.BlockDevice(TEST_BLOCKDEVICE).data
+        pv= blockdevice.BlockDevice(testcase.device_path).data
         testcase.assertIsInstance(pv, lvm.PV)
         vg= pv.create_vg(TEST_VG)
         lv1= vg.create_lv(TEST_LV, size) 
@@ -161,18 +272,18 @@ class LVMTest(unittest.TestCase):
 
 
 
-class LUKSTest(unittest.TestCase):
+class LUKSTest(SystemTestCase):
     @staticmethod
     def _create_on_bd(testcase, bd, format=True):
         if format:
-            encryption.create_encrypted(bd.path, key_file=LUKS_KEYFILE, interactive=False)
+            encryption.create_encrypted(bd.path, key_file=testcase.luks_keyfile, interactive=False)
         encrypted= bd.data
         decrypted= encrypted.inner
-        decrypted.set_params(key_file=LUKS_KEYFILE)
+        decrypted.set_params(key_file=testcase.luks_keyfile)
         return encrypted, decrypted
 
     def _create(testcase, format=True):
-        bd= blockdevice.BlockDevice(TEST_BLOCKDEVICE)
+        bd= blockdevice.BlockDevice(testcase.device_path)
         encrypted, decrypted= LUKSTest._create_on_bd(testcase, bd, format)
         return bd, encrypted, decrypted
 
@@ -184,7 +295,7 @@ class LUKSTest(unittest.TestCase):
     def _check_not_accessable(testcase, decrypted):
         testcase.assertTrue(not decrypted.is_open)
         with testcase.assertRaises(Exception):
-            inner_size= inner.size
+            inner_size= decrypted.size
 
     def test_luks(self):
         bd, encrypted, decrypted= self._create()
@@ -214,11 +325,11 @@ class LUKSTest(unittest.TestCase):
         self.assertFalse(decrypted2.is_externally_open)
 
 
-class FilesystemTest(unittest.TestCase):
+class FilesystemTest(SystemTestCase):
     def test_filesystem(self):
         new_size= 500*1024*1024 #500 MB
         strange_size= 525336587 #~=501 MB, prime
-        bd= blockdevice.BlockDevice(TEST_BLOCKDEVICE)
+        bd= blockdevice.BlockDevice(self.device_path)
         fs_cls= filesystem.Ext3
 
         #create filesystem
@@ -230,7 +341,7 @@ class FilesystemTest(unittest.TestCase):
         self.assertLess(fs.size, 1*1024*1024*1024*1024) #1TB
         #fill fs with random data
         debug=False
-        fs_state= FilesystemState(bd.path, flat_hash=not debug)
+        fs_state= FilesystemState(bd.path, self.mountpoint, flat_hash=not debug)
         fs_state.fill_with_garbage(int(new_size*FILESYSTEM_FILL_RATE))
         fs_state.set_state()
 
@@ -256,9 +367,9 @@ class FilesystemTest(unittest.TestCase):
             fs.resize(strange_size, approximate=False)
         fs_state.check_unmodified()
 
-class BlockDeviceTest(unittest.TestCase):
+class BlockDeviceTest(SystemTestCase):
     def test_blockdevice_resize(self):
-        bd= blockdevice.BlockDevice( TEST_BLOCKDEVICE ) 
+        bd= blockdevice.BlockDevice( self.device_path ) 
         old_size= bd.size
         new_size= bd.size/2
         with self.assertRaises(blockdevice.Resizeable.ResizeError):
@@ -269,8 +380,8 @@ class BlockDeviceTest(unittest.TestCase):
             bd.resize( old_size/2, no_data=True )
 
 
-class BlockDeviceStackTest(unittest.TestCase):
-    DEFAULT_FILESYSTEM= filesystem.Ext3
+class BlockDeviceStackTest(SystemTestCase):
+    DEFAULT_FILESYSTEM= filesystem.Ext4
     @staticmethod
     def _create_stack(testcase, size=TEST_LV_SIZE):
         fs_cls= BlockDeviceStackTest.DEFAULT_FILESYSTEM
@@ -278,7 +389,7 @@ class BlockDeviceStackTest(unittest.TestCase):
         encrypted, decrypted= LUKSTest._create_on_bd(testcase, lv)
         with decrypted:
             fs_cls.create(decrypted.path)
-        stack= blockdevice.BlockDeviceStack(lv, key_file=LUKS_KEYFILE)
+        stack= blockdevice.BlockDeviceStack(lv, key_file=testcase.luks_keyfile)
         return stack, pv, vg, lv, decrypted
 
     @staticmethod
@@ -300,7 +411,7 @@ class BlockDeviceStackTest(unittest.TestCase):
         stack, pv, vg, lv, decrypted= BlockDeviceStackTest._create_stack(testcase, size=old_size)
         with stack as stack:
             testcase.assertEquals(stack.layer_and_data_sizes(), pre_sizes)
-            fs_state= FilesystemState(stack.innermost.path)
+            fs_state= FilesystemState(stack.innermost.path, testcase.mountpoint)
             fs_state.fill_with_garbage(int(min(new_size,old_size)*FILESYSTEM_FILL_RATE))
             fs_state.set_state()
 
@@ -329,9 +440,19 @@ class BlockDeviceStackTest(unittest.TestCase):
         BlockDeviceStackTest._test_stack_resize(self, TEST_LV_SIZE/2, TEST_LV_SIZE, pre_sizes, post_sizes)
 
 
+def benchmark(repeat=3):
+    '''Runs the BlockDeviceStack scenarios (create, open/close, resize) repeat times. Returns the timings summary'''
+    global timings
+    timings= Timings()
+    loader= unittest.TestLoader()
+    suite= unittest.TestSuite([loader.loadTestsFromTestCase(BlockDeviceStackTest) for _ in range(repeat)])
+    result= unittest.TextTestRunner(verbosity=0).run(suite)
+    if not result.wasSuccessful():
+        raise Exception("The system tests failed")
+    return timings.summary()
+
 if __name__ == '__main__':
-    assert os.path.exists(TEST_BLOCKDEVICE)
-    assert os.path.exists(TEST_MOUNTPOINT)
-    with open(LUKS_KEYFILE, 'w') as f:
-        f.write(LUKS_KEY)
-    unittest.main()
+    program= unittest.main(exit=False)
+    print
+    print timings.summary()
+    sys.exit(not program.result.wasSuccessful())
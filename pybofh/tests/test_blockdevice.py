@@ -6,28 +6,203 @@
 # pylint: disable=pointless-statement
 # pylint: disable=too-many-public-methods
 
+import json
+import os
+import os.path
+import shutil
+import subprocess
+import tempfile
 import unittest
 import mock
-from pybofh import blockdevice
+from pybofh import blockdevice, lvm
 from pybofh.tests import common
 from pybofh.tests.common import FakeDevice
 
-LSBLK_DATA = """NAME                                MAJ:MIN RM  SIZE RO TYPE  MOUNTPOINT
-sda                                   8:0    0  2.7T  0 disk  
-├─sda1                                8:1    0  1.8T  0 part  
-│ └─md0                               9:0    0  1.8T  0 raid1 
-│   ├─md0p1                         259:0    0   32G  0 md    
-│   │ ├─vg01-something00            254:14   0    8G  0 lvm   
-│   │ ├─vg01-something01            254:16   0    2G  0 lvm   
-│   │ │ └─something001              254:26   0    2G  0 crypt 
-│   │ └─vg01-something02            254:17   0    1G  0 lvm   
-│   └─md0p2                         259:1    0  1.5T  0 md    
-│     ├─vg02-something03            254:1    0    5G  0 lvm   
-└─sda2                                8:2    0    8G  0 part  
-sdb                                   8:32   1  7.5G  0 disk  
-├─sdb1                                8:33   1  121M  0 part  /home
-└─sdb5                                8:37   1  2.8G  0 part  
-  └─vg03-something04                254:0    0  2.8G  0 lvm   /media/something4
+LSBLK_DATA = """NAME                                MAJ:MIN RM          SIZE RO TYPE  MOUNTPOINT
+sda                                     8:0  0 3000592982016  0 disk  
+├─sda1                                  8:1  0 2000398934016  0 part  
+│ └─md0                                 9:0  0 2000398934016  0 raid1 
+│   ├─md0p1                           259:0  0   34359738368  0 md    
+│   │ ├─vg01-something00             254:14  0    8589934592  0 lvm   
+│   │ ├─vg01-something01             254:16  0    2147483648  0 lvm   
+│   │ │ └─something001               254:26  0    2145386496  0 crypt 
+│   │ └─vg01-something02             254:17  0    1073741824  0 lvm   
+│   └─md0p2                           259:1  0 1649267441664  0 md    
+│     ├─vg02-something03              254:1  0    5368709120  0 lvm   
+└─sda2                                  8:2  0    8589934592  0 part  
+sdb                                    8:32  1    8053063680  0 disk  
+├─sdb1                                 8:33  1     126877696  0 part  /home
+└─sdb5                                 8:37  1    3006267392  0 part  
+  └─vg03-something04                  254:0  0    3003121664  0 lvm   /media/something4
+"""
+
+LSBLK_JSON_DATA = """{
+   "blockdevices": [
+      {
+         "name": "sda",
+         "maj:min": "8:0",
+         "rm": false,
+         "size": 3000592982016,
+         "ro": false,
+         "type": "disk",
+         "mountpoint": null,
+         "children": [
+            {
+               "name": "sda1",
+               "maj:min": "8:1",
+               "rm": false,
+               "size": 2000398934016,
+               "ro": false,
+               "type": "part",
+               "mountpoint": null,
+               "children": [
+                  {
+                     "name": "md0",
+                     "maj:min": "9:0",
+                     "rm": false,
+                     "size": 2000398934016,
+                     "ro": false,
+                     "type": "raid1",
+                     "mountpoint": null,
+                     "children": [
+                        {
+                           "name": "md0p1",
+                           "maj:min": "259:0",
+                           "rm": false,
+                           "size": 34359738368,
+                           "ro": false,
+                           "type": "md",
+                           "mountpoint": null,
+                           "children": [
+                              {
+                                 "name": "vg01-something00",
+                                 "maj:min": "254:14",
+                                 "rm": false,
+                                 "size": 8589934592,
+                                 "ro": false,
+                                 "type": "lvm",
+                                 "mountpoint": null
+                              },
+                              {
+                                 "name": "vg01-something01",
+                                 "maj:min": "254:16",
+                                 "rm": false,
+                                 "size": 2147483648,
+                                 "ro": false,
+                                 "type": "lvm",
+                                 "mountpoint": null,
+                                 "children": [
+                                    {
+                                       "name": "something001",
+                                       "maj:min": "254:26",
+                                       "rm": false,
+                                       "size": 2145386496,
+                                       "ro": false,
+                                       "type": "crypt",
+                                       "mountpoint": null
+                                    }
+                                 ]
+                              },
+                              {
+                                 "name": "vg01-something02",
+                                 "maj:min": "254:17",
+                                 "rm": false,
+                                 "size": 1073741824,
+                                 "ro": false,
+                                 "type": "lvm",
+                                 "mountpoint": null
+                              }
+                           ]
+                        },
+                        {
+                           "name": "md0p2",
+                           "maj:min": "259:1",
+                           "rm": false,
+                           "size": 1649267441664,
+                           "ro": false,
+                           "type": "md",
+                           "mountpoint": null,
+                           "children": [
+                              {
+                                 "name": "vg02-something03",
+                                 "maj:min": "254:1",
+                                 "rm": false,
+                                 "size": 5368709120,
+                                 "ro": false,
+                                 "type": "lvm",
+                                 "mountpoint": null
+                              }
+                           ]
+                        }
+                     ]
+                  }
+               ]
+            },
+            {
+               "name": "sda2",
+               "maj:min": "8:2",
+               "rm": false,
+               "size": 8589934592,
+               "ro": false,
+               "type": "part",
+               "mountpoint": null
+            }
+         ]
+      },
+      {
+         "name": "sdb",
+         "maj:min": "8:32",
+         "rm": true,
+         "size": 8053063680,
+         "ro": false,
+         "type": "disk",
+         "mountpoint": null,
+         "children": [
+            {
+               "name": "sdb1",
+               "maj:min": "8:33",
+               "rm": true,
+               "size": 126877696,
+               "ro": false,
+               "type": "part",
+               "mountpoint": "/home"
+            },
+            {
+               "name": "sdb5",
+               "maj:min": "8:37",
+               "rm": true,
+               "size": 3006267392,
+               "ro": false,
+               "type": "part",
+               "mountpoint": null,
+               "children": [
+                  {
+                     "name": "vg03-something04",
+                     "maj:min": "254:0",
+                     "rm": false,
+                     "size": 3003121664,
+                     "ro": false,
+                     "type": "lvm",
+                     "mountpoint": "/media/something4"
+                  }
+               ]
+            }
+         ]
+      }
+   ]
+}
+"""
+
+# util-linux 2.25
+LSBLK_HELP_NO_JSON = """
+Usage:
+ lsblk [options] [<device> ...]
+
+Options:
+ -a, --all            print all devices
+ -b, --bytes          print SIZE in bytes rather than in human readable format
+ -l, --list           use list format output
+ -o, --output <list>  output columns
 """
 
 DMSETUP_INFO_DATA = """Name:              vg01-lv01
@@ -41,6 +216,10 @@ Number of targets: 3
 UUID: LVM-0bIWK7rs4OtKBT3YAk9qJpnSa19Yj4pbAR5j79MUV5HFIst4JF0McYNuq9avYXBC
 
 """
+MOUNTINFO_DATA = """18 1 8:33 / /home rw,relatime shared:1 - ext4 /dev/sdb1 rw
+19 1 254:0 / /media/some\\040thing4 rw,relatime shared:2 - ext4 /dev/mapper/vg03-something04 rw
+"""
+SIMPLE_MAGIC = blockdevice.Magic(8, 'SIMPLEDATA')
 # Aux classes for testing -------------------------------------------
 
 class SimpleResizeable(blockdevice.Resizeable):
@@ -186,16 +365,87 @@ class SimpleInnerLayer(blockdevice.InnerLayer):
     def _size(self):
         return self.fakedevice.size
 
+class FakeSysfs(object):
+    """A fake sysfs directory tree"""
+    def __init__(self):
+        self.root = tempfile.mkdtemp()
+        self.mountinfo = os.path.join(self.root, 'mountinfo')
+        with open(self.mountinfo, 'w') as f:
+            f.write(MOUNTINFO_DATA)
+
+    def add_device(self, kname, dev, sectors, parent=None, holders=(), dm=None, md_level=None):
+        """Adds a block device. parent is the kname of the disk, for partitions.
+        dm is a (name, uuid) tuple, for devicemapper devices."""
+        if parent:
+            dev_dir = os.path.join(self.root, 'block', parent, kname)
+        else:
+            dev_dir = os.path.join(self.root, 'block', kname)
+        files = {'dev': dev, 'size': str(sectors), 'ro': '0'}
+        if parent:
+            files['partition'] = '1'
+        if dm:
+            files['dm/name'], files['dm/uuid'] = dm
+            files['dm/suspended'] = '0'
+        if md_level:
+            files['md/level'] = md_level
+        for d in ('holders', 'slaves', 'dm' if dm else None, 'md' if md_level else None):
+            if d:
+                os.makedirs(os.path.join(dev_dir, d))
+        for name, content in files.items():
+            with open(os.path.join(dev_dir, name), 'w') as f:
+                f.write(content + '\n')
+        class_dir = os.path.join(self.root, 'class', 'block')
+        if not os.path.isdir(class_dir):
+            os.makedirs(class_dir)
+        os.symlink(dev_dir, os.path.join(class_dir, kname))
+        for holder in holders:
+            self.add_holder(kname, holder)
+
+    def add_holder(self, kname, holder):
+        dev_dir = os.path.join(self.root, 'class', 'block', kname)
+        holder_dir = os.path.join(self.root, 'class', 'block', holder)
+        os.symlink(holder_dir, os.path.join(dev_dir, 'holders', holder))
+        os.symlink(dev_dir, os.path.join(holder_dir, 'slaves', kname))
+
+    def remove(self):
+        shutil.rmtree(self.root)
+
+def create_fake_sysfs():
+    """Creates a FakeSysfs with (part of) the same devices as LSBLK_DATA"""
+    sysfs = FakeSysfs()
+    gib = 2**30 / 512
+    sysfs.add_device('sda', '8:0', 2800 * gib)
+    sysfs.add_device('sda1', '8:1', 1800 * gib, parent='sda')
+    sysfs.add_device('sda2', '8:2', 8 * gib, parent='sda')
+    sysfs.add_device('md0', '9:0', 1800 * gib, md_level='raid1')
+    sysfs.add_device('md0p1', '259:0', 32 * gib, parent='md0')
+    sysfs.add_device('dm-14', '254:14', 8 * gib, dm=('vg01-something00', 'LVM-aaa'))
+    sysfs.add_device('dm-16', '254:16', 2 * gib, dm=('vg01-something01', 'LVM-bbb'))
+    sysfs.add_device('dm-26', '254:26', 2 * gib, dm=('something001', 'CRYPT-LUKS1-ccc'))
+    sysfs.add_device('sdb', '8:32', 7 * gib)
+    sysfs.add_device('sdb1', '8:33', 1 * gib, parent='sdb')
+    sysfs.add_device('sdb5', '8:37', 3 * gib, parent='sdb')
+    sysfs.add_device('dm-0', '254:0', 3 * gib, dm=('vg03-something04', 'LVM-ddd'))
+    sysfs.add_holder('sda1', 'md0')
+    sysfs.add_holder('md0p1', 'dm-14')
+    sysfs.add_holder('md0p1', 'dm-16')
+    sysfs.add_holder('dm-16', 'dm-26')
+    sysfs.add_holder('sdb5', 'dm-0')
+    return sysfs
+
 class FakeEnvironment(common.FakeEnvironment):
     def __init__(self):
         common.FakeEnvironment.__init__(self)
-        self.shell.add_fake('/bin/lsblk', LSBLK_DATA)
+        fields = ",".join(blockdevice.LSBLK_FIELDS)
+        self.shell.add_fake(('/bin/lsblk', '--json', '--bytes', '-o', fields), LSBLK_JSON_DATA)
+        self.shell.add_fake(('/bin/lsblk', '--bytes', '-o', fields), LSBLK_DATA)
         self.shell.add_fake(('/sbin/dmsetup', 'info', '/dev/mapper/vg01-lv01'), DMSETUP_INFO_DATA)
 
 # Module level constants / vars / code  --------------------------------------
 
 blockdevice.register_data_class('SimpleData', SimpleData)
 blockdevice.register_data_class('SimpleOuterLayer', SimpleOuterLayer)
+blockdevice.register_data_class(SIMPLE_MAGIC, SimpleData, priority=True)
 
 def generic_setup(test_instance):
     '''Setups mocks'''
@@ -209,6 +459,7 @@ def generic_setup(test_instance):
         mock.patch('pybofh.blockdevice.blockdevice_from_path', new=SimpleBlockDevice),
         mock.patch('pybofh.tests.common.get_fake_environment', new=lambda: env),
         mock.patch('os.path.exists', new=env.path_exists),
+        mock.patch('pybofh.misc.read_file', new=env.read_file),
         ]
     for patch in patches:
         patch.start()
@@ -385,6 +636,47 @@ class BlockdeviceTest(unittest.TestCase):
         self.assertIn(('file', '--special', '--dereference', self.bd.path), self.env.shell.run_commands)
         self.assertIsInstance(data, SimpleData) # SimpleData is registered in this test file
 
+    def test_data_magic(self):
+        self.bd.data = None
+        self.bd.content = '\x00' * 8 + SIMPLE_MAGIC.magic
+        b = blockdevice.BlockDevice(self.bd.path)
+        with mock.patch('pybofh.misc.read_file', wraps=self.env.read_file) as read_file:
+            self.assertIsInstance(b.data, SimpleData)
+            # all the signatures are tested with a single read
+            self.assertEqual(read_file.call_count, 1)
+        self.assertNotIn(('file', '--special', '--dereference', self.bd.path), self.env.shell.run_commands)
+
+    def test_data_unreadable(self):
+        # a device whose header can't be read falls back to the file type
+        self.bd.content = None
+        b = blockdevice.BlockDevice(self.bd.path)
+        self.assertIsInstance(b.data, SimpleData)
+
+    def test_data_class_cache(self):
+        # the cache needs a path it can stat
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        bd = FakeDevice(path, SimpleData)
+        self.env.add_device(bd)
+        file_command = ('file', '--special', '--dereference', path)
+        b = blockdevice.BlockDevice(path)
+        def detections():
+            b.data
+            return self.env.shell.run_commands.count(file_command)
+        self.assertEqual(detections(), 1)
+        self.assertEqual(detections(), 1)
+        # mutating commands invalidate the cache
+        self.env.shell.add_fake(('true',), None)
+        self.env.shell.check_call(('true',))
+        self.assertEqual(detections(), 2)
+        # so do changes to the device node
+        os.utime(path, (0, 0))
+        self.assertEqual(detections(), 3)
+        self.assertEqual(detections(), 3)
+        blockdevice.data_class_cache.invalidate(path)
+        self.assertEqual(detections(), 4)
+
     def test_data_identity(self):
         # getting .data twice should return the same object
         b = blockdevice.BlockDevice(self.bd.path)
@@ -399,6 +691,33 @@ class BlockdeviceTest(unittest.TestCase):
         b = blockdevice.BlockDevice(self.bd.path)
         self.assertEqual(b.path, self.bd.path)
 
+    def test_sizes(self):
+        bd2 = FakeDevice('/dev/inexistent2', size=2*2**20)
+        self.env.add_device(bd2)
+        sizes = blockdevice.sizes([self.bd.path, bd2.path, self.bd.path])
+        self.assertEqual(sizes, {self.bd.path: self.bd.size, bd2.path: bd2.size})
+        self.assertEqual(self.env.shell.run_commands, [('/sbin/blockdev', '--getsize64', self.bd.path, bd2.path)])
+
+    def test_size_cache(self):
+        b = blockdevice.BlockDevice(self.bd.path)
+        command = ('/sbin/blockdev', '--getsize64', self.bd.path)
+        b.size
+        b.size
+        self.assertEqual(self.env.shell.run_commands.count(command), 2) # not cached outside operations
+        with blockdevice.size_cache:
+            b.size
+            with blockdevice.size_cache:
+                b.size
+            b.size
+            self.assertEqual(self.env.shell.run_commands.count(command), 3)
+            self.bd.size = 2**20
+            self.env.shell.add_fake(('touch', 'x'), '')
+            self.env.shell.check_call(('touch', 'x')) # mutating command
+            self.assertEqual(b.size, 2**20)
+            self.assertEqual(self.env.shell.run_commands.count(command), 4)
+        b.size
+        self.assertEqual(self.env.shell.run_commands.count(command), 5)
+
     def test_resize(self):
         b = blockdevice.BlockDevice(self.bd.path)
         with self.assertRaises(blockdevice.Resizeable.ResizeError):
@@ -704,6 +1023,60 @@ class BlockDeviceStackTest(unittest.TestCase):
             sizes = st.layer_and_data_sizes()
             self.assertItemsEqual(sizes, [3, 3, 2, 2, 1, 1])
 
+    def test_layer_and_data_sizes_single_query(self):
+        st = blockdevice.BlockDeviceStack(self.l0.path)
+        with st:
+            n_commands = len(self.env.shell.run_commands)
+            st.layer_and_data_sizes()
+            blockdev_commands = [c for c in self.env.shell.run_commands[n_commands:] if c[0] == '/sbin/blockdev']
+            self.assertEqual(blockdev_commands, [('/sbin/blockdev', '--getsize64', self.l0.path, self.l1.path, self.l2.path)])
+
+class PVStackTest(unittest.TestCase):
+    '''A stack whose innermost data is a LVM PV, which only uses whole extents of its device'''
+    EXTENT = 4 * 2**20
+    PE_START = 2**20
+
+    def setUp(self):
+        generic_setup(self)
+        self.pv_size = None # as set by pvresize --setphysicalvolumesize
+        # before the devices, whose fakes match any command with their path
+        self.env.shell.add_fake_binary('/sbin/pvs', self.pvs)
+        self.env.shell.add_fake_binary('/sbin/pvresize', self.pvresize)
+        self.l0 = FakeDevice('/dev/inexistent_l0', SimpleOuterLayer, size=self.PE_START + 100 * self.EXTENT + 5 * 512)
+        self.l1 = FakeDevice('/dev/inexistent_l1', content='\x00' * 512 + '\x00' * 24 + 'LVM2 001', parent=self.l0, size=self.l0.size)
+        self.env.add_device(self.l0)
+        self.env.add_device(self.l1)
+        mock.patch('pybofh.blockdevice.InnerLayer._externally_open_data', return_value=None).start()
+
+    def tearDown(self):
+        mock.patch.stopall()
+
+    def pvs(self, command):
+        dev_size = self.l1.size
+        pe_count = ((self.pv_size or dev_size) - self.PE_START) // self.EXTENT
+        values = {"pv_name": self.l1.path, "vg_name": "vg", "dev_size": dev_size, "pv_size": pe_count * self.EXTENT, "pv_free": 0,
+            "pe_start": self.PE_START, "pv_pe_count": pe_count, "pv_pe_alloc_count": 0, "vg_extent_size": self.EXTENT}
+        row = {field: str(values.get(field, "")) for field in lvm.PV_FIELDS}
+        return json.dumps({"report": [{"pv": [row]}]})
+
+    def pvresize(self, command):
+        self.pv_size = int(command[2][:-1]) if command[1] == '--setphysicalvolumesize' else None
+
+    def test_open(self):
+        st = blockdevice.BlockDeviceStack(self.l0.path)
+        with st:
+            self.assertIsInstance(st.innermost.data, lvm.PV)
+            self.assertEqual(st.layer_and_data_sizes(), [self.l0.size] * 3 + [self.PE_START + 100 * self.EXTENT])
+
+    def test_resize(self):
+        st = blockdevice.BlockDeviceStack(self.l0.path)
+        with st:
+            # the PV rounds down to whole extents when growing...
+            st.resize(self.PE_START + 200 * self.EXTENT + 1024)
+            self.assertEqual(st.layer_and_data_sizes(), [self.PE_START + 200 * self.EXTENT + 1024] * 3 + [self.PE_START + 200 * self.EXTENT])
+            # when shrinking, the device fits it exactly
+            st.resize(self.PE_START + 50 * self.EXTENT)
+            self.assertEqual(st.layer_and_data_sizes(), [self.PE_START + 50 * self.EXTENT] * 4)
 
 class ModuleTest(unittest.TestCase):
     def setUp(self):
@@ -724,7 +1097,7 @@ class ModuleTest(unittest.TestCase):
         self.assertEqual(node1.name, 'vg01-something01')
         self.assertEqual(node1.major, 254)
         self.assertEqual(node1.minor, 16)
-        self.assertEqual(node1.size, '2G')
+        self.assertEqual(node1.size, 2 * 2**30)
         self.assertEqual(node1.type, 'lvm')
         self.assertEqual(node1.mountpoint, None)
         self.assertEqual(node1.ro, False)
@@ -732,6 +1105,101 @@ class ModuleTest(unittest.TestCase):
         node2 = node.find_node('sdb1')
         self.assertEqual(node2.mountpoint, '/home')
 
+    def test_lsblk_text(self):
+        def unsupported(command):
+            raise subprocess.CalledProcessError(1, command)
+        json_command = ('/bin/lsblk', '--json', '--bytes', '-o', ','.join(blockdevice.LSBLK_FIELDS))
+        self.env.shell.remove_fake(json_command)
+        self.env.shell.add_fake(json_command, unsupported)
+        self.env.shell.add_fake(('/bin/lsblk', '--help'), LSBLK_HELP_NO_JSON)
+        text_tree = blockdevice.lsblk()
+        self.assertEqual(self.env.shell.run_commands.count(json_command), 1)
+        # lsblk --json isn't retried
+        blockdevice.topology_cache.invalidate()
+        blockdevice.lsblk()
+        self.assertEqual(self.env.shell.run_commands.count(json_command), 1)
+        # text and json trees are the same
+        json_tree = blockdevice._parse_lsblk_json(LSBLK_JSON_DATA)
+        def node_tuple(node):
+            return node.name, node.major, node.minor, node.size, node.ro, node.type, node.mountpoint, node.parent.name
+        text_nodes = [node_tuple(node) for node in list(text_tree.iterate())[1:]]
+        json_nodes = [node_tuple(node) for node in list(json_tree.iterate())[1:]]
+        self.assertEqual(len(text_nodes), 15)
+        self.assertEqual(text_nodes, json_nodes)
+
+    def test_lsblk_json_failure(self):
+        # a lsblk that supports --json, failing for some other reason
+        def fail(command):
+            raise subprocess.CalledProcessError(1, command)
+        json_command = ('/bin/lsblk', '--json', '--bytes', '-o', ','.join(blockdevice.LSBLK_FIELDS))
+        self.env.shell.remove_fake(json_command)
+        self.env.shell.add_fake(json_command, fail)
+        self.env.shell.add_fake(('/bin/lsblk', '--help'), LSBLK_HELP_NO_JSON + " -J, --json           use JSON output format\n")
+        with self.assertRaises(subprocess.CalledProcessError):
+            blockdevice.lsblk()
+        # --json is still used afterwards
+        self.env.shell.remove_fake(json_command)
+        self.env.shell.add_fake(json_command, LSBLK_JSON_DATA)
+        blockdevice.topology_cache.invalidate()
+        blockdevice.lsblk()
+        self.assertEqual(self.env.shell.run_commands.count(json_command), 2)
+
+    def test_parse_lsblk_json_strings(self):
+        # util-linux < 2.33 outputs all values as strings
+        output = '''{"blockdevices": [{"name": "sda", "maj:min": "8:0", "rm": "0", "size": "1024", "ro": "1", "type": "disk", "mountpoint": null}]}'''
+        node = blockdevice._parse_lsblk_json(output).children[0]
+        self.assertEqual(node.size, 1024)
+        self.assertEqual(node.ro, True)
+
+    def test_lsblk_lookups(self):
+        root = blockdevice.lsblk()
+        self.assertIsInstance(root, blockdevice.LsblkTree)
+        node = root.find_node('vg01-something01')
+        self.assertTrue(root.find_devno(254, 16) is node)
+        self.assertTrue(root.find_devno('254', '16') is node)
+        self.assertTrue(root.find_path('/dev/mapper/vg01-something01') is node)
+        self.assertTrue(root.find_path('/dev/sdb1') is root.find_node('sdb1'))
+        self.assertEqual(root.find_node('xxx', return_one=False), ())
+        with self.assertRaises(blockdevice.LsblkNode.NodeNotFound):
+            root.find_node('xxx')
+        with self.assertRaises(blockdevice.LsblkNode.NodeNotFound):
+            root.find_devno(1, 1)
+        with self.assertRaises(blockdevice.LsblkNode.NodeNotFound):
+            root.find_path('/dev/xxx')
+        # non-root nodes only search their subtree
+        sda = root.find_node('sda')
+        self.assertTrue(sda.find_node('vg01-something01') is node)
+        self.assertEqual(sda.find_node('sdb1', return_one=False), ())
+
+    def test_lsblk_cache(self):
+        lsblk_command = ('/bin/lsblk', '--json', '--bytes', '-o', ','.join(blockdevice.LSBLK_FIELDS))
+        # nothing is cached outside of operations - sizes can change without anything telling
+        node = blockdevice.lsblk()
+        self.assertFalse(blockdevice.lsblk() is node)
+        self.assertEqual(self.env.shell.run_commands.count(lsblk_command), 2)
+        self.env.shell.clear_run_commands()
+        with blockdevice.size_cache:
+            node = blockdevice.lsblk()
+            self.assertTrue(blockdevice.lsblk() is node)
+            self.assertEqual(self.env.shell.run_commands.count(lsblk_command), 1)
+            # a mutating command invalidates the cache
+            self.env.shell.add_fake(('touch', 'x'), '')
+            self.env.shell.check_call(('touch', 'x'))
+            self.assertFalse(blockdevice.lsblk() is node)
+            self.assertEqual(self.env.shell.run_commands.count(lsblk_command), 2)
+            # a query doesn't
+            self.env.shell.check_output(('touch', 'x'))
+            blockdevice.lsblk()
+            self.assertEqual(self.env.shell.run_commands.count(lsblk_command), 2)
+            # explicit invalidation
+            blockdevice.topology_cache.invalidate()
+            blockdevice.lsblk()
+            self.assertEqual(self.env.shell.run_commands.count(lsblk_command), 3)
+        # the next operation queries it again
+        with blockdevice.size_cache:
+            blockdevice.lsblk()
+        self.assertEqual(self.env.shell.run_commands.count(lsblk_command), 4)
+
     def test_devicemapper_info(self):
         with mock.patch('os.path.exists', new=lambda path: True):
             info = blockdevice.devicemapper_info('/dev/mapper/vg01-lv01')
@@ -739,6 +1207,10 @@ class ModuleTest(unittest.TestCase):
             self.assertEqual(info['Name'], 'vg01-lv01')
             self.assertEqual(info['UUID'], 'LVM-0bIWK7rs4OtKBT3YAk9qJpnSa19Yj4pbAR5j79MUV5HFIst4JF0McYNuq9avYXBC')
             self.assertEqual(info['Open count'], 1)
+            with blockdevice.size_cache:
+                blockdevice.devicemapper_info('/dev/mapper/vg01-lv01')
+                blockdevice.devicemapper_info('/dev/mapper/vg01-lv01')
+            self.assertEqual(len(self.env.shell.run_commands), 2) # cached during the operation
 
     def test_get_blockdevice_child(self):
         # uses LSBLK_DATA
@@ -751,6 +1223,72 @@ class ModuleTest(unittest.TestCase):
                 blockdevice.get_blockdevice_child('xxxsda1')
             child = blockdevice.get_blockdevice_child('md0p2')
             self.assertEqual(child, '/dev/mapper/vg02-something03')
+            # lookups by device path don't need dmsetup
+            with blockdevice.size_cache:
+                blockdevice.lsblk()
+                commands = len(self.env.shell.run_commands)
+                child = blockdevice.get_blockdevice_child('/dev/mapper/vg01-something01')
+            self.assertEqual(child, '/dev/mapper/something001')
+            self.assertEqual(len(self.env.shell.run_commands), commands)
+
+class SysfsTopologyTest(unittest.TestCase):
+    def setUp(self):
+        self.sysfs = create_fake_sysfs()
+        self.topology = blockdevice.SysfsTopology(self.sysfs.root, self.sysfs.mountinfo)
+
+    def tearDown(self):
+        self.sysfs.remove()
+        mock.patch.stopall()
+
+    def test_lsblk(self):
+        root = self.topology.lsblk()
+        self.assertEqual([c.name for c in root.children], ['sda', 'sdb'])
+        self.assertEqual(len(list(root.iterate())), 12 + 1)
+        node = root.find_node('vg01-something01')
+        self.assertEqual((node.major, node.minor), (254, 16))
+        self.assertEqual(node.size, 2 * 2**30)
+        self.assertEqual(node.type, 'lvm')
+        self.assertEqual(node.ro, False)
+        self.assertEqual(node.parent.name, 'md0p1')
+        self.assertEqual(node.parent.type, 'md')
+        self.assertEqual(node.parent.parent.type, 'raid1')
+        self.assertEqual(node.parent.parent.parent.name, 'sda1')
+        self.assertEqual(node.parent.parent.parent.type, 'part')
+        self.assertEqual([c.name for c in node.children], ['something001'])
+        self.assertEqual(node.children[0].type, 'crypt')
+        self.assertEqual(root.find_node('sdb1').mountpoint, '/home')
+        self.assertEqual(root.find_node('vg03-something04').mountpoint, '/media/some thing4')
+        self.assertEqual(root.find_node('sda2').mountpoint, None)
+
+    def test_devicemapper_info(self):
+        info = self.topology.devicemapper_info('/dev/dm-16')
+        self.assertEqual(info['Major, minor'], '254, 16')
+        self.assertEqual(info['Name'], 'vg01-something01')
+        self.assertEqual(info['UUID'], 'LVM-bbb')
+        self.assertEqual(info['State'], 'ACTIVE')
+        # /dev/mapper device node, instead of a symlink
+        info = self.topology.devicemapper_info('/dev/mapper/vg01-something01')
+        self.assertEqual(info['Name'], 'vg01-something01')
+        with self.assertRaises(Exception):
+            self.topology.devicemapper_info('/dev/sda1')
+
+    def test_size(self):
+        self.assertEqual(self.topology.size('/dev/sda2'), 8 * 2**30)
+        self.assertEqual(self.topology.size('/dev/mapper/vg01-something01'), 2 * 2**30)
+
+    def test_provider_setting(self):
+        shell = mock.Mock(generation=0)
+        mock.patch('pybofh.shell.get', return_value=shell).start()
+        with blockdevice.settings.change(topology_provider='sysfs', sysfs_root=self.sysfs.root):
+            node = blockdevice.lsblk().find_node('vg01-something01')
+            self.assertEqual(node.size, 2 * 2**30)
+            with mock.patch('os.path.exists', new=lambda path: True):
+                self.assertEqual(blockdevice.devicemapper_info('/dev/dm-0')['Name'], 'vg03-something04')
+            self.assertEqual(blockdevice.size('/dev/sdb5'), 3 * 2**30)
+        self.assertFalse(shell.check_output.called)
+        with blockdevice.settings.change(topology_provider='xyz'):
+            with self.assertRaises(ValueError):
+                blockdevice.lsblk()
 
 if __name__ == '__main__':
     unittest.main()
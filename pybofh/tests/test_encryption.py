@@ -16,7 +16,6 @@ class FakeEnvironment(common.FakeEnvironment):
     def __init__(self):
         common.FakeEnvironment.__init__(self)
         self.shell.add_fake_binary("/sbin/cryptsetup", self.cryptsetup)
-        self.shell.add_fake_binary("/sbin/blockdev", self.blockdev)
 
     def cryptsetup(self, command):
         """Implements a fake cryptsetup command"""
@@ -50,16 +49,6 @@ class FakeEnvironment(common.FakeEnvironment):
         else:
             raise Exception("Unimplemented cryptsetup fake command: {}".format(command))
 
-    def blockdev(self, command):
-        """Implements the blockdev fake command"""
-        assert command[0].endswith("blockdev")
-        if command[1] != "--getsize64" or len(command) != 3:
-            raise NotImplementedError
-        device = self.get_device(command[2])
-        if not device:
-            raise Exception("FakeDevice not found for path: {}".format(command[2]))
-        return device.size
-
 def generic_setup(test_instance):
     """Setups mocks"""
     # pylint: disable=unnecessary-lambda, star-args
@@ -170,6 +159,10 @@ class ModuleTest(unittest.TestCase):
     def tearDown(self):
         mock.patch.stopall()
 
+    def test_data_class(self):
+        self.bd.content = LUKS_HEADER
+        self.assertEqual(blockdevice.get_data_class_for(self.bd), encryption.Encrypted)
+
     def test_create_encrypted(self):
         encryption.create_encrypted(self.bd.path)
         self.assertEqual(self.env.shell.run_commands[-1], ("/sbin/cryptsetup", "luksFormat", "/dev/something"))
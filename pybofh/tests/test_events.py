@@ -0,0 +1,68 @@
+import threading
+import unittest
+import mock
+
+from pybofh import events
+
+class EventsTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(events, "log")
+        self.log = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_operation(self):
+        with events.sink() as s:
+            with events.operation("create_lv", "vg/lv", size="1G"):
+                pass
+            with self.assertRaises(ValueError):
+                with events.operation("remove_lv", "vg/lv"):
+                    raise ValueError()
+        with events.operation("remove_lv", "vg/other"):
+            pass # not on the sink
+        self.assertEqual(len(s.events), 2)
+        event = s.events[0]
+        self.assertEqual((event.operation, event.target, event.result), ("create_lv", "vg/lv", events.OK))
+        self.assertEqual(event.details, {"size": "1G"})
+        self.assertGreaterEqual(event.duration, 0)
+        self.assertEqual(s.events[1].result, "ValueError")
+        self.assertEqual(s.failures(), [s.events[1]])
+        self.assertEqual(s.counts(), {"create_lv": 1, "remove_lv": 1})
+        self.assertEqual(self.log.info.call_count, 3)
+        self.assertIs(self.log.info.call_args[1]["extra"]["event"].target, "vg/other")
+
+    def test_str(self):
+        event = events.Event("mount", "/dev/x", 0.5, events.OK, {"mountpoint": "/mnt"})
+        self.assertEqual(str(event), "mount /dev/x: ok in 0.500s mountpoint=/mnt")
+
+    def test_batch(self):
+        with events.sink() as s:
+            with events.batch("provision") as b:
+                for i in range(3):
+                    with events.operation("create_lv", "vg/lv{}".format(i)):
+                        pass
+        self.assertEqual(len(b.events), 3)
+        self.assertEqual(self.log.debug.call_count, 3)
+        self.assertEqual(self.log.info.call_count, 1) # only the summary
+        summary = self.log.info.call_args[1]["extra"]["event"]
+        self.assertEqual((summary.operation, summary.target, summary.result), ("batch", "provision", events.OK))
+        self.assertEqual(summary.details, {"create_lv": 3, "failed": 0})
+        self.assertEqual(len(s.events), 4) # sinks get the details too
+
+    def test_batch_failure(self):
+        with self.assertRaises(ValueError):
+            with events.batch("provision"):
+                with events.operation("create_lv", "vg/lv"):
+                    raise ValueError()
+        summary = self.log.info.call_args[1]["extra"]["event"]
+        self.assertEqual(summary.result, "ValueError")
+        self.assertEqual(summary.details["failed"], 1)
+
+    def test_batch_per_thread(self):
+        def other_thread():
+            with events.operation("mount", "/dev/x"):
+                pass
+        with events.batch("provision") as b:
+            t = threading.Thread(target=other_thread)
+            t.start()
+            t.join()
+        self.assertEqual(b.events, [])
@@ -1,11 +1,19 @@
 '''Tests for filesystem.py'''
 
+import struct
 import unittest
 import mock
+from pybofh import blockdevice
 from pybofh import filesystem
 from pybofh.tests import common
 from pybofh.tests.common import FakeDevice
 
+def ext_header(compat=0, incompat=0, ro_compat=0):
+    '''Builds the start of a device with a ext superblock with the given feature flags'''
+    header = '\x00' * 1080 + '\x53\xef'
+    header += '\x00' * (1116 - len(header))
+    return header + struct.pack('<III', compat, incompat, ro_compat) + '\x00' * 128
+
 def generic_setup(test_instance):
     '''Setups mocks'''
     env = test_instance.env = common.FakeEnvironment()
@@ -16,6 +24,7 @@ def generic_setup(test_instance):
     patches = [
         mock.patch("os.path.exists", env.path_exists),
         mock.patch("pybofh.shell.get", lambda: env.shell),
+        mock.patch("pybofh.misc.read_file", env.read_file),
         ]
     for patch in patches:
         patch.start()
@@ -91,5 +100,23 @@ class ModuleTest(unittest.TestCase):
     def tearDown(self):
         mock.patch.stopall()
 
+    def test_ext_version(self):
+        self.assertEqual(filesystem.ext_version(ext_header()), 2)
+        self.assertEqual(filesystem.ext_version(ext_header(compat=0x3c)), 3)
+        self.assertEqual(filesystem.ext_version(ext_header(compat=0x3c, incompat=0x2c2)), 4)
+        self.assertEqual(filesystem.ext_version(ext_header(compat=0x3c, incompat=0x2, ro_compat=0x8)), 4)
+        # mkfs.ext4 -O ^has_journal: "file" says ext2
+        self.assertEqual(filesystem.ext_version(ext_header(compat=0x38, incompat=0x2c2, ro_compat=0x46b)), 2)
+
+    def test_data_class(self):
+        self.bd.content = ext_header(compat=0x3c, incompat=0x2c2)
+        self.assertEqual(blockdevice.get_data_class_for(self.bd), filesystem.Ext4)
+        self.bd.content = ext_header(compat=0x3c)
+        self.assertEqual(blockdevice.get_data_class_for(self.bd), filesystem.Ext3)
+        self.bd.content = ext_header(compat=0x38, incompat=0x2c2, ro_compat=0x46b) # ext4 without a journal
+        self.assertEqual(blockdevice.get_data_class_for(self.bd), filesystem.Ext2)
+        self.bd.content = ext_header()[:1100] # truncated superblock
+        self.assertNotIn(blockdevice.get_data_class_for(self.bd), (filesystem.Ext2, filesystem.Ext3, filesystem.Ext4))
+
 if __name__ == "__main__":
     unittest.main()
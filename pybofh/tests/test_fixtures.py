@@ -0,0 +1,61 @@
+'''Tests for fixtures.py: the generated outputs are parsed by the pybofh parsers'''
+import unittest
+from StringIO import StringIO
+import mock
+
+from pybofh import blockdevice, interfaces, lvm, xen
+from pybofh.drbd import proc_parser
+from pybofh.shell import FakeShell
+from pybofh.tests import fixtures
+
+N = 50
+
+class FixturesTest(unittest.TestCase):
+    def test_lvm_reports(self):
+        lvs = lvm._parse_report(fixtures.lvs_report(N, vgs=3), 'lv', lvm.LVRecord)
+        self.assertEqual(len(lvs), N)
+        self.assertEqual(len(set(lv.lv_uuid for lv in lvs)), N)
+        self.assertEqual(len(set(lv.vg_name for lv in lvs)), 3)
+        self.assertEqual(lvs[0].lv_size, fixtures.LV_EXTENTS * fixtures.EXTENT_SIZE)
+        vgs = lvm._parse_report(fixtures.vgs_report(N), 'vg', lvm.VGRecord)
+        self.assertEqual(len(vgs), N)
+        pvs = lvm._parse_report(fixtures.pvs_report(N), 'pv', lvm.PVRecord)
+        self.assertEqual(len(set(pv.pv_name for pv in pvs)), N)
+
+    def test_lsblk(self):
+        for n in (1, 2, 3, N):
+            json_tree = blockdevice._parse_lsblk_json(fixtures.lsblk_json(n))
+            text_tree = blockdevice._parse_lsblk_text(fixtures.lsblk_text(n))
+            def node_tuple(node):
+                return node.name, node.major, node.minor, node.size, node.ro, node.type, node.mountpoint, node.parent.name
+            json_nodes = [node_tuple(node) for node in list(json_tree.iterate())[1:]]
+            text_nodes = [node_tuple(node) for node in list(text_tree.iterate())[1:]]
+            self.assertEqual(len(json_nodes), n)
+            self.assertEqual(json_nodes, text_nodes)
+            self.assertEqual(len(set((t[1], t[2]) for t in json_nodes)), n) # unique device numbers
+
+    def test_dmsetup_info(self):
+        shell = FakeShell()
+        shell.add_fake_binary('/sbin/dmsetup', lambda command: fixtures.dmsetup_info(7))
+        with mock.patch('pybofh.shell.get', return_value=shell):
+            info = blockdevice._devicemapper_info('/dev/mapper/x')
+        self.assertEqual(info['Major, minor'], '253, 7')
+        self.assertEqual(info['Name'], 'vg000-lv00007')
+
+    def test_ifconfig(self):
+        shell = FakeShell()
+        shell.add_fake((interfaces.IFCONFIG, '-a'), fixtures.ifconfig(N))
+        with mock.patch('pybofh.shell.get', return_value=shell):
+            itfs = interfaces.ifconfig()
+        self.assertEqual(len(itfs), N)
+        self.assertEqual(len(set(itf.mac for itf in itfs[1:])), N - 1)
+
+    def test_xl_list(self):
+        names = xen._parse_xl_list(fixtures.xl_list(N))
+        self.assertEqual(names, [fixtures.domu_name(i) for i in range(N)])
+
+    def test_proc_drbd(self):
+        for version in ("8.3.0", "8.4.3"):
+            v, resources = proc_parser.parse_proc_drbd(StringIO(fixtures.proc_drbd(N, version)))
+            self.assertEqual(v, version)
+            self.assertEqual(len(resources), N)
@@ -0,0 +1,47 @@
+'''Tests for lazy.py, and the lazy loading of the pybofh packages'''
+import subprocess
+import sys
+import unittest
+
+import pybofh
+from pybofh import lazy
+
+def loaded_modules(statements):
+    '''Runs statements on a new python process. Returns the pybofh modules loaded'''
+    code = statements + "\nimport sys\nprint ' '.join(m for m in sys.modules if m.startswith('pybofh') and sys.modules[m])"
+    return subprocess.check_output((sys.executable, "-c", code)).split()
+
+class LazyPackageTest(unittest.TestCase):
+    def test_import(self):
+        modules = loaded_modules("import pybofh")
+        self.assertItemsEqual(modules, ["pybofh", "pybofh.lazy"])
+
+    def test_submodule(self):
+        modules = loaded_modules("import pybofh.drbd.proc_parser")
+        self.assertItemsEqual(modules, ["pybofh", "pybofh.lazy", "pybofh.drbd", "pybofh.drbd.proc_parser"])
+
+    def test_attribute_access(self):
+        modules = loaded_modules("import pybofh\npybofh.lvm")
+        self.assertIn("pybofh.lvm", modules)
+        self.assertNotIn("pybofh.xen", modules)
+
+    def test_data_classes_on_detection(self):
+        modules = loaded_modules("import pybofh.blockdevice")
+        self.assertNotIn("pybofh.encryption", modules)
+        modules = loaded_modules("import pybofh.blockdevice\npybofh.blockdevice._load_data_class_modules()")
+        self.assertIn("pybofh.encryption", modules)
+
+    def test_attributes(self):
+        from pybofh import AtomicContext
+        from pybofh.atomic_operations import AtomicContext as original
+        self.assertIs(AtomicContext, original)
+        from pybofh.drbd import Resource
+        from pybofh.drbd.classes import Resource as original
+        self.assertIs(Resource, original)
+        self.assertIn("lvm", dir(pybofh))
+        with self.assertRaises(AttributeError):
+            pybofh.nonexistent
+
+    def test_lazy_package(self):
+        self.assertIsInstance(pybofh, lazy.LazyPackage)
+        self.assertIs(sys.modules["pybofh"], pybofh)
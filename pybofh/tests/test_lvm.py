@@ -2,8 +2,15 @@
 # pylint: disable=no-member
 # pylint: disable=no-self-use
 
+import json
+import os
+import stat
+import subprocess
+import tempfile
 import unittest
 import mock
+from pybofh import blockdevice
+from pybofh import events
 from pybofh import lvm
 from pybofh.shell import FakeShell
 
@@ -11,73 +18,118 @@ PV = '/dev/in1'
 VG = 'in_vg'
 LV = 'in_lv'
 
-PVDISPLAY_DATA = '''  --- Physical volume ---
-  PV Name               /dev/in1
-  VG Name               in_vg
-  PV Size               2.79 GiB / not usable 4.00 MiB
-  Allocatable           yes (but full)
-  PE Size               4.00 MiB
-  Total PE              714
-  Free PE               0
-  Allocated PE          714
-  PV UUID               EvbqlT-AUsZ-MfKi-ZSOz-Lh6L-Y3xC-KiLcYx
-   
+PVS_DATA = '''  {
+      "report": [
+          {
+              "pv": [
+                  {"pv_name":"/dev/in1", "vg_name":"in_vg", "pv_uuid":"EvbqlT-AUsZ-MfKi-ZSOz-Lh6L-Y3xC-KiLcYx", "dev_size":"2998927360", "pv_size":"2994733056", "pv_free":"0", "pe_start":"1048576", "pv_pe_count":"714", "pv_pe_alloc_count":"714", "vg_extent_size":"4194304"}
+              ]
+          }
+      ]
+  }
 '''
 
-VGDISPLAY_DATA = '''  --- Volume group ---
-  VG Name               in_vg
-  System ID             
-  Format                lvm2
-  Metadata Areas        2
-  Metadata Sequence No  13
-  VG Access             read/write
-  VG Status             resizable
-  MAX LV                0
-  Cur LV                1
-  Open LV               0
-  Max PV                0
-  Cur PV                1
-  Act PV                1
-  VG Size               107.88 GiB
-  PE Size               4.00 MiB
-  Total PE              27616
-  Alloc PE / Size       25318 / 98.90 GiB
-  Free  PE / Size       2298 / 8.98 GiB
-  VG UUID               jWIQCX-uxUT-aG1x-1tpc-1Ixk-pxw2-gL6mlJ
+ORPHAN_PVS_DATA = '''  {
+      "report": [
+          {
+              "pv": [
+                  {"pv_name":"/dev/in1", "vg_name":"", "pv_uuid":"EvbqlT-AUsZ-MfKi-ZSOz-Lh6L-Y3xC-KiLcYx", "dev_size":"2998927360", "pv_size":"2998927360", "pv_free":"2998927360", "pe_start":"1048576", "pv_pe_count":"0", "pv_pe_alloc_count":"0", "vg_extent_size":"0"}
+              ]
+          }
+      ]
+  }
+'''
+
+PVSEG_DATA = '''  {
+      "report": [
+          {
+              "pvseg": [
+                  {"pv_name":"/dev/in1", "vg_name":"in_vg", "vg_extent_size":"4194304", "pvseg_start":"0", "pvseg_size":"600", "lv_name":"in_lv"},
+                  {"pv_name":"/dev/in1", "vg_name":"in_vg", "vg_extent_size":"4194304", "pvseg_start":"600", "pvseg_size":"400", "lv_name":""},
+                  {"pv_name":"/dev/in2", "vg_name":"in_vg", "vg_extent_size":"4194304", "pvseg_start":"0", "pvseg_size":"300", "lv_name":""},
+                  {"pv_name":"/dev/in2", "vg_name":"in_vg", "vg_extent_size":"4194304", "pvseg_start":"300", "pvseg_size":"200", "lv_name":"other_lv"},
+                  {"pv_name":"/dev/in2", "vg_name":"in_vg", "vg_extent_size":"4194304", "pvseg_start":"500", "pvseg_size":"500", "lv_name":""},
+                  {"pv_name":"/dev/other1", "vg_name":"other_vg", "vg_extent_size":"4194304", "pvseg_start":"0", "pvseg_size":"1000", "lv_name":""}
+              ]
+          }
+      ]
+  }
+'''
+
+VGS_DATA = '''  {
+      "report": [
+          {
+              "vg": [
+                  {"vg_name":"in_vg", "vg_uuid":"jWIQCX-uxUT-aG1x-1tpc-1Ixk-pxw2-gL6mlJ", "vg_size":"115829587968", "vg_free":"9638510592", "vg_extent_size":"4194304", "vg_extent_count":"27616", "vg_free_count":"2298", "lv_count":"1", "pv_count":"1", "vg_seqno":"13"}
+              ]
+          }
+      ]
+  }
+'''
 
+LVS_DATA = '''  {
+      "report": [
+          {
+              "lv": [
+                  {"lv_name":"in_lv", "vg_name":"in_vg", "lv_path":"/dev/in_vg/in_lv", "lv_uuid":"wgA7Jd-cve5-eK2K-OcUk-yZ43-vvbw-diT892", "lv_size":"15997075456", "lv_attr":"-wi-ao----", "seg_count":"1", "segtype":"linear", "pool_lv":"", "origin":"", "data_percent":"", "metadata_percent":""}
+              ]
+          }
+      ]
+  }
 '''
 
-LVDISPLAY_DATA = '''  --- Logical volume ---
-  LV Path                /dev/in_vg/in_lv
-  LV Name                in_lv
-  VG Name                in_vg
-  LV UUID                wgA7Jd-cve5-eK2K-OcUk-yZ43-vvbw-diT892
-  LV Write Access        read/write
-  LV Creation host, time hostname, 2011-11-19 11:28:13 +0000
-  LV Status              available
-  # open                 1
-  LV Size                14.90 GiB
-  Current LE             3814
-  Segments               1
-  Allocation             inherit
-  Read ahead sectors     auto
-  - currently set to     256
-  Block device           253:1
-   
+# emulates "lvm shell": echoes commands in a JSON report, and fails those named "fail"
+FAKE_LVM_SHELL = '''#!/bin/sh
+[ "$1" = shell ] || exit 1
+printf 'lvm> '
+while read -r cmd rest; do
+    log_type=status
+    case "$cmd" in
+        fail) code=5 ;;
+        nostatus) code=1; log_type=print ;;
+        *) code=1 ;;
+    esac
+    printf '  {\\n      "report": [{"echo": "%s %s"}]\\n      ,\\n      "log": [\\n          {"log_type":"print", "log_ret_code":"0"},\\n          {"log_type":"%s", "log_ret_code":"%s"}\\n      ]\\n  }\\n' "$cmd" "$rest" "$log_type" "$code"
+    printf 'lvm> '
+done
 '''
 
-def command_side_effect(command):
-    if command == '/sbin/vgdisplay':
-        return VGDISPLAY_DATA
-    if command == '/sbin/lvdisplay':
-        return LVDISPLAY_DATA
-    return mock.DEFAULT
+THIN_LVS_DATA = '''  {
+      "report": [
+          {
+              "lv": [
+                  {"lv_name":"pool", "vg_name":"in_vg", "lv_path":"", "lv_uuid":"Jd4oSK-4UZy-7Jvq-mLdG-Mcb5-p1vM-0QnHx5", "lv_size":"10737418240", "lv_attr":"twi-aotz--", "seg_count":"1", "segtype":"thin-pool", "pool_lv":"", "origin":"", "data_percent":"12.50", "metadata_percent":"3.05"},
+                  {"lv_name":"thin1", "vg_name":"in_vg", "lv_path":"/dev/in_vg/thin1", "lv_uuid":"h3y2Rz-6Tzr-Ii6R-x8Qy-1Xbm-jtSA-Ug7c3A", "lv_size":"21474836480", "lv_attr":"Vwi-a-tz--", "seg_count":"1", "segtype":"thin", "pool_lv":"pool", "origin":"", "data_percent":"6.25", "metadata_percent":""},
+                  {"lv_name":"thin1_snap", "vg_name":"in_vg", "lv_path":"/dev/in_vg/thin1_snap", "lv_uuid":"tK1eXz-PzU3-ExBg-D0oN-7jGU-2ZlR-q9TQgw", "lv_size":"21474836480", "lv_attr":"Vwi-a-tz--", "seg_count":"1", "segtype":"thin", "pool_lv":"pool", "origin":"thin1", "data_percent":"6.25", "metadata_percent":""}
+              ]
+          }
+      ]
+  }
+'''
+
+SNAPSHOT_LVS_DATA = '''  {
+      "report": [
+          {
+              "lv": [
+                  {"lv_name":"in_lv", "vg_name":"in_vg", "lv_path":"/dev/in_vg/in_lv", "lv_uuid":"wgA7Jd-cve5-eK2K-OcUk-yZ43-vvbw-diT892", "lv_size":"15997075456", "lv_attr":"owi-aos---", "seg_count":"1", "segtype":"linear", "pool_lv":"", "origin":"", "data_percent":"", "metadata_percent":""},
+                  {"lv_name":"in_lv_snap", "vg_name":"in_vg", "lv_path":"/dev/in_vg/in_lv_snap", "lv_uuid":"Qm3kLd-Wc8V-s2oT-Yh1N-f0aB-Rz7e-Up4XcJ", "lv_size":"15997075456", "lv_attr":"swi-a-s---", "seg_count":"1", "segtype":"linear", "pool_lv":"", "origin":"in_lv", "data_percent":"42.10", "metadata_percent":""},
+                  {"lv_name":"old_snap", "vg_name":"in_vg", "lv_path":"/dev/in_vg/old_snap", "lv_uuid":"Zp9rTx-Bn2M-c4Ue-Kq7W-o1Ly-Hd5s-Gv8AjF", "lv_size":"15997075456", "lv_attr":"swi-I-s---", "seg_count":"1", "segtype":"linear", "pool_lv":"", "origin":"in_lv", "data_percent":"100.00", "metadata_percent":""}
+              ]
+          }
+      ]
+  }
+'''
 
-def generic_setup(test_instance):
+def binaries_run(shell):
+    '''Returns the binaries of all the commands run by a FakeShell'''
+    return [command[0] for command in shell.run_commands]
+
+def generic_setup(test_instance, lvs_data=LVS_DATA, pvs_data=PVS_DATA):
     '''Setups mocks'''
     test_instance.shell = shell = FakeShell()
-    shell.add_fake('/sbin/vgdisplay', VGDISPLAY_DATA)
-    shell.add_fake('/sbin/lvdisplay', LVDISPLAY_DATA)
+    shell.add_fake_binary('/sbin/pvs', pvs_data)
+    shell.add_fake_binary('/sbin/vgs', VGS_DATA)
+    shell.add_fake_binary('/sbin/lvs', lvs_data)
     shell.add_fake(lambda _: True, mock.DEFAULT) # catch-all
     mocklist = [
         {"target": "os.path.isdir"},
@@ -121,6 +173,49 @@ class PVTest(unittest.TestCase):
         pv.remove()
         self.assertIn(('/sbin/pvremove', PV), self.shell.run_commands)
 
+    def test_size(self):
+        pv = lvm.PV(PV)
+        pv.device.path = PV # manual mock
+        self.assertEqual(pv.size, 2**20 + 714 * 4 * 2**20)
+        self.assertEqual(pv.resize_granularity, 512)
+        self.assertEqual(self.shell.run_commands[-1][-1], PV)
+
+    def test_resize(self):
+        pv = lvm.PV(PV)
+        pv.device.path = PV # manual mock
+        with mock.patch.object(lvm.PV, "_size", return_value=2**20 + 800 * 4 * 2**20):
+            # rounded up to a whole extent
+            size = pv.resize(2**20 + 799 * 4 * 2**20 + 512)
+        self.assertEqual(size, 2**20 + 800 * 4 * 2**20)
+        self.assertIn(('/sbin/pvresize', '--setphysicalvolumesize', '{}B'.format(size), PV), self.shell.run_commands)
+        with self.assertRaises(lvm.PV.WrongSize):
+            pv.resize(2**20 + 799 * 4 * 2**20 + 512, approximate=False)
+
+    def test_resize_maximum(self):
+        pv = lvm.PV(PV)
+        pv.device.path = PV # manual mock
+        pv.resize(maximum=True)
+        self.assertIn(('/sbin/pvresize', PV), self.shell.run_commands)
+
+    def test_resize_minimum(self):
+        pv = lvm.PV(PV)
+        pv.device.path = PV # manual mock
+        pv.resize(minimum=True)
+        self.assertIn(('/sbin/pvresize', '--setphysicalvolumesize', '{}B'.format(2**20 + 714 * 4 * 2**20), PV), self.shell.run_commands)
+
+    def test_orphan(self):
+        mock.patch.stopall()
+        generic_setup(self, pvs_data=ORPHAN_PVS_DATA)
+        pv = lvm.PV(PV)
+        pv.device.path = PV # manual mock
+        self.assertEqual(pv.size, 2998927360)
+        self.assertEqual(pv._process_resize_size(2**30 + 1), 2**30 + 512) # no extents, only sectors
+
+    def test_pv_record(self):
+        self.assertEqual(lvm.pv_record(PV).vg_name, VG)
+        with self.assertRaises(Exception):
+            lvm.pv_record('/dev/nonexistent')
+
 class VGTest(unittest.TestCase):
     def setUp(self):
         generic_setup(self)
@@ -131,7 +226,7 @@ class VGTest(unittest.TestCase):
     def test_get_lvs(self):
         vg = lvm.VG(VG)
         lvs = vg.get_lvs()
-        self.assertIn(('/sbin/lvdisplay',), self.shell.run_commands)
+        self.assertEqual(binaries_run(self.shell), ['/sbin/vgs', '/sbin/lvs'])
         self.assertEqual(len(lvs), 1)
         self.assertIsInstance(lvs[0], lvm.LV)
         self.assertEqual(lvs[0].name, LV)
@@ -143,10 +238,21 @@ class VGTest(unittest.TestCase):
         self.assertIsInstance(lv, lvm.LV)
         self.assertEqual(lv.name, LV)
 
+    def test_create_lvs(self):
+        vg = lvm.VG(VG)
+        lvs = vg.create_lvs([('lv1', '1G'), ('lv2', '1G')])
+        self.assertEqual([lv.name for lv in lvs], ['lv1', 'lv2'])
+        self.assertIn(('/sbin/lvcreate', VG, '--name', 'lv2', '--size', '1G'), self.shell.run_commands)
+
+    def test_remove_lvs(self):
+        vg = lvm.VG(VG)
+        vg.remove_lvs([LV], force=False)
+        self.assertEqual(self.shell.run_commands[-1], ('/sbin/lvremove', VG + '/' + LV))
+
     def test_lv(self):
         vg = lvm.VG(VG)
         lv = vg.lv(LV)
-        self.assertIn(('/sbin/lvdisplay',), self.shell.run_commands)
+        self.assertIn('/sbin/lvs', binaries_run(self.shell))
         self.assertIsInstance(lv, lvm.LV)
         self.assertEqual(lv.name, LV)
 
@@ -164,15 +270,81 @@ class LVTest(unittest.TestCase):
 
     def test_init(self):
         lv = lvm.LV(VG, LV)
-        self.assertIn(('/sbin/lvdisplay',), self.shell.run_commands)
+        self.assertIn('/sbin/lvs', binaries_run(self.shell))
         self.assertIsInstance(lv, lvm.LV)
         self.assertEqual(lv.name, LV)
 
+    def test_from_inventory(self):
+        record = lvm.lv_inventory()[0]
+        commands = len(self.shell.run_commands)
+        lv = lvm.LV.from_inventory(record)
+        self.assertEqual(len(self.shell.run_commands), commands) # no validation
+        self.assertIsInstance(lv, lvm.LV)
+        self.assertEqual(lv.name, LV)
+        self.assertEqual(lv.vg.name, VG)
+        vg = lvm.VG(VG)
+        lv = lvm.LV.from_inventory(record, vg)
+        self.assertTrue(lv.vg is vg)
+
     def test_remove(self):
         lv = lvm.LV(VG, LV)
         lv.remove()
         self.assertIn((('/sbin/lvremove', '-f', VG + '/' + LV)), self.shell.run_commands)
 
+    def test_resize_granularity(self):
+        lv = lvm.LV(VG, LV)
+        self.assertEqual(lv.resize_granularity, 4 * 2**20)
+        self.assertIn('/sbin/vgs', binaries_run(self.shell))
+
+    def test_size(self):
+        lv = lvm.LV(VG, LV)
+        self.assertEqual(lv.size, 3814 * 4 * 2**20)
+
+    def test_metadata_cache(self):
+        lv = lvm.LV(VG, LV)
+        lv.resize_granularity
+        self.shell.clear_run_commands()
+        # only the seqno is checked
+        lv.resize_granularity
+        lv.size
+        self.assertEqual(set(self.shell.run_commands), set([lvm._report_command(lvm.VGS, lvm.VGSeqnoRecord, (VG,))]))
+        # while an operation is running, the seqno is only checked once
+        self.shell.clear_run_commands()
+        with blockdevice.size_cache:
+            lv.resize_granularity
+            lv.size
+            with blockdevice.size_cache:
+                lv.size
+        self.assertEqual(self.shell.run_commands, [lvm._report_command(lvm.VGS, lvm.VGSeqnoRecord, (VG,))])
+        # changes made outside pybofh before an operation are seen by it
+        self.shell.clear_run_commands()
+        with mock.patch('pybofh.lvm._vg_seqno', return_value=14):
+            with blockdevice.size_cache:
+                lv.size
+                lv.size
+        self.assertEqual(binaries_run(self.shell), ['/sbin/vgs', '/sbin/lvs'])
+        self.shell.clear_run_commands()
+        # the metadata is fetched again if the seqno changes
+        with mock.patch('pybofh.lvm._vg_seqno', return_value=14):
+            lv.resize_granularity
+        self.assertEqual(binaries_run(self.shell), ['/sbin/vgs', '/sbin/lvs'])
+        # or if pybofh changes the VG
+        self.shell.clear_run_commands()
+        with blockdevice.size_cache:
+            lvm.create_lv(VG, 'other_lv', '1G')
+            lv.resize_granularity
+        self.assertEqual(binaries_run(self.shell), ['/sbin/lvcreate', '/sbin/vgs', '/sbin/lvs'])
+
+    def test_metadata_cache_session(self):
+        lv = lvm.LV(VG, LV)
+        lv.resize_granularity
+        self.shell.clear_run_commands()
+        # the cache follows the shell that runs the LVM commands, not shell.get()
+        with mock.patch('pybofh.lvm._session', new=self.shell), mock.patch('pybofh.shell.get', new=FakeShell):
+            with lvm.settings.change(backend='session'):
+                lv.resize_granularity
+        self.assertEqual(self.shell.run_commands, [lvm._report_command(lvm.VGS, lvm.VGSeqnoRecord, (VG,))])
+
     def test_resize(self):
         pass # TODO
         #lv = lvm.LV(VG, LV)
@@ -193,16 +365,65 @@ class ModuleFunctionsTest(unittest.TestCase):
 
     def test_get_vgs(self):
         vgs = lvm.get_vgs()
-        self.assertIn(('/sbin/vgdisplay',), self.shell.run_commands)
+        self.assertIn('/sbin/vgs', binaries_run(self.shell))
         self.assertEqual(len(vgs), 1)
         self.assertItemsEqual(vgs, [VG])
 
+    def test_lvm2_label(self):
+        header = '\x00' * 512 + 'LABELONE' + '\x01' + '\x00' * 15 + 'LVM2 001'
+        self.assertTrue(lvm.LVM2_LABEL.matches(header))
+        self.assertFalse(lvm.LVM2_LABEL.matches(header[:530]))
+        self.assertFalse(lvm.LVM2_LABEL.matches('\x00' * 1024))
+
     def test_get_lvs(self):
         lvs = lvm.get_lvs(VG)
-        self.assertIn(('/sbin/lvdisplay',), self.shell.run_commands)
+        self.assertIn('/sbin/lvs', binaries_run(self.shell))
         self.assertEqual(len(lvs), 1)
         self.assertItemsEqual(lvs, [LV])
 
+    def test_get_lvs_async(self):
+        lvs = lvm.get_lvs_async(VG)
+        self.assertItemsEqual(lvs.result(), [LV])
+        self.assertItemsEqual(lvm.get_vgs_async().result(), [VG])
+
+    def test_lv_inventory(self):
+        lvs = lvm.lv_inventory()
+        self.assertEqual(self.shell.run_commands[-1], ('/sbin/lvs', '--reportformat', 'json', '--units', 'b', '--nosuffix', '-o', ','.join(lvm.LV_FIELDS)))
+        self.assertEqual(len(lvs), 1)
+        lv = lvs[0]
+        self.assertIsInstance(lv, lvm.LVRecord)
+        self.assertEqual(lv.lv_name, LV)
+        self.assertEqual(lv.vg_name, VG)
+        self.assertEqual(lv.lv_path, '/dev/in_vg/in_lv')
+        self.assertEqual(lv.lv_size, 3814 * 4 * 2**20)
+        # only the VG is reported
+        lvm.lv_inventory('other_vg')
+        self.assertEqual(self.shell.run_commands[-1][-1], 'other_vg')
+
+    def test_vg_inventory(self):
+        vgs = lvm.vg_inventory()
+        self.assertEqual(len(vgs), 1)
+        vg = vgs[0]
+        self.assertEqual(vg.vg_name, VG)
+        self.assertEqual(vg.vg_extent_size, 4 * 2**20)
+        self.assertEqual(vg.vg_free_count, 2298)
+        self.assertEqual(vg.vg_seqno, 13)
+
+    def test_pv_inventory(self):
+        pvs = lvm.pv_inventory()
+        self.assertEqual(len(pvs), 1)
+        pv = pvs[0]
+        self.assertEqual(pv.pv_name, PV)
+        self.assertEqual(pv.vg_name, VG)
+        self.assertEqual(pv.pv_pe_count, 714)
+
+    def test_parse_report_empty_values(self):
+        output = '{"report": [{"lv": [{"lv_name":"pool", "vg_name":"in_vg", "lv_path":"", "lv_uuid":"x", "lv_size":"", "lv_attr":"twi-a-tz--", "seg_count":"1", "segtype":"thin-pool", "pool_lv":"", "origin":"", "data_percent":"", "metadata_percent":""}]}]}'
+        lv = lvm._parse_report(output, 'lv', lvm.LVRecord)[0]
+        self.assertEqual(lv.lv_path, '')
+        self.assertEqual(lv.lv_size, None)
+        self.assertEqual(lv.data_percent, None)
+
     def test_create_lv(self):
         lvm.create_lv(VG, LV, '1G')
         self.assertIn((('/sbin/lvcreate', VG, '--name', LV, '--size', '1G')), self.shell.run_commands)
@@ -211,6 +432,40 @@ class ModuleFunctionsTest(unittest.TestCase):
         lvm.remove_lv(VG, LV)
         self.assertIn((('/sbin/lvremove', "-f", VG + "/" + LV)), self.shell.run_commands)
 
+    def test_create_lvs(self):
+        lvm.create_lvs(VG, [('lv1', '1G'), ('lv2', 2**20)])
+        self.assertEqual(self.shell.run_commands, [
+            ('/sbin/lvcreate', VG, '--name', 'lv1', '--size', '1G'),
+            ('/sbin/lvcreate', VG, '--name', 'lv2', '--size', '1048576B')])
+
+    def test_create_lvs_events(self):
+        with mock.patch.object(events, "log") as log, events.sink() as sink:
+            lvm.create_lvs(VG, [('lv1', '1G'), ('lv2', 2**20)])
+        self.assertEqual([(e.operation, e.target) for e in sink.events], [
+            ('create_lv', VG + '/lv1'), ('create_lv', VG + '/lv2'), ('batch', 'create_lvs')])
+        self.assertEqual(log.info.call_count, 1) # a single record per batch
+
+    def test_create_lvs_rollback(self):
+        shell = FakeShell()
+        def lvcreate(command):
+            if 'bad' in command:
+                raise Exception("lvcreate failed")
+        shell.add_fake_binary('/sbin/lvcreate', lvcreate)
+        shell.add_fake(lambda _: True, None)
+        with mock.patch('pybofh.shell.get', new=lambda: shell):
+            with self.assertRaises(Exception):
+                lvm.create_lvs(VG, [('lv1', '1G'), ('lv2', '1G'), ('bad', '1G'), ('lv3', '1G')])
+        removes = [c for c in shell.run_commands if c[0] == '/sbin/lvremove']
+        self.assertEqual(removes, [('/sbin/lvremove', '-f', VG + '/lv2'), ('/sbin/lvremove', '-f', VG + '/lv1')])
+        self.assertNotIn(('/sbin/lvcreate', VG, '--name', 'lv3', '--size', '1G'), shell.run_commands)
+
+    def test_remove_lvs(self):
+        lvm.remove_lvs(VG, [LV])
+        self.assertEqual(self.shell.run_commands[-1], ('/sbin/lvremove', '-f', VG + '/' + LV))
+        with self.assertRaises(Exception):
+            lvm.remove_lvs(VG, [LV, 'inexistent'])
+        self.assertEqual(len([c for c in self.shell.run_commands if c[0] == '/sbin/lvremove']), 1)
+
     def test_rename_lv(self):
         lvm.rename_lv(VG, LV, "lvnewname")
         self.assertIn((('/sbin/lvrename', VG, LV, "lvnewname")), self.shell.run_commands)
@@ -231,5 +486,269 @@ class ModuleFunctionsTest(unittest.TestCase):
         lvm.remove_pv(PV)
         self.assertIn((('/sbin/pvremove', PV)), self.shell.run_commands)
 
+def pvs_with_segments(command):
+    '''Fake pvs, that supports --segments and --select vg_name=VG'''
+    if "--segments" not in command:
+        return PVS_DATA
+    if "--select" not in command:
+        return PVSEG_DATA
+    vg = command[command.index("--select") + 1].split("=")[1]
+    report = json.loads(PVSEG_DATA)
+    report['report'][0]['pvseg'] = [r for r in report['report'][0]['pvseg'] if r['vg_name'] == vg]
+    return json.dumps(report)
+
+class ExtentPlannerTest(unittest.TestCase):
+    EXTENT = 4 * 2**20
+
+    def setUp(self):
+        generic_setup(self, pvs_data=pvs_with_segments)
+
+    def tearDown(self):
+        mock.patch.stopall()
+
+    def test_pv_segments(self):
+        segments = lvm.pv_segments(VG)
+        self.assertEqual(self.shell.run_commands[-1][-2:], ('--select', 'vg_name=' + VG))
+        self.assertEqual(len(segments), 5)
+        self.assertEqual(segments[1].pvseg_start, 600)
+        self.assertEqual(segments[1].lv_name, '')
+        self.assertEqual(len(lvm.pv_segments()), 6)
+
+    def test_free_extents(self):
+        planner = lvm.VG(VG).planner()
+        self.assertEqual(planner.pvs, ['/dev/in1', '/dev/in2'])
+        self.assertEqual(planner.free_extents(), 1200)
+        self.assertEqual(planner.free_extents('/dev/in2'), 800)
+        self.assertEqual(planner.extents('1G'), 256)
+        self.assertEqual(planner.extents(self.EXTENT + 1), 2)
+
+    def test_plan(self):
+        planner = lvm.ExtentPlanner(VG)
+        commands = len(self.shell.run_commands)
+        p1, p2 = planner.plan([('lv1', 300 * self.EXTENT), ('lv2', 500 * self.EXTENT)])
+        self.assertEqual(p1.areas, [('/dev/in1', 600, 300)])
+        # doesn't fit on the rest of in1, but fits on in2
+        self.assertEqual(p2.areas, [('/dev/in2', 0, 300), ('/dev/in2', 500, 200)])
+        self.assertEqual(p2.pvs, ['/dev/in2'])
+        self.assertEqual(len(self.shell.run_commands), commands) # planning runs no commands
+
+    def test_plan_spanning(self):
+        planner = lvm.ExtentPlanner(VG)
+        p, = planner.plan([('big', 1000 * self.EXTENT)])
+        self.assertEqual(p.areas, [('/dev/in1', 600, 400), ('/dev/in2', 0, 300), ('/dev/in2', 500, 300)])
+        self.assertEqual(p.pvs, ['/dev/in1', '/dev/in2'])
+        with self.assertRaises(lvm.ExtentPlanner.NoSpace):
+            planner.plan([('big', 1000 * self.EXTENT), ('lv2', 201 * self.EXTENT)])
+        self.assertTrue(planner.fits([('big', 1000 * self.EXTENT), ('lv2', 200 * self.EXTENT)]))
+        self.assertFalse(planner.fits([('huge', 1201 * self.EXTENT)]))
+
+    def test_plan_contiguous(self):
+        planner = lvm.ExtentPlanner(VG)
+        p, = planner.plan([('lv1', 450 * self.EXTENT)], alloc='contiguous')
+        self.assertEqual(p.areas, [('/dev/in2', 500, 450)])
+        with self.assertRaises(lvm.ExtentPlanner.NoSpace):
+            planner.plan([('lv1', 501 * self.EXTENT)], alloc='contiguous')
+        with self.assertRaises(ValueError):
+            planner.plan([('lv1', '1G')], alloc='nonexistent')
+
+    def test_plan_spread(self):
+        planner = lvm.ExtentPlanner(VG)
+        placements = planner.plan([('lv1', '1G'), ('lv2', '1G'), ('lv3', '1G')], spread=True)
+        self.assertEqual([p.pvs for p in placements], [['/dev/in2'], ['/dev/in2'], ['/dev/in1']])
+
+    def test_plan_pvs(self):
+        planner = lvm.ExtentPlanner(VG)
+        p, = planner.plan([('lv1', '1G')], pvs=['/dev/in2'])
+        self.assertEqual(p.pvs, ['/dev/in2'])
+        with self.assertRaises(Exception):
+            planner.plan([('lv1', '1G')], pvs=['/dev/other1'])
+
+    def test_create_lvs_spread(self):
+        vg = lvm.VG(VG)
+        vg.create_lvs([('lv1', '1G'), ('lv2', '1G')], spread=True)
+        self.assertIn(('/sbin/lvcreate', VG, '--name', 'lv1', '--size', '1G', '/dev/in2'), self.shell.run_commands)
+        self.assertIn(('/sbin/lvcreate', VG, '--name', 'lv2', '--size', '1G', '/dev/in2'), self.shell.run_commands)
+
+    def test_create_lvs_validate(self):
+        with self.assertRaises(lvm.ExtentPlanner.NoSpace):
+            lvm.create_lvs(VG, [('lv1', '4T')], validate=True)
+        self.assertNotIn('/sbin/lvcreate', binaries_run(self.shell))
+
+    def test_create_lv_alloc(self):
+        lvm.create_lv(VG, LV, '1G', alloc='contiguous', pvs=['/dev/in1'])
+        self.assertIn(('/sbin/lvcreate', VG, '--name', LV, '--size', '1G', '--alloc', 'contiguous', '/dev/in1'), self.shell.run_commands)
+
+    def test_size_bytes(self):
+        self.assertEqual(lvm._size_bytes(512), 512)
+        self.assertEqual(lvm._size_bytes('1G'), 2**30)
+        self.assertEqual(lvm._size_bytes('1.5k'), 1536)
+        self.assertEqual(lvm._size_bytes('2'), 2 * 2**20)
+        self.assertEqual(lvm._size_bytes('8s'), 4096)
+        with self.assertRaises(ValueError):
+            lvm._size_bytes('1X')
+
+class ThinTest(unittest.TestCase):
+    def setUp(self):
+        generic_setup(self, lvs_data=THIN_LVS_DATA)
+
+    def tearDown(self):
+        mock.patch.stopall()
+
+    def test_inventory(self):
+        pool, thin, snap = lvm.lv_inventory()
+        self.assertEqual(pool.segtype, 'thin-pool')
+        self.assertEqual(pool.data_percent, 12.5)
+        self.assertEqual(pool.metadata_percent, 3.05)
+        self.assertEqual(thin.pool_lv, 'pool')
+        self.assertEqual(thin.metadata_percent, None)
+        self.assertEqual(snap.origin, 'thin1')
+
+    def test_get_lvs(self):
+        vg = lvm.VG(VG)
+        lvs = vg.get_lvs()
+        self.assertEqual([lv.name for lv in lvs], ['thin1', 'thin1_snap'])
+        self.assertTrue(all(isinstance(lv, lvm.ThinLV) for lv in lvs))
+        pools = vg.get_thin_pools()
+        self.assertEqual([p.name for p in pools], ['pool'])
+
+    def test_create_thin_pool(self):
+        vg = lvm.VG(VG)
+        pool = vg.create_thin_pool('pool', '10G', metadata_size=2**30)
+        self.assertIn(('/sbin/lvcreate', VG, '--type', 'thin-pool', '--name', 'pool', '--size', '10G', '--poolmetadatasize', '1073741824B'), self.shell.run_commands)
+        self.assertIsInstance(pool, lvm.ThinPool)
+        self.assertEqual(pool.size, 10 * 2**30)
+
+    def test_create_thin_lv(self):
+        pool = lvm.VG(VG).thin_pool('pool')
+        lv = pool.create_thin_lv('thin1', '20G')
+        self.assertIn(('/sbin/lvcreate', VG, '--type', 'thin', '--thinpool', 'pool', '--name', 'thin1', '--virtualsize', '20G'), self.shell.run_commands)
+        self.assertIsInstance(lv, lvm.ThinLV)
+        self.assertEqual(lv.pool.name, 'pool')
+        with self.assertRaises(Exception):
+            lvm.VG(VG).thin_pool('thin1') # not a pool
+
+    def test_snapshot(self):
+        lv = lvm.ThinLV(VG, 'thin1')
+        snap = lv.snapshot('thin1_snap')
+        self.assertIn(('/sbin/lvcreate', '--snapshot', '--name', 'thin1_snap', '--setactivationskip', 'n', '--activate', 'y', VG + '/thin1'), self.shell.run_commands)
+        self.assertIsInstance(snap, lvm.ThinLV)
+
+    def test_usage(self):
+        pool = lvm.ThinPool(VG, 'pool')
+        lvs_commands = binaries_run(self.shell).count('/sbin/lvs')
+        self.assertEqual(pool.usage(), (12.5, 3.05))
+        self.assertEqual(pool.data_percent, 12.5)
+        # usage isn't cached
+        self.assertEqual(binaries_run(self.shell).count('/sbin/lvs'), lvs_commands + 2)
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        generic_setup(self, lvs_data=SNAPSHOT_LVS_DATA)
+
+    def tearDown(self):
+        mock.patch.stopall()
+
+    def test_get_lvs(self):
+        lvs = lvm.VG(VG).get_lvs()
+        self.assertEqual([type(lv) for lv in lvs], [lvm.LV, lvm.Snapshot, lvm.Snapshot])
+        self.assertEqual(lvs[1].origin.name, 'in_lv')
+
+    def test_snapshot(self):
+        lv = lvm.LV(VG, 'in_lv')
+        snap = lv.snapshot('in_lv_snap', 2**30)
+        self.assertIn(('/sbin/lvcreate', '--snapshot', '--name', 'in_lv_snap', '--size', '1073741824B', VG + '/in_lv'), self.shell.run_commands)
+        self.assertIsInstance(snap, lvm.Snapshot)
+
+    def test_thin_lv_snapshot(self):
+        lv = lvm.ThinLV(VG, 'in_lv', skip_validation=True)
+        snap = lv.snapshot('in_lv_snap', size='1G')
+        self.assertIn(('/sbin/lvcreate', '--snapshot', '--name', 'in_lv_snap', '--size', '1G', VG + '/in_lv'), self.shell.run_commands)
+        self.assertIsInstance(snap, lvm.Snapshot)
+
+    def test_cow_usage(self):
+        snap = lvm.Snapshot(VG, 'in_lv_snap')
+        lvs_commands = binaries_run(self.shell).count('/sbin/lvs')
+        self.assertEqual(snap.cow_usage, 42.1)
+        self.assertEqual(snap.cow_usage, 42.1)
+        # usage isn't cached
+        self.assertEqual(binaries_run(self.shell).count('/sbin/lvs'), lvs_commands + 2)
+        self.assertEqual(self.shell.run_commands[-1][-1], VG + '/in_lv_snap')
+        self.assertFalse(snap.is_invalid)
+        self.assertTrue(lvm.Snapshot(VG, 'old_snap').is_invalid)
+
+    def test_lv_record(self):
+        self.assertEqual(lvm.lv_record(VG, 'old_snap').data_percent, 100.0)
+        with self.assertRaises(Exception):
+            lvm.lv_record(VG, 'nonexistent')
+
+    def test_merge(self):
+        snap = lvm.Snapshot(VG, 'in_lv_snap')
+        snap.merge()
+        self.assertIn(('/sbin/lvconvert', '--merge', VG + '/in_lv_snap'), self.shell.run_commands)
+        self.assertEqual(snap.name, lvm.REMOVED)
+
+    def test_remove(self):
+        snap = lvm.Snapshot(VG, 'in_lv_snap')
+        snap.remove()
+        self.assertIn(('/sbin/lvremove', '-f', VG + '/in_lv_snap'), self.shell.run_commands)
+
+class LvmShellTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.lvm_binary = tempfile.mkstemp()
+        os.write(fd, FAKE_LVM_SHELL)
+        os.close(fd)
+        os.chmod(self.lvm_binary, stat.S_IRWXU)
+        self.addCleanup(os.remove, self.lvm_binary)
+        self.shell = lvm.LvmShell(self.lvm_binary)
+        self.addCleanup(self.shell.close)
+
+    def test_check_output(self):
+        out = self.shell.check_output(('/sbin/lvs', '-o', 'lv_name'))
+        self.assertEqual(json.loads(out)['report'], [{'echo': 'lvs -o lv_name --reportformat json'}])
+        out = self.shell.check_output(('vgs', '--reportformat', 'json'))
+        self.assertEqual(json.loads(out)['report'], [{'echo': 'vgs --reportformat json'}])
+        pid = self.shell._process.pid
+        self.shell.check_output(('pvs',))
+        self.assertEqual(self.shell._process.pid, pid) # same session
+
+    def test_check_call(self):
+        fake = FakeShell()
+        with mock.patch('pybofh.shell.get', new=lambda: fake):
+            self.shell.check_call(('/sbin/lvcreate', 'vg', '--name', 'lv'))
+            self.assertEqual(fake.generation, 1)
+            with self.assertRaises(subprocess.CalledProcessError) as cm:
+                self.shell.check_call(('fail', 'x'))
+            self.assertEqual(cm.exception.returncode, 5)
+            self.assertEqual(fake.generation, 2)
+        # the session survives failed commands
+        self.shell.check_output(('lvs',))
+
+    def test_no_status(self):
+        # older LVM builds may not log the exit status
+        with self.assertRaises(lvm.LvmShell.NoStatus):
+            self.shell.check_output(('nostatus', 'x'))
+        self.shell.check_output(('lvs',))
+
+    def test_whitespace(self):
+        with self.assertRaises(ValueError):
+            self.shell.check_output(('lvs', 'a b'))
+
+    def test_session_died(self):
+        self.shell.check_output(('lvs',))
+        self.shell._process.kill()
+        self.shell._process.wait()
+        self.shell.check_output(('lvs',)) # restarted
+
+    def test_backend(self):
+        fake = FakeShell()
+        fake.add_fake(lambda _: True, None)
+        with mock.patch('pybofh.lvm._session', new=fake), mock.patch('pybofh.shell.get', new=FakeShell):
+            with lvm.settings.change(backend='session'):
+                lvm.create_lv('vg', 'lv', '1G')
+        self.assertEqual(fake.run_commands, [('/sbin/lvcreate', 'vg', '--name', 'lv', '--size', '1G')])
+        with lvm.settings.change(backend='xxx'):
+            with self.assertRaises(ValueError):
+                lvm.get_vgs()
+
 if __name__ == "__main__":
     unittest.main()
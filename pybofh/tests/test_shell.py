@@ -1,7 +1,14 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
 import unittest
 import mock
 
-from pybofh.shell import SystemShell, FakeShell
+from pybofh import shell as shellmodule
+from pybofh.shell import SystemShell, PersistentShell, AsyncShell, FakeShell, RecordingShell, ReplayShell, Future, gather
 
 class SystemShellTest(unittest.TestCase):
     def test_check_call(self):
@@ -18,6 +25,220 @@ class SystemShellTest(unittest.TestCase):
         response = shell.check_output(('ls', '.'))
         self.assertGreater(len(response), 0)
 
+class PersistentShellTest(unittest.TestCase):
+    def setUp(self):
+        self.shell = PersistentShell()
+        self.addCleanup(self.shell.close)
+
+    def test_check_call(self):
+        response = self.shell.check_call(('pwd',))
+        self.assertEqual(response, None)
+
+    def test_check_output(self):
+        response = self.shell.check_output(('pwd',))
+        self.assertEqual(response, subprocess.check_output(('pwd',)))
+        response = self.shell.check_output(('printf', 'a\nb'))
+        self.assertEqual(response, 'a\nb') # no trailing newline
+        response = self.shell.check_output(('echo', "it's $HOME; `x`"))
+        self.assertEqual(response, "it's $HOME; `x`\n") # arguments aren't interpreted by the shell
+        response = self.shell.check_output(('cat',))
+        self.assertEqual(response, '') # stdin isn't the worker's
+
+    def test_error(self):
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            self.shell.check_output(('sh', '-c', 'echo out; exit 3'))
+        self.assertEqual(cm.exception.returncode, 3)
+        self.assertEqual(cm.exception.output, 'out\n')
+        # the worker is still usable
+        self.assertEqual(self.shell.check_output(('echo', 'a')), 'a\n')
+
+    def test_worker_reuse(self):
+        pid = self.shell.check_output(('sh', '-c', 'echo $PPID'))
+        self.assertEqual(self.shell.check_output(('sh', '-c', 'echo $PPID')), pid)
+        self.shell.close()
+        self.assertNotEqual(self.shell.check_output(('sh', '-c', 'echo $PPID')), pid)
+
+    def test_worker_died(self):
+        self.shell.check_output(('true',))
+        self.shell._worker.kill()
+        self.shell._worker.wait()
+        # a dead worker is restarted
+        self.assertEqual(self.shell.check_output(('echo', 'a')), 'a\n')
+        with self.assertRaises(PersistentShell.WorkerDied):
+            self.shell.check_output(('sh', '-c', 'kill $PPID'))
+        self.assertEqual(self.shell.check_output(('echo', 'a')), 'a\n')
+
+class FutureTest(unittest.TestCase):
+    def test_result(self):
+        f = Future.from_call(lambda x: x + 1, 1)
+        self.assertTrue(f.done())
+        self.assertEqual(f.result(), 2)
+        self.assertEqual(f.then(lambda x: x * 3).result(), 6)
+
+    def test_exception(self):
+        f = Future.from_call(lambda: 1 / 0)
+        with self.assertRaises(ZeroDivisionError):
+            f.result()
+        with self.assertRaises(ZeroDivisionError):
+            f.then(lambda x: x).result()
+
+    def test_gather(self):
+        futures = [Future.from_call(lambda x=x: x) for x in range(3)]
+        self.assertEqual(gather(futures), [0, 1, 2])
+
+class AsyncShellTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeShell()
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+        self.fake.add_fake_binary('sleep', self.sleep)
+
+    def sleep(self, command):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(float(command[1]))
+        with self.lock:
+            self.running -= 1
+        return command[1]
+
+    def test_check_output(self):
+        shell = AsyncShell(self.fake)
+        self.assertEqual(shell.check_output(('sleep', '0')), '0')
+        self.assertEqual(self.fake.run_commands, [('sleep', '0')])
+
+    def test_concurrency(self):
+        shell = AsyncShell(self.fake, max_concurrency=3)
+        futures = [shell.check_output_async(('sleep', '0.05')) for _ in range(9)]
+        self.assertEqual(gather(futures), ['0.05'] * 9)
+        self.assertEqual(self.max_running, 3)
+        self.assertEqual(len(shell._workers), 3) # the threads are reused
+
+    def test_profile(self):
+        shell = AsyncShell(self.fake)
+        with shell.profile() as outer, self.fake.profile() as inner:
+            gather([shell.check_output_async(('sleep', '0')) for _ in range(2)])
+        self.assertEqual(len(outer.records), 2)
+        self.assertEqual(len(inner.records), 2)
+        self.assertEqual(outer.callers().keys(), [__name__ + '.test_profile'])
+        self.assertEqual(inner.callers().keys(), [__name__ + '.test_profile'])
+
+    def test_error(self):
+        shell = AsyncShell(self.fake)
+        future = shell.check_output_async(('ps',))
+        with self.assertRaises(FakeShell.NoFakeForCommand):
+            future.result()
+
+    def test_system_shell(self):
+        shell = AsyncShell()
+        futures = [shell.check_output_async(('echo', str(i))) for i in range(4)]
+        self.assertEqual(gather(futures), ['0\n', '1\n', '2\n', '3\n'])
+
+class ProfileTest(unittest.TestCase):
+    def setUp(self):
+        self.shell = FakeShell()
+        self.shell.add_fake(('/sbin/lvs',), 'abc')
+        self.shell.add_fake(('/sbin/dmsetup', 'info'), 'x')
+        self.shell.add_fake_binary('/bin/false', lambda command: subprocess.check_call(('false',)))
+
+    def test_profile(self):
+        with self.shell.profile() as p:
+            self.shell.check_output(('/sbin/lvs',))
+            self.shell.check_output(('/sbin/lvs',))
+            self.shell.check_call(('/sbin/dmsetup', 'info'))
+            with self.assertRaises(subprocess.CalledProcessError):
+                self.shell.check_call(('/bin/false',))
+            with self.assertRaises(FakeShell.NoFakeForCommand):
+                self.shell.check_call(('ps',))
+        self.shell.check_output(('/sbin/lvs',)) # not profiled
+        self.assertEqual(len(p.records), 5)
+        record = p.records[0]
+        self.assertEqual(record.command, ('/sbin/lvs',))
+        self.assertEqual(record.status, 0)
+        self.assertEqual(record.output_size, 3)
+        self.assertEqual(record.caller, __name__ + '.test_profile')
+        self.assertGreaterEqual(record.duration, 0)
+        self.assertEqual([r.status for r in p.records[2:]], [0, 1, None])
+        stats = p.stats()
+        self.assertItemsEqual(stats.keys(), ['lvs', 'dmsetup', 'false', 'ps'])
+        self.assertEqual(stats['lvs']['count'], 2)
+        self.assertLessEqual(stats['lvs']['p50'], stats['lvs']['p95'])
+        self.assertLessEqual(stats['lvs']['p95'], stats['lvs']['max'])
+        self.assertEqual(p.callers()[__name__ + '.test_profile'][0], 5)
+        self.assertIn('dmsetup', p.summary())
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(shellmodule._percentile(values, 50), 50)
+        self.assertEqual(shellmodule._percentile(values, 95), 95)
+        self.assertEqual(shellmodule._percentile([7], 95), 7)
+
+    def test_nested(self):
+        with self.shell.profile() as p1:
+            self.shell.check_output(('/sbin/lvs',))
+            with self.shell.profile() as p2:
+                self.shell.check_output(('/sbin/lvs',))
+        self.assertEqual(len(p1.records), 2)
+        self.assertEqual(len(p2.records), 1)
+
+    def test_module_profile(self):
+        with mock.patch('pybofh.shell.get', new=lambda: self.shell):
+            with shellmodule.profile() as p:
+                self.shell.check_output(('/sbin/lvs',))
+        self.assertEqual(len(p.records), 1)
+
+class RecordReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, "recording.gz")
+        self.outputs = iter(["one\n", "two\n", "\xff\x00binary"])
+        self.inner = inner = FakeShell()
+        inner.add_fake_binary('/sbin/lvs', lambda command: next(self.outputs))
+        inner.add_fake_binary('/bin/false', lambda command: subprocess.check_output(('sh', '-c', 'echo err; exit 3')))
+        self.recording = RecordingShell(inner)
+
+    def test_record(self):
+        self.assertEqual(self.recording.check_output(('/sbin/lvs',)), "one\n")
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.recording.check_call(('/bin/false',))
+        with self.assertRaises(FakeShell.NoFakeForCommand):
+            self.recording.check_call(('ps',)) # not recorded
+        self.assertEqual([(r.command, r.output, r.status) for r in self.recording.records], [
+            (('/sbin/lvs',), "one\n", 0), (('/bin/false',), "err\n", 3)])
+        self.assertGreaterEqual(self.recording.records[0].duration, 0)
+
+    def test_inner_profile(self):
+        with self.inner.profile() as p:
+            self.recording.check_output(('/sbin/lvs',))
+        self.assertEqual([r.command for r in p.records], [('/sbin/lvs',)])
+
+    def test_replay(self):
+        for _ in range(3):
+            self.recording.check_output(('/sbin/lvs', '-o', 'lv_name'))
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.recording.check_call(('/bin/false', 'x'))
+        self.recording.save(self.path)
+        replay = ReplayShell(self.path)
+        # responses are replayed in order, and the last one is repeated
+        outputs = [replay.check_output(('/sbin/lvs', '-o', 'lv_name')) for _ in range(4)]
+        self.assertEqual(outputs, ["one\n", "two\n", "\xff\x00binary", "\xff\x00binary"])
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            replay.check_call(('/bin/false', 'x'))
+        self.assertEqual((cm.exception.returncode, cm.exception.output), (3, "err\n"))
+        with self.assertRaises(ReplayShell.NotRecorded):
+            replay.check_output(('/sbin/lvs',))
+
+    def test_latency(self):
+        records = [shellmodule.RecordedCommand(('ls',), "x", 0, 0.05)]
+        start = time.time()
+        self.assertEqual(ReplayShell(records).check_output(('ls',)), "x")
+        self.assertLess(time.time() - start, 0.05)
+        start = time.time()
+        ReplayShell(records, latency=1.0).check_output(('ls',))
+        self.assertGreaterEqual(time.time() - start, 0.05)
+
 class FakeShellTest(unittest.TestCase):
     def test_check_call(self):
         shell = FakeShell()
@@ -31,6 +252,18 @@ class FakeShellTest(unittest.TestCase):
         response = shell.check_output(('pwd',))
         self.assertEqual(response, 'response')
 
+    def test_generation(self):
+        shell = FakeShell()
+        shell.add_fake('pwd', 'response')
+        self.assertEqual(shell.generation, 0)
+        shell.check_output(('pwd',))
+        self.assertEqual(shell.generation, 0)
+        shell.check_call(('pwd',))
+        self.assertEqual(shell.generation, 1)
+        with self.assertRaises(FakeShell.NoFakeForCommand):
+            shell.check_call(('ps',))
+        self.assertEqual(shell.generation, 2)
+
     def test_add_fake(self):
         shell = FakeShell()
         # literal command, literal response
@@ -69,6 +302,39 @@ class FakeShellTest(unittest.TestCase):
         self.assertEqual(shell.check_output(('/bin/ls','a')), 'called /bin/ls: a')
         self.assertEqual(shell.check_output(('ls','a')), 'called ls: a')
 
+    def test_fake_order(self):
+        shell = FakeShell()
+        matcher = mock.Mock(return_value=True)
+        shell.add_fake_binary('/bin/ls', 'binary')
+        shell.add_fake(matcher, 'callable')
+        shell.add_fake(('/bin/ls', 'a'), 'exact')
+        shell.add_fake(('/bin/cat',), 'exact')
+        # the first fake added wins
+        self.assertEqual(shell.check_output(('/bin/ls', 'a')), 'binary')
+        self.assertEqual(shell.check_output(('/bin/cat', 'a')), 'callable')
+        self.assertEqual(matcher.call_count, 1) # not called for commands with earlier fakes
+        self.assertEqual(shell.check_output(('cat', 'a')), 'callable')
+        shell.remove_fake(matcher)
+        self.assertEqual(shell.check_output(('/bin/cat',)), 'exact')
+        with self.assertRaises(FakeShell.NoFakeForCommand):
+            shell.check_output(('/bin/cat', 'a'))
+        shell.remove_fake(('/bin/cat',))
+        with self.assertRaises(KeyError):
+            shell.remove_fake(('/bin/cat',))
+
+    def test_max_run_commands(self):
+        shell = FakeShell(max_run_commands=2)
+        shell.add_fake_binary('ls', 'x')
+        for i in range(5):
+            shell.check_output(('ls', str(i)))
+        self.assertEqual(list(shell.run_commands), [('ls', '3'), ('ls', '4')])
+        shell.clear_run_commands()
+        self.assertEqual(len(shell.run_commands), 0)
+        shell = FakeShell(max_run_commands=0)
+        shell.add_fake_binary('ls', 'x')
+        shell.check_output(('ls',))
+        self.assertEqual(len(shell.run_commands), 0)
+
 
 
 
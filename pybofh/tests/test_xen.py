@@ -5,6 +5,7 @@ import unittest
 import mock
 from pkg_resources import resource_stream
 from pybofh.tests import common
+from pybofh import shell
 from pybofh import xen
 
 DOMUS_CFGS = ["domu1.cfg"]
@@ -120,6 +121,12 @@ class ModuleTest(unittest.TestCase):
         l = xen.running_domus_names()
         self.assertEqual(l, ['domu1', 'domu2', 'domu3'])
 
+    def test_running_domus_names_async(self):
+        async_shell = shell.AsyncShell(self.env.shell)
+        with mock.patch('pybofh.shell.get', new=lambda: async_shell):
+            future = xen.running_domus_names_async()
+            self.assertEqual(future.result(), ['domu1', 'domu2', 'domu3'])
+
     def test_all_domus_configs_filepaths(self):
         with mock.patch('os.listdir', return_value=['domu.cfg', 'unrelated.txt']):
             with xen.settings.change(domu_config_dirs=[]):
@@ -137,8 +137,14 @@ class Domu(object):
         return "Domu<{}>".format(self.name)
 
 def running_domus_names():
+    return running_domus_names_async().result()
+
+def running_domus_names_async():
+    """Like running_domus_names, but returns a shell.Future"""
     command = (XL, "list")
-    out = shell.get().check_output(command)
+    return shell.get().check_output_async(command).then(_parse_xl_list)
+
+def _parse_xl_list(out):
     running = [line.split()[0] for line in out.split('\n')[1:-1]]
     running.remove('Domain-0') #Domain-0 is not a DomU!
     return running